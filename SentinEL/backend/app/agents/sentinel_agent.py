@@ -1,25 +1,165 @@
+import os
+import asyncio
 import logging
-import json
-from typing import TypedDict, Annotated, List, Any, Dict, Union
+import hashlib
+import datetime
+import orjson
+from typing import TypedDict, Annotated, List, Any, Dict, Union, AsyncIterator, Optional
 
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_google_vertexai import ChatVertexAI
 from langchain.tools import tool
 from langgraph.graph import StateGraph, END
+from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 
 from app.core.config import settings
-from app.agents.tools import ALL_TOOLS
+from app.agents.tools import ALL_TOOLS, lookup_user_profile, predict_churn_risk
 
 logger = logging.getLogger(__name__)
 
+# ==============================================================================
+# System Prompt
+# ==============================================================================
+
+SYSTEM_PROMPT = (
+    "你是一个决策型 AI (SentinEL Agent)。"
+    "你的目标是为用户制定最佳挽留策略。"
+    "必须遵循以下决策逻辑："
+    "1. 首先调用 lookup_user_profile 获取用户画像和最近行为。"
+    "2. 然后调用 predict_churn_risk 获取流失概率。"
+    "3. 评估风险：如果风险高（Risk Level = High 或 Score > 0.7），必须寻找挽留策略。"
+    "4. 调用 find_retention_strategies 获取候选策略。"
+    "5. 对成本最高的策略，务必调用 check_budget_availability 确认预算。"
+    "6. 如果预算不足或风险较低，仅建议发送关怀邮件或低成本策略。"
+    "7. 每一步都要解释原因 (Thought)。"
+    "8. 最终给出一个总结性的建议。"
+)
+
+# Built once and shared across every ReAct iteration
+_SYSTEM_MSG = SystemMessage(content=SYSTEM_PROMPT)
+
+# Canonical prompt: the system prompt is pinned at position 0 with byte-identical
+# content on every request, so the model server can reuse the prefix KV cache.
+# NOTE: SYSTEM_PROMPT must stay a plain constant (no per-request interpolation).
+# For guaranteed reuse on Vertex, register it as Gemini context cache (cachedContent).
+AGENT_PROMPT = ChatPromptTemplate.from_messages([
+    _SYSTEM_MSG,
+    MessagesPlaceholder("history"),
+])
+
+AGENT_MODEL_NAME = "gemini-2.5-pro" # Validated via script and console
+
+# ==============================================================================
+# Gemini Context Cache (cachedContent)
+# ==============================================================================
+
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+CONTEXT_CACHE_REFRESH_MARGIN_S = 300   # 提前 5 分钟在后台续建，避免请求命中已过期的缓存
+# Gemini 显式上下文缓存的最小 token 数 (低于此值 create 必然失败，直接走常规路径)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("AGENT_CONTEXT_CACHE_MIN_TOKENS", "2048"))
+
+# SYSTEM_PROMPT 为常量，其版本哈希在模块加载时计算一次 (写入缓存日志，便于核对缓存对应的 Prompt)
+SYSTEM_PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+
+class PromptContextCache:
+    """
+    将 System Prompt + 工具声明注册为 Vertex AI CachedContent，
+    后续调用通过 cached_content 引用，Gemini 跳过这部分前缀的 prefill。
+
+    - 仅在启动时 (warmup_agent) 创建一次，且前缀达到 CONTEXT_CACHE_MIN_TOKENS 才启用
+    - 过期前由后台任务续建，请求路径上不发起任何缓存 RPC、不持锁
+    - 续建失败时回退到 AGENT_PROMPT | llm.bind_tools 的常规路径
+    """
+
+    def __init__(self, tools: List[Any], fallback):
+        self._tools = tools
+        self._fallback = fallback
+        self._runnable = None  # 引用赋值是原子的，请求线程直接读取
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _cacheable_tokens(self, llm: ChatVertexAI) -> int:
+        """System Prompt + 工具声明的 token 数 (count_tokens)"""
+        tool_specs = [{"name": t.name, "description": t.description, "args": t.args} for t in self._tools]
+        return llm.get_num_tokens(SYSTEM_PROMPT + orjson.dumps(tool_specs).decode())
+
+    def _create(self):
+        from langchain_google_vertexai.utils import create_context_cache
+
+        base_llm = ChatVertexAI(
+            project=settings.PROJECT_ID,
+            location=settings.LOCATION,
+            model_name=AGENT_MODEL_NAME,
+        )
+        cache_name = create_context_cache(
+            base_llm,
+            messages=[_SYSTEM_MSG],
+            time_to_live=CONTEXT_CACHE_TTL,
+            tools=self._tools,
+        )
+        logger.info(f"Agent context cache created: {cache_name} (prompt {SYSTEM_PROMPT_HASH})")
+        # System prompt and tools live in the cache, so only history is sent per call
+        return ChatVertexAI(
+            project=settings.PROJECT_ID,
+            location=settings.LOCATION,
+            model_name=AGENT_MODEL_NAME,
+            temperature=0.0,
+            max_output_tokens=2048,
+            cached_content=cache_name,
+        )
+
+    async def start(self, llm: ChatVertexAI) -> bool:
+        """
+        启动时调用一次: 前缀达到最小 token 数时创建缓存并启动后台续建。
+        返回 False 表示不启用 (调用方直接绑定常规路径)。
+        """
+        try:
+            tokens = await asyncio.to_thread(self._cacheable_tokens, llm)
+        except Exception as e:
+            logger.warning(f"Agent context cache disabled, token count failed: {e}")
+            return False
+        if tokens < CONTEXT_CACHE_MIN_TOKENS:
+            logger.info(
+                f"Agent context cache disabled: prompt + tools = {tokens} tokens "
+                f"(minimum {CONTEXT_CACHE_MIN_TOKENS})"
+            )
+            return False
+        if not await self._refresh():
+            return False
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        return True
+
+    async def _refresh(self) -> bool:
+        try:
+            self._runnable = await asyncio.to_thread(self._create)
+            return True
+        except Exception as e:
+            logger.warning(f"Agent context cache unavailable, using uncached prompt: {e}")
+            self._runnable = None
+            return False
+
+    async def _refresh_loop(self):
+        interval = CONTEXT_CACHE_TTL.total_seconds() - CONTEXT_CACHE_REFRESH_MARGIN_S
+        while True:
+            await asyncio.sleep(interval)
+            await self._refresh()
+
+    def invoke(self, inputs: Dict[str, List[BaseMessage]]) -> BaseMessage:
+        """与 AGENT_PROMPT | llm_with_tools 相同的调用方式: {"history": [...]}"""
+        runnable = self._runnable
+        if runnable is not None:
+            return runnable.invoke(inputs["history"])
+        return self._fallback.invoke(inputs)
+
 # ==============================================================================
 # Agent State
 # ==============================================================================
 
 class AgentState(TypedDict):
-    messages: Annotated[List[BaseMessage], "The conversation history"]
+    # add_messages appends node outputs to the history instead of replacing the list
+    messages: Annotated[List[BaseMessage], add_messages]
     user_id: str
 
 # ==============================================================================
@@ -37,22 +177,31 @@ class TraceStep(TypedDict):
 # Graph Construction
 # ==============================================================================
 
-def create_agent_graph():
+def create_agent_llm() -> ChatVertexAI:
     """
-    Constructs the ReAct Agent Graph using LangGraph.
+    Creates the chat model used by the reasoning node.
     """
-    
-    # 1. Initialize LLM with Tools
-    llm = ChatVertexAI(
+    return ChatVertexAI(
         project=settings.PROJECT_ID,
         location=settings.LOCATION,
-        model_name="gemini-2.5-pro", # Validated via script and console
+        model_name=AGENT_MODEL_NAME,
         temperature=0.0,
         max_output_tokens=2048,
     )
+
+def create_agent_graph(llm: Optional[ChatVertexAI] = None, context_cache: Optional[PromptContextCache] = None):
+    """
+    Constructs the ReAct Agent Graph using LangGraph.
+    An already-warmed `llm` may be passed in so its channel is reused;
+    `context_cache` (started by warmup_agent) replaces the plain prompt when available.
+    """
+    
+    # 1. Initialize LLM with Tools
+    if llm is None:
+        llm = create_agent_llm()
     
     tools = ALL_TOOLS
-    llm_with_tools = llm.bind_tools(tools)
+    agent_runnable = context_cache or (AGENT_PROMPT | llm.bind_tools(tools))
     
     # 2. Define Nodes
     
@@ -63,32 +212,12 @@ def create_agent_graph():
         messages = state["messages"]
         
         # System Prompt Injection
-        # We perform a check to ensure System Prompt is at the start or context is appropriately set
-        # For a simple ReAct loop, we can prepend instructions if not present, 
-        # but here we assume the initial message setup handles it or we do it here.
-        
-        system_prompt = (
-            "你是一个决策型 AI (SentinEL Agent)。"
-            "你的目标是为用户制定最佳挽留策略。"
-            "必须遵循以下决策逻辑："
-            "1. 首先调用 lookup_user_profile 获取用户画像和最近行为。"
-            "2. 然后调用 predict_churn_risk 获取流失概率。"
-            "3. 评估风险：如果风险高（Risk Level = High 或 Score > 0.7），必须寻找挽留策略。"
-            "4. 调用 find_retention_strategies 获取候选策略。"
-            "5. 对成本最高的策略，务必调用 check_budget_availability 确认预算。"
-            "6. 如果预算不足或风险较低，仅建议发送关怀邮件或低成本策略。"
-            "7. 每一步都要解释原因 (Thought)。"
-            "8. 最终给出一个总结性的建议。"
-        )
-        
-        # Ensure system prompt is considered. 
-        # In strictly chat models, specific logic applies, but prepending a SystemMessage is standard.
-        from langchain_core.messages import SystemMessage
-        if not isinstance(messages[0], SystemMessage):
-             messages = [SystemMessage(content=system_prompt)] + messages
+        # History is passed through the placeholder only; the system prefix never shifts.
+        if messages and isinstance(messages[0], SystemMessage):
+            messages = messages[1:]
              
         try:
-            response = llm_with_tools.invoke(messages)
+            response = agent_runnable.invoke({"history": messages})
             return {"messages": [response]}
         except Exception as e:
             logger.error(f"LLM invoke failed: {e}", exc_info=True)
@@ -148,66 +277,167 @@ def create_agent_graph():
 # Invocation & Log Parsing
 # ==============================================================================
 
-# Singleton Graph
-_agent_graph = create_agent_graph()
-
-async def invoke_agent(user_id: str) -> Dict[str, Any]:
+def _iter_trace(messages: List[BaseMessage], step: int = 1):
     """
-    Invokes the agent and returns the final result + trace log.
+    Walks the given messages once and yields TraceStep dicts in order,
+    numbering steps from `step`.
     """
-    logger.info(f"Agent invoked for user_id={user_id}")
-    
-    inputs = {
-        "messages": [HumanMessage(content=f"请分析用户 {user_id} 的状态并制定挽留计划。")],
-        "user_id": user_id
-    }
-    
-    # Run the graph
-    final_state = await _agent_graph.ainvoke(inputs)
-    
-    # Parse Trace Logs from Messages
-    messages = final_state["messages"]
-    trace_log: List[TraceStep] = []
-    step_counter = 1
-    
     for msg in messages:
         if isinstance(msg, AIMessage):
             # Thought: Content present
             if msg.content:
-                trace_log.append({
-                    "step": step_counter,
+                yield {
+                    "step": step,
                     "type": "thought",
                     "content": str(msg.content),
                     "tool": None,
                     "input": None
-                })
-                step_counter += 1
+                }
+                step += 1
             
             # Action: Tool Calls present
-            if msg.tool_calls:
-                for tool_call in msg.tool_calls:
-                    trace_log.append({
-                        "step": step_counter,
-                        "type": "action",
-                        "content": f"调用工具: {tool_call['name']}",
-                        "tool": tool_call['name'],
-                        "input": json.dumps(tool_call['args'], ensure_ascii=False)
-                    })
-                    step_counter += 1
+            for tool_call in msg.tool_calls or ():
+                yield {
+                    "step": step,
+                    "type": "action",
+                    "content": f"调用工具: {tool_call['name']}",
+                    "tool": tool_call['name'],
+                    "input": orjson.dumps(tool_call['args']).decode()
+                }
+                step += 1
                     
         elif isinstance(msg, ToolMessage):
             # Observation: Tool Output
-            trace_log.append({
-                "step": step_counter,
+            yield {
+                "step": step,
                 "type": "observation",
                 "content": str(msg.content), # Content is usually the tool output string
                 "tool": msg.name,
                 "input": None
-            })
-            step_counter += 1
-            
+            }
+            step += 1
+
+# Singleton Graph (built by warmup_agent at startup, or lazily on first use)
+_agent_graph = None
+
+def get_agent_graph():
+    global _agent_graph
+    if _agent_graph is None:
+        _agent_graph = create_agent_graph()
+    return _agent_graph
+
+async def warmup_agent():
+    """
+    Builds the agent graph and sends a 1-token probe through its LLM so the
+    Vertex channel and auth token are established before the first real request.
+    The Gemini context cache is created here (if the prompt is large enough), never per request.
+    """
+    global _agent_graph
+    llm = create_agent_llm()
+    try:
+        await llm.ainvoke([HumanMessage(content="ping")], max_output_tokens=1)
+        logger.info("Agent LLM channel warmed up.")
+    except Exception as e:
+        logger.warning(f"Agent LLM warmup probe failed: {e}")
+    
+    context_cache = PromptContextCache(ALL_TOOLS, fallback=AGENT_PROMPT | llm.bind_tools(ALL_TOOLS))
+    if not await context_cache.start(llm):
+        context_cache = None
+    _agent_graph = create_agent_graph(llm, context_cache)
+    return _agent_graph
+
+# 低于此分数的用户直接返回模板化结论，不进入 LLM ReAct 循环
+LOW_RISK_FAST_PATH_THRESHOLD = 0.3
+
+LOW_RISK_FINAL_TEMPLATE = (
+    "用户 {user_id} 流失风险较低 (Risk Level = {risk_level}, Score = {risk_score:.2f})。"
+    "无需启动挽留策略，建议仅发送常规关怀邮件并持续观察。"
+)
+
+async def _prefetch_messages(user_id: str) -> List[BaseMessage]:
+    """
+    Runs the first two mandatory tool calls (lookup_user_profile -> predict_churn_risk)
+    without the LLM and returns them as an AIMessage(tool_calls) + ToolMessage sequence,
+    exactly as the ReAct loop would have produced them.
+    """
+    profile = await lookup_user_profile.ainvoke({"user_id": user_id})
+    risk_args = {"user_id": user_id, "events": list(profile["recent_events"])}
+    risk = await predict_churn_risk.ainvoke(risk_args)
+
+    messages: List[BaseMessage] = []
+    for name, args, output in (
+        ("lookup_user_profile", {"user_id": user_id}, profile),
+        ("predict_churn_risk", risk_args, risk),
+    ):
+        call_id = f"prefetch_{name}"
+        messages.append(AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": call_id}]))
+        messages.append(ToolMessage(content=orjson.dumps(output).decode(), tool_call_id=call_id, name=name))
+    return messages
+
+async def stream_agent(user_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Runs the agent and yields events as each graph node finishes:
+    {"event": "trace", "data": TraceStep} per step, then {"event": "final", "data": str}.
+
+    Profile lookup and churn prediction are executed up front. Low-risk users get a
+    templated answer without any LLM call; otherwise the results are seeded into the
+    conversation so the agent starts from step 3 of the decision logic.
+    """
+    logger.info(f"Agent invoked for user_id={user_id}")
+    
+    messages: List[BaseMessage] = [HumanMessage(content=f"请分析用户 {user_id} 的状态并制定挽留计划。")]
+    next_step = 1
+    
+    try:
+        prefetched = await _prefetch_messages(user_id)
+    except Exception as e:
+        logger.warning(f"Agent prefetch failed for user_id={user_id}, falling back to full ReAct loop: {e}")
+        prefetched = []
+    
+    for trace_step in _iter_trace(prefetched, next_step):
+        next_step = trace_step["step"] + 1
+        yield {"event": "trace", "data": trace_step}
+    messages.extend(prefetched)
+    
+    if prefetched:
+        risk = orjson.loads(prefetched[-1].content)
+        if "error" not in risk and risk["risk_score"] < LOW_RISK_FAST_PATH_THRESHOLD:
+            logger.info(f"Low-risk fast path for user_id={user_id} (score={risk['risk_score']:.2f})")
+            yield {"event": "final", "data": LOW_RISK_FINAL_TEMPLATE.format(user_id=user_id, **risk)}
+            return
+    
+    inputs = {
+        "messages": messages,
+        "user_id": user_id
+    }
+    
+    # Stream per-node state updates instead of waiting for the whole ReAct loop
+    last_message = None
+    async for update in get_agent_graph().astream(inputs, stream_mode="updates"):
+        for node_output in update.values():
+            new_messages = (node_output or {}).get("messages") or []
+            for trace_step in _iter_trace(new_messages, next_step):
+                next_step = trace_step["step"] + 1
+                yield {"event": "trace", "data": trace_step}
+            if new_messages:
+                last_message = new_messages[-1]
+    
     # Final Result is the last message content
-    final_result = messages[-1].content if messages else "No reponse generated."
+    final_result = last_message.content if last_message else "No reponse generated."
+    yield {"event": "final", "data": final_result}
+
+async def invoke_agent(user_id: str) -> Dict[str, Any]:
+    """
+    Invokes the agent and returns the final result + trace log.
+    """
+    trace_log: List[TraceStep] = []
+    final_result = None
+    
+    async for event in stream_agent(user_id):
+        if event["event"] == "trace":
+            trace_log.append(event["data"])
+        else:
+            final_result = event["data"]
     
     return {
         "final_result": final_result,
@@ -1,4 +1,5 @@
 import logging
+import os
 import random
 from typing import Dict, Any, List
 
@@ -10,6 +11,15 @@ from app.services.recommendation_service import get_recommendation_service
 
 logger = logging.getLogger(__name__)
 
+# 工具专用随机数生成器 (设置 SENTINEL_RNG_SEED 可在压测时获得确定性结果)
+_RNG_SEED = os.getenv("SENTINEL_RNG_SEED")
+_RNG = random.Random(int(_RNG_SEED) if _RNG_SEED else None)
+
+# 服务实例在首次成功获取后绑定到模块级变量，工具热路径只做一次 None 判断。
+# 预测服务初始化失败时 getter 返回 None，此时不缓存，下次调用会重试。
+_PREDICTION_SERVICE = None
+_RECOMMENDATION_SERVICE = None
+
 # ==============================================================================
 # Input Schemas
 # ==============================================================================
@@ -28,78 +38,84 @@ class RetentionStrategiesInput(BaseModel):
 class BudgetCheckInput(BaseModel):
     strategy_cost: float = Field(description="The estimated cost of the retention strategy.")
 
+# ==============================================================================
+# Mock Profile Templates
+# ==============================================================================
+
+# 确定性 Mock: 根据 ID 尾号 (% 3) 选择用户类型
+# recent_events 使用 tuple，模板在所有调用间共享且不可变
+_PROFILE_TEMPLATES = (
+    # High Value User
+    {
+        "segment": "VIP",
+        "lifetime_value": 1200.50,
+        "membership_level": "Gold",
+        "last_active_days_ago": 2,
+        "recent_events": ("page_view", "view_item", "add_to_cart", "remove_from_cart", "page_view"),
+    },
+    # At Risk User
+    {
+        "segment": "At-Risk",
+        "lifetime_value": 450.00,
+        "membership_level": "Silver",
+        "last_active_days_ago": 15,
+        "recent_events": ("page_view", "check_policy", "view_returns", "page_view"),
+    },
+    # New/Low Value User
+    {
+        "segment": "New",
+        "lifetime_value": 0.00,
+        "membership_level": "Basic",
+        "last_active_days_ago": 0,
+        "recent_events": ("session_start", "page_view"),
+    },
+)
+
 # ==============================================================================
 # Tool Definitions
 # ==============================================================================
 
 @tool("lookup_user_profile", args_schema=UserProfileInput)
-def lookup_user_profile(user_id: str) -> Dict[str, Any]:
+async def lookup_user_profile(user_id: str) -> Dict[str, Any]:
     """
     Look up user profile data from the feature store (Mock implementation).
     Returns user demographics, recent activity summary, and membership status.
+    NOTE: This is an ASYNC tool.
     """
     logger.info(f"[Tool] lookup_user_profile called for user_id={user_id}")
     
     # Mock Data: 模拟不同用户的 Feature
     # 实际项目中应调用 FeatureStoreService
-    
-    # 确定性 Mock: 根据 ID 尾号决定用户类型
-    last_digit = int(user_id[-1]) if user_id[-1].isdigit() else 0
-    
-    if last_digit % 3 == 0:
-        # High Value User
-        profile = {
-            "user_id": user_id,
-            "segment": "VIP",
-            "lifetime_value": 1200.50,
-            "membership_level": "Gold",
-            "last_active_days_ago": 2,
-            "recent_events": ["page_view", "view_item", "add_to_cart", "remove_from_cart", "page_view"]
-        }
-    elif last_digit % 3 == 1:
-        # At Risk User
-        profile = {
-            "user_id": user_id,
-            "segment": "At-Risk",
-            "lifetime_value": 450.00,
-            "membership_level": "Silver",
-            "last_active_days_ago": 15,
-            "recent_events": ["page_view", "check_policy", "view_returns", "page_view"]
-        }
-    else:
-        # New/Low Value User
-        profile = {
-            "user_id": user_id,
-            "segment": "New",
-            "lifetime_value": 0.00,
-            "membership_level": "Basic",
-            "last_active_days_ago": 0,
-            "recent_events": ["session_start", "page_view"]
-        }
+    last = user_id[-1:] or "0"
+    idx = (ord(last) - 48) % 3 if "0" <= last <= "9" else 0
+    profile = {**_PROFILE_TEMPLATES[idx], "user_id": user_id}
         
     logger.info(f"[Tool] lookup_user_profile result: {profile}")
     return profile
 
 
 @tool("predict_churn_risk", args_schema=ChurnRiskInput)
-def predict_churn_risk(user_id: str, events: List[str]) -> Dict[str, Any]:
+async def predict_churn_risk(user_id: str, events: List[str]) -> Dict[str, Any]:
     """
     Predict the churn probability for a user based on their recent event sequence.
     Uses the Vertex AI Churn Prediction Endpoint.
+    NOTE: This is an ASYNC tool.
     """
     logger.info(f"[Tool] predict_churn_risk called for user_id={user_id}, events_len={len(events)}")
     
-    service = get_prediction_service()
+    global _PREDICTION_SERVICE
+    if _PREDICTION_SERVICE is None:
+        _PREDICTION_SERVICE = get_prediction_service()
+    service = _PREDICTION_SERVICE
     if not service:
         # Fallback if service not init
         return {"risk_score": 0.5, "risk_level": "Medium", "error": "Service Unavailable"}
 
-    # 同步调用 (LangChain Tools 默认是同步的，若需异步可使用 acheck_budget_availability 等 async compat)
-    # 由于底层 predict_churn 是同步网络调用，这里会阻塞。
-    # 生产环境建议使用 async tool 结合 LangGraph 的 async 执行。
+    # 异步调用: 底层同步网络请求在 PredictionService 线程池中执行，不阻塞事件循环。
+    # 当 LLM 在同一步发出多个 tool_calls 时，ToolNode 会并发 await 这些协程。
     
     try:
-        score = service.predict_churn(user_id, events)
+        score = await service.predict_churn_async(user_id, events)
         level = service.get_risk_level(score)
         
         result = {
@@ -123,7 +139,10 @@ async def find_retention_strategies(user_id: str, risk_score: float) -> List[Dic
     """
     logger.info(f"[Tool] find_retention_strategies called for user_id={user_id}, risk={risk_score}")
     
-    service = get_recommendation_service()
+    global _RECOMMENDATION_SERVICE
+    if _RECOMMENDATION_SERVICE is None:
+        _RECOMMENDATION_SERVICE = get_recommendation_service()
+    service = _RECOMMENDATION_SERVICE
     if not service:
         return []
         
@@ -153,8 +172,7 @@ def check_budget_availability(strategy_cost: float) -> Dict[str, Any]:
         reason = "Cost is within auto-approval limit."
     else:
         # 30% chance of approval for high cost
-        import random
-        approved = random.random() > 0.7
+        approved = _RNG.random() > 0.7
         reason = "Budget allocation check." if approved else "Cost exceeds current allocation limit."
         
     return {
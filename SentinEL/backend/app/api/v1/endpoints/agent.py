@@ -1,8 +1,14 @@
-from typing import Any, Dict, List, Optional
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+
+from app.agents.sentinel_agent import invoke_agent, stream_agent
 
-from app.agents.sentinel_agent import invoke_agent
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -10,10 +16,17 @@ router = APIRouter()
 # Models
 # ==============================================================================
 
+# 请求/轨迹模型只读: extra="ignore" 跳过未知字段检查, frozen 使实例可哈希
+_FROZEN = ConfigDict(extra="ignore", frozen=True)
+
 class AnalyzeFlowRequest(BaseModel):
+    model_config = _FROZEN
+
     user_id: str = Field(..., description="The ID of the user to analyze.")
 
 class TraceStepModel(BaseModel):
+    model_config = _FROZEN
+
     step: int
     type: str # "thought", "action", "observation"
     content: str
@@ -21,8 +34,10 @@ class TraceStepModel(BaseModel):
     input: Optional[str] = None
 
 class AnalyzeFlowResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     final_result: str
-    trace_log: List[TraceStepModel]
+    trace_log: Tuple[TraceStepModel, ...]
 
 # ==============================================================================
 # Endpoints
@@ -39,3 +54,21 @@ async def analyze_user_flow(request: AnalyzeFlowRequest) -> Any:
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent execution failed: {str(e)}")
+
+
+@router.post("/analyze_flow/stream")
+async def analyze_user_flow_stream(request: AnalyzeFlowRequest) -> StreamingResponse:
+    """
+    Streaming variant of /analyze_flow.
+    Emits each reasoning step as a Server-Sent Event as soon as it is produced,
+    followed by a final event carrying the recommendation.
+    """
+    async def generate():
+        try:
+            async for event in stream_agent(request.user_id):
+                yield b"event: " + event["event"].encode() + b"\ndata: " + orjson.dumps(event["data"]) + b"\n\n"
+        except Exception as e:
+            logger.error(f"Agent stream failed for {request.user_id}: {e}")
+            yield b"event: error\ndata: " + orjson.dumps(f"Agent execution failed: {str(e)}") + b"\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
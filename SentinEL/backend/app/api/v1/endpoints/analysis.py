@@ -7,9 +7,11 @@ SentinEL 分析 API 端点
 import json
 import base64
 import logging
+from functools import lru_cache
 from typing import Optional
 from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends, Request
 from pydantic import BaseModel
+from app.core.concurrency import run_in_threadpool
 from app.models.schemas import UserAnalysisRequest, UserAnalysisResponse, FeedbackRequest
 from app.services.orchestrator import get_orchestrator
 from app.services.storage_service import get_storage_service
@@ -23,6 +25,16 @@ router = APIRouter(dependencies=[Depends(verify_api_key)])
 # storage_service initialized lazily
 
 
+@lru_cache(maxsize=1)
+def _db():
+    """
+    进程级 Firestore 异步客户端 (懒加载)
+    复用 gRPC 通道与认证令牌，避免每次请求重新握手
+    """
+    from google.cloud import firestore
+    return firestore.AsyncClient()
+
+
 # ==============================================================================
 # 异步分析响应模型
 # ==============================================================================
@@ -37,7 +49,7 @@ class AsyncAnalysisResponse(BaseModel):
 # 面向前端的端点
 # ==============================================================================
 @router.post("/analyze", response_model=AsyncAnalysisResponse, status_code=202)
-def analyze_user_endpoint(request: UserAnalysisRequest):
+async def analyze_user_endpoint(request: UserAnalysisRequest):
     """
     **异步分析用户流失风险并生成干预策略**
     
@@ -59,7 +71,9 @@ def analyze_user_endpoint(request: UserAnalysisRequest):
         analysis_id = storage_service.generate_id()
         
         # 2. 创建初始 Firestore 记录 (QUEUED)
-        storage_service.create_queued_analysis(
+        # 同步 Firestore 写入放到线程池，避免阻塞事件循环
+        await run_in_threadpool(
+            storage_service.create_queued_analysis,
             user_id=request.user_id,
             analysis_id=analysis_id
         )
@@ -71,7 +85,7 @@ def analyze_user_endpoint(request: UserAnalysisRequest):
              # Consider raising error or fallback
              raise HTTPException(status_code=500, detail="Messaging service unavailable")
 
-        queue_service.publish_analysis_event(
+        await queue_service.publish_analysis_event_async(
             user_id=request.user_id,
             analysis_id=analysis_id,
             image_data=request.image_data
@@ -93,7 +107,7 @@ def analyze_user_endpoint(request: UserAnalysisRequest):
 
 
 @router.get("/analyze/{analysis_id}")
-def get_analysis_status(analysis_id: str):
+async def get_analysis_status(analysis_id: str):
     """
     **获取分析任务状态和结果**
     
@@ -103,11 +117,10 @@ def get_analysis_status(analysis_id: str):
         dict: 包含 status 和完整分析结果 (当 status=COMPLETED 时)
     """
     try:
-        from google.cloud import firestore
-        db = firestore.Client()
+        db = _db()
         
         doc_ref = db.collection("analysis_logs").document(analysis_id)
-        doc = doc_ref.get()
+        doc = await doc_ref.get()
         
         if not doc.exists:
             raise HTTPException(status_code=404, detail=f"Analysis {analysis_id} not found")
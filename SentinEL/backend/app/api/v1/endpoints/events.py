@@ -3,10 +3,12 @@ SentinEL 内部事件处理端点
 用于接收 Pub/Sub Push 回调 (无 API Key 验证，由 Cloud Run IAM 保护)
 """
 
-import json
 import base64
+import asyncio
 import logging
+import orjson
 from fastapi import APIRouter, HTTPException, Request
+from app.core.concurrency import run_in_threadpool
 from app.services.orchestrator import get_orchestrator
 from app.services.storage_service import get_storage_service
 
@@ -57,7 +59,8 @@ async def process_pubsub_event(request: Request):
             logger.warning("[EventsProcess] Empty message data")
             return {"status": "error", "message": "Empty message data"}
         
-        message_data = json.loads(base64.b64decode(message_data_b64).decode("utf-8"))
+        # orjson 直接解析 bytes，省去中间的 UTF-8 str 解码
+        message_data = orjson.loads(base64.b64decode(message_data_b64))
         
         user_id = message_data.get("user_id")
         analysis_id = message_data.get("analysis_id")
@@ -69,35 +72,41 @@ async def process_pubsub_event(request: Request):
         
         logger.info(f"[EventsProcess] Processing analysis {analysis_id} for user {user_id}")
         
-        # 3. 更新状态为 PROCESSING
+        # 3. 不再单独写入 PROCESSING 状态: 记录保持 QUEUED 直到写入终态，
+        #    每个任务只需一次 Firestore 写入 (前端轮询对 QUEUED/PROCESSING 处理一致)
         storage_service = get_storage_service()
-        if storage_service:
-            storage_service.update_status(analysis_id, "PROCESSING")
         
         # 4. 执行 AI 分析工作流
         try:
             orchestrator = get_orchestrator()
-            result = orchestrator.analyze_user_workflow(
+            result = await orchestrator.analyze_user_workflow(
                 user_id=user_id,
                 analysis_id=analysis_id,
                 image_data=image_data,
                 is_async_worker=True  # 标记为异步 Worker 模式
             )
             
-            # 5. 更新状态为 COMPLETED，并保存结果 (包含 A/B 实验字段和策略)
-            # 5. 更新状态为 COMPLETED，并保存结果 (包含 A/B 实验字段和策略)
-            if storage_service:
-                storage_service.update_status(
-                    analysis_id,
-                    "COMPLETED",
-                    risk_level=result.get("risk_level"),
-                    churn_probability=result.get("churn_probability"),
-                    retention_policies=result.get("retention_policies", []),
-                    generated_email=result.get("generated_email"),
-                    call_script=result.get("call_script"),
-                    processing_time_ms=result.get("processing_time_ms"),
-                    experiment_group=result.get("experiment_group"),
-                    model_used=result.get("model_used")
+            # 5. 更新状态为 COMPLETED，并保存结果 (包含 A/B 实验字段和策略)；
+            #    AI 审计与终态写入并行执行 (两者互不依赖)。
+            #    审计任务无论存储是否可用都要取走，否则会一直留在编排器的 _audit_tasks 中
+            if not storage_service:
+                await orchestrator.audit_workflow_result(result)
+            else:
+                await asyncio.gather(
+                    run_in_threadpool(
+                        storage_service.update_status,
+                        analysis_id,
+                        "COMPLETED",
+                        risk_level=result.get("risk_level"),
+                        churn_probability=result.get("churn_probability"),
+                        retention_policies=result.get("retention_policies", []),
+                        generated_email=result.get("generated_email"),
+                        call_script=result.get("call_script"),
+                        processing_time_ms=result.get("processing_time_ms"),
+                        experiment_group=result.get("experiment_group"),
+                        model_used=result.get("model_used")
+                    ),
+                    orchestrator.audit_workflow_result(result)
                 )
             
             logger.info(f"[EventsProcess] Analysis {analysis_id} completed successfully")
@@ -1,45 +1,77 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends
-from app.services.data_factory_service import DataFactory
+from fastapi import APIRouter, HTTPException, Depends
+from app.workers.pipeline_worker import (
+    broker, PIPELINE_QUEUE, PIPELINE_LOCK_KEY, PIPELINE_LOCK_TTL_SECONDS,
+    set_job_status, get_job_status
+)
+from app.core.cache import redis_client
 from app.core.security import verify_api_key
+import asyncio
 import logging
 import uuid
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# Single instance of DataFactory
-try:
-    data_factory = DataFactory()
-except Exception as e:
-    logger.error(f"Failed to initialize DataFactory at module level: {e}")
-    data_factory = None
-
-async def run_pipeline_task(job_id: str):
-    logger.info(f"Job {job_id}: Starting Data Factory Pipeline Task...")
-    if data_factory:
-        try:
-            result = await data_factory.run_pipeline()
-            logger.info(f"Job {job_id}: Pipeline finished. Result: {result}")
-        except Exception as e:
-            logger.error(f"Job {job_id}: Pipeline failed: {e}")
-    else:
-        logger.error(f"Job {job_id}: DataFactory not initialized.")
+# In-flight enqueue tasks (strong refs so they aren't garbage-collected mid-flight)
+_DISPATCH_TASKS: set = set()
+
+async def _enqueue_pipeline_job(job_id: str):
+    try:
+        await set_job_status(job_id, "queued")
+        # 消息体为裸 job_id 字符串，与 run_pipeline_task(job_id: str) 的签名一致
+        await broker.publish(job_id, list=PIPELINE_QUEUE)
+    except Exception as e:
+        logger.error(f"Job {job_id}: Failed to enqueue pipeline task: {e}")
+        await set_job_status(job_id, "failed", error=f"Failed to enqueue: {e}")
+        await redis_client.release_lock(PIPELINE_LOCK_KEY, job_id)
+
+async def drain_pending_dispatches():
+    """Waits for in-flight enqueue tasks (called on shutdown so Cloud Run drains cleanly)."""
+    if _DISPATCH_TASKS:
+        await asyncio.gather(*_DISPATCH_TASKS, return_exceptions=True)
 
 @router.post("/run_data_pipeline", dependencies=[Depends(verify_api_key)])
-async def trigger_data_pipeline(background_tasks: BackgroundTasks):
+async def trigger_data_pipeline():
     """
     Triggers the Data Factory pipeline to fetch low-quality logs,
     synthesize better data using Gemini, and export to BigQuery.
+
+    The job is queued on Redis and executed by the pipeline worker process.
+    Only one pipeline runs at a time; repeated triggers return the running job_id.
     """
-    if not data_factory:
-        raise HTTPException(status_code=503, detail="Data Factory Service unavailable")
+    if not redis_client.is_available:
+        raise HTTPException(status_code=503, detail="Pipeline queue unavailable")
 
     job_id = str(uuid.uuid4())
-    
-    background_tasks.add_task(run_pipeline_task, job_id)
-    
+
+    if not await redis_client.acquire_lock(PIPELINE_LOCK_KEY, job_id, PIPELINE_LOCK_TTL_SECONDS):
+        return {
+            "status": "already_running",
+            "job_id": await redis_client.get_lock_owner(PIPELINE_LOCK_KEY),
+            "message": "A Data Factory pipeline is already in progress."
+        }
+
+    # Fire-and-forget: the lock already reserves the job, so respond without
+    # waiting on the status write + publish round-trips
+    task = asyncio.create_task(_enqueue_pipeline_job(job_id))
+    _DISPATCH_TASKS.add(task)
+    task.add_done_callback(_DISPATCH_TASKS.discard)
+
     return {
         "status": "Pipeline started",
         "job_id": job_id,
         "message": "Data Factory is refining low-quality samples in the background."
     }
+
+@router.get("/jobs/{job_id}", dependencies=[Depends(verify_api_key)])
+async def get_pipeline_job(job_id: str):
+    """
+    Returns the status of a queued Data Factory job.
+    """
+    status = await get_job_status(job_id)
+    if status is None:
+        # Lock taken but enqueue task hasn't written the status yet
+        if await redis_client.get_lock_owner(PIPELINE_LOCK_KEY) == job_id:
+            return {"job_id": job_id, "status": "queued"}
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job_id, **status}
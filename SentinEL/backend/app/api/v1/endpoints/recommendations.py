@@ -3,17 +3,21 @@ SentinEL 推荐 API 端点
 提供个性化挽留策略推荐接口
 """
 
+import asyncio
 import logging
 from typing import List, Dict, Any
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 
-from app.services.recommendation_service import get_recommendation_service, RecommendationService
+from app.services.recommendation_service import get_recommendation_service, get_recommendation_batcher, RecommendationService
 from app.services.storage_service import get_storage_service
 from app.core.security import verify_api_key
+from app.core.concurrency import run_in_threadpool
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_RISK_SCORE = 0.5  # 冷启动默认值 (中等风险)
+
 router = APIRouter(dependencies=[Depends(verify_api_key)])
 
 
@@ -41,29 +45,31 @@ async def get_user_recommendations(
         raise HTTPException(status_code=503, detail="Recommendation service unavailable")
         
     # 1. 获取用户风险分数
-    # 这里我们尝试从最近的分析记录中获取，如果找不到，默认设为 0.5 (中等风险)
-    # 实际上应该有更完善的 User Profile Service
-    try:
-        profile = storage.get_user_profile(user_id)
-        if profile and "churn_probability" in profile:
-            risk_score = profile["churn_probability"]
-        else:
-            # 尝试查最近的分析记录
-            logs = storage.get_recent_analysis_logs(user_id, limit=1)
-            if logs:
-                risk_score = logs[0].get("churn_probability", 0.5)
-            else:
-                risk_score = 0.5 # 冷启动默认值
-                
-        logger.info(f"Getting recommendations for {user_id}, risk_score={risk_score}")
+    # 优先使用用户画像，其次使用最近的分析记录，都没有则默认 0.5 (中等风险)
+    # 两次查询相互独立，并发执行: 延迟从两者之和降为两者最大值
+    risk_score = DEFAULT_RISK_SCORE
+    if storage:
+        profile, logs = await asyncio.gather(
+            run_in_threadpool(storage.get_user_profile, user_id),
+            run_in_threadpool(storage.get_recent_analysis_logs, user_id, limit=1),
+            return_exceptions=True
+        )
+        if isinstance(profile, Exception):
+            logger.warning(f"Failed to fetch user profile: {profile}")
+        if isinstance(logs, Exception):
+            logger.warning(f"Failed to fetch recent analysis logs: {logs}")
         
-    except Exception as e:
-        logger.warning(f"Failed to fetch user profile, using default risk: {e}")
-        risk_score = 0.5
+        if isinstance(profile, dict) and "churn_probability" in profile:
+            risk_score = profile["churn_probability"]
+        elif isinstance(logs, list) and logs:
+            risk_score = logs[0].get("churn_probability", DEFAULT_RISK_SCORE)
+    
+    logger.info(f"Getting recommendations for {user_id}, risk_score={risk_score}")
 
     # 2. 获取推荐
     try:
-        strategies = await rec_service.get_recommendations(user_id, risk_score, top_k)
+        # 并发请求经微批处理器合并为一次批量向量检索
+        strategies = await get_recommendation_batcher().submit(user_id, risk_score, top_k)
         
         # 转换格式
         response = []
@@ -4,65 +4,195 @@ SentinEL 缓存模块
 """
 
 import os
-import json
+import socket
 import time
+import asyncio
+import hashlib
+import inspect
 import logging
 import functools
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, Union
+
+import orjson
+from cachetools import TTLCache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
 # Redis 连接配置
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Redis 与应用同机部署 (如 Cloud Run sidecar / 本地进程) 时可改用 Unix Domain Socket，
+# 绕过 TCP 回环协议栈。托管 Memorystore 不支持 UDS，默认仍走 TCP。
+REDIS_UDS_PATH = os.getenv("REDIS_UDS_PATH")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+REDIS_POOL_TIMEOUT = 2  # 连接池耗尽时最多等待 2 秒，而不是无限新建连接
 CACHE_KEY_PREFIX = "sentinel:analysis"
+CACHE_KEY_PREFIX_B = f"{CACHE_KEY_PREFIX}:".encode()
+
+# 缓存键直接使用 bytes: 客户端为二进制协议 (decode_responses=False)，驱动无需再编码
+KeyT = Union[str, bytes]
+
+
+def _analysis_cache_key(user_id: str) -> bytes:
+    return CACHE_KEY_PREFIX_B + user_id.encode()
+
+# 进程内 L1 缓存 (Redis 为 L2): 短时间内重复读取同一用户时免去 RTT 与反序列化
+# 仅在事件循环线程中访问，无需加锁
+L1_MAXSIZE = 1024
+L1_TTL_SECONDS = 60
+_L1: TTLCache = TTLCache(maxsize=L1_MAXSIZE, ttl=L1_TTL_SECONDS)
+
+# 进行中的分析 (single-flight): (缓存键, 图片摘要) -> Task，同一用户的并发未命中请求共用一次计算
+# 同样仅在事件循环线程中访问
+_INFLIGHT: dict = {}
+
+_ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+# 超过阈值的负载使用 zstd 压缩，并以版本字节标记
+# (未压缩的 JSON 以 '{' 开头、msgpack map 以 0x8x/0xde/0xdf 开头，均不会与其冲突)
+ZSTD_MIN_BYTES = 1024
+_CODEC_ZSTD = b"\x01"
+_zstd_c = zstandard.ZstdCompressor(level=3) if zstandard else None
+_zstd_d = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def _encode(value: dict) -> bytes:
+    """
+    序列化缓存值: 默认 orjson；含 bytes 等 JSON 无法表示的值时回退 msgpack
+    (二进制原样存储，不做 base64 膨胀)。大负载再经 zstd 压缩。
+    """
+    try:
+        data = orjson.dumps(value, option=_ORJSON_OPTS)
+    except TypeError:
+        if msgpack is None:
+            raise
+        data = msgpack.packb(value, use_bin_type=True)
+    if _zstd_c is not None and len(data) >= ZSTD_MIN_BYTES:
+        return _CODEC_ZSTD + _zstd_c.compress(data)
+    return data
 
 
+def _decode(data: bytes) -> dict:
+    """反序列化缓存值: 先按版本字节解压，JSON 对象以 '{' 开头，其余按 msgpack 解析"""
+    if data[:1] == _CODEC_ZSTD:
+        data = _zstd_d.decompress(data[1:])
+    if data[:1] == b"{":
+        return orjson.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+# 比较持有者后删除，避免误删已过期并被其他任务重新获取的锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
 class RedisClient:
     """
-    Redis 客户端单例
+    Redis 客户端单例 (redis.asyncio)
     支持连接失败时自动降级（Fallback）
+
+    所有读写均为协程，Redis 往返期间不阻塞 uvicorn 事件循环。
+    连接检测在 FastAPI startup 阶段通过 connect() 完成。
     """
     
-    _instance: Optional["RedisClient"] = None
     _client = None
+    _pool = None
     _available: bool = False
     
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._initialize()
-        return cls._instance
+    def __init__(self):
+        self._initialize()
     
     def _initialize(self):
-        """初始化 Redis 连接"""
+        """创建 Redis 异步客户端 (不建立连接，连接在 connect() 中检测)；重复调用无副作用"""
+        if self._client is not None:
+            return
+        
         try:
-            import redis
-            self._client = redis.Redis(
-                host=REDIS_HOST,
-                port=REDIS_PORT,
-                decode_responses=True,
+            import redis.asyncio as aioredis
+            
+            # 有界阻塞连接池: 并发超过上限时排队等待空闲连接，避免连接风暴和端口耗尽
+            pool_kwargs = dict(
+                max_connections=REDIS_MAX_CONNECTIONS,
+                timeout=REDIS_POOL_TIMEOUT,
+                decode_responses=False,  # 值为 orjson/msgpack bytes，由 _decode 负责解码
                 socket_timeout=5,
                 socket_connect_timeout=5,
                 retry_on_timeout=True
             )
-            # 测试连接
-            self._client.ping()
-            self._available = True
-            logger.info(f"[Cache] Redis 连接成功: {REDIS_HOST}:{REDIS_PORT}")
+            if REDIS_UDS_PATH:
+                self._pool = aioredis.BlockingConnectionPool(
+                    connection_class=aioredis.UnixDomainSocketConnection,
+                    path=REDIS_UDS_PATH,
+                    **pool_kwargs
+                )
+            else:
+                keepalive_options = {}
+                if hasattr(socket, "TCP_KEEPIDLE"):  # Linux only
+                    keepalive_options[socket.TCP_KEEPIDLE] = 30
+                self._pool = aioredis.BlockingConnectionPool(
+                    host=REDIS_HOST,
+                    port=REDIS_PORT,
+                    socket_keepalive=True,
+                    socket_keepalive_options=keepalive_options,
+                    **pool_kwargs
+                )
+            self._client = aioredis.Redis(connection_pool=self._pool)
         except ImportError:
             logger.warning("[Cache] redis 包未安装，缓存功能禁用")
-            self._available = False
+            self._client = None
+            self._pool = None
+        self._available = False
+    
+    async def connect(self) -> bool:
+        """测试 Redis 连接 (在 FastAPI startup 中调用)"""
+        if self._client is None:
+            return False
+        
+        try:
+            await self._client.ping()
+            self._available = True
+            logger.info(f"[Cache] Redis 连接成功: {REDIS_UDS_PATH or f'{REDIS_HOST}:{REDIS_PORT}'}")
         except Exception as e:
             logger.warning(f"[Cache] Redis 连接失败，自动降级: {e}")
             self._available = False
+        return self._available
+    
+    async def close(self):
+        """断开连接池中的所有连接 (在 FastAPI shutdown 中调用)"""
+        if self._pool is not None:
+            await self._pool.disconnect()
+            self._available = False
+    
+    def pool_stats(self) -> dict:
+        """连接池状态 (用于 /health)"""
+        if self._pool is None:
+            return {"available": False}
+        return {
+            "available": self._available,
+            "max_connections": self._pool.max_connections,
+            "in_use": len(getattr(self._pool, "_in_use_connections", ())),
+            "idle": sum(1 for c in getattr(self._pool, "_available_connections", ()) if c is not None),
+        }
     
     @property
     def is_available(self) -> bool:
         """检查 Redis 是否可用"""
         return self._available
     
-    def get(self, key: str) -> Optional[dict]:
+    async def get(self, key: KeyT) -> Optional[dict]:
         """
         获取缓存数据
         
@@ -76,15 +206,43 @@ class RedisClient:
             return None
         
         try:
-            data = self._client.get(key)
+            data = await self._client.get(key)
             if data:
-                return json.loads(data)
+                return _decode(data)
             return None
         except Exception as e:
             logger.warning(f"[Cache] 读取缓存失败: {e}")
             return None
     
-    def set(self, key: str, value: dict, ttl_seconds: int = 3600) -> bool:
+    async def get_and_touch(self, key: KeyT, ttl_seconds: int) -> Optional[dict]:
+        """
+        获取缓存数据并刷新 TTL (滑动过期)
+        
+        GET 与 EXPIRE 通过 pipeline 在一次网络往返内完成；键不存在时 EXPIRE 为空操作。
+        
+        Args:
+            key: 缓存键
+            ttl_seconds: 命中后重新设置的过期时间（秒）
+        
+        Returns:
+            缓存的字典数据，或 None（不存在/连接失败）
+        """
+        if not self._available:
+            return None
+        
+        try:
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.expire(key, ttl_seconds)
+                data, _ = await pipe.execute()
+            if data:
+                return _decode(data)
+            return None
+        except Exception as e:
+            logger.warning(f"[Cache] 读取缓存失败: {e}")
+            return None
+    
+    async def set(self, key: KeyT, value: dict, ttl_seconds: int = 3600) -> bool:
         """
         设置缓存数据
         
@@ -100,10 +258,10 @@ class RedisClient:
             return False
         
         try:
-            self._client.setex(
+            await self._client.setex(
                 name=key,
                 time=ttl_seconds,
-                value=json.dumps(value, ensure_ascii=False)
+                value=_encode(value)
             )
             logger.info(f"[Cache] 缓存已设置: {key} (TTL: {ttl_seconds}s)")
             return True
@@ -111,24 +269,104 @@ class RedisClient:
             logger.warning(f"[Cache] 设置缓存失败: {e}")
             return False
     
-    def delete(self, key: str) -> bool:
+    async def delete(self, key: KeyT) -> bool:
         """删除缓存"""
         if not self._available:
             return False
         
         try:
-            self._client.delete(key)
+            await self._client.delete(key)
             return True
         except Exception as e:
             logger.warning(f"[Cache] 删除缓存失败: {e}")
             return False
+    
+    async def hset(self, key: str, mapping: dict, ttl_seconds: Optional[int] = None) -> bool:
+        """
+        写入 Hash 字段 (用于任务状态等小型结构化数据)
+        
+        Args:
+            key: 键
+            mapping: 字段 -> 值 (值会被转换为字符串)
+            ttl_seconds: 可选的过期时间（秒）
+        
+        Returns:
+            是否设置成功
+        """
+        if not self._available:
+            return False
+        
+        try:
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.hset(key, mapping={k: str(v) for k, v in mapping.items()})
+                if ttl_seconds:
+                    pipe.expire(key, ttl_seconds)
+                await pipe.execute()
+            return True
+        except Exception as e:
+            logger.warning(f"[Cache] 写入 Hash 失败: {e}")
+            return False
+    
+    async def hgetall(self, key: str) -> Optional[dict]:
+        """读取 Hash 全部字段，不存在或连接失败时返回 None"""
+        if not self._available:
+            return None
+        
+        try:
+            data = await self._client.hgetall(key)
+            if not data:
+                return None
+            return {k.decode(): v.decode() for k, v in data.items()}
+        except Exception as e:
+            logger.warning(f"[Cache] 读取 Hash 失败: {e}")
+            return None
+
+    
+    async def acquire_lock(self, key: str, owner: str, ttl_seconds: int) -> bool:
+        """
+        获取分布式锁 (SET key owner NX EX ttl)
+        
+        Returns:
+            是否获取成功；Redis 不可用时返回 False
+        """
+        if not self._available:
+            return False
+        
+        try:
+            return bool(await self._client.set(key, owner, nx=True, ex=ttl_seconds))
+        except Exception as e:
+            logger.warning(f"[Cache] 获取锁失败: {e}")
+            return False
+    
+    async def get_lock_owner(self, key: str) -> Optional[str]:
+        """读取锁的持有者，未加锁时返回 None"""
+        if not self._available:
+            return None
+        
+        try:
+            owner = await self._client.get(key)
+            return owner.decode() if owner else None
+        except Exception as e:
+            logger.warning(f"[Cache] 读取锁失败: {e}")
+            return None
+    
+    async def release_lock(self, key: str, owner: str) -> bool:
+        """仅当锁仍由 owner 持有时释放 (Lua 脚本保证比较与删除的原子性)"""
+        if not self._available:
+            return False
+        
+        try:
+            return bool(await self._client.eval(_RELEASE_LOCK_SCRIPT, 1, key, owner))
+        except Exception as e:
+            logger.warning(f"[Cache] 释放锁失败: {e}")
+            return False
 
 
-# 全局单例
+# 全局单例 (模块导入时创建一次，请直接使用 redis_client 而不是再实例化 RedisClient)
 redis_client = RedisClient()
 
 
-def cached_analysis(ttl_seconds: int = 3600):
+def cached_analysis(ttl_seconds: int = 3600, sliding: bool = True):
     """
     分析结果缓存装饰器
     
@@ -136,19 +374,27 @@ def cached_analysis(ttl_seconds: int = 3600):
     - Cache Hit: 直接返回缓存数据，注入 data_source="CACHE"
     - Cache Miss: 执行原逻辑，缓存结果，注入 data_source="REALTIME"
     
+    包装后的函数是协程，调用方需要 await。被装饰的函数若为同步函数，
+    则放到线程池中执行，避免阻塞事件循环。
+    
     Args:
         ttl_seconds: 缓存过期时间（秒），默认 1 小时
+        sliding: 命中时是否刷新 TTL (热点用户持续保留)；False 则为绝对过期
     
     Usage:
         @cached_analysis(ttl_seconds=3600)
         def analyze_user_workflow(self, user_id: str, ...):
             ...
+        
+        result = await orchestrator.analyze_user_workflow(user_id)
     """
     def decorator(func: Callable) -> Callable:
+        is_coroutine = inspect.iscoroutinefunction(func)
+        
         @functools.wraps(func)
-        def wrapper(self, user_id: str, *args, **kwargs) -> dict:
+        async def wrapper(self, user_id: str, *args, **kwargs) -> dict:
             # 构建缓存键
-            cache_key = f"{CACHE_KEY_PREFIX}:{user_id}"
+            cache_key = _analysis_cache_key(user_id)
             
             # 异步 Worker 模式不使用缓存（因为已经进入队列）
             is_async_worker = kwargs.get("is_async_worker", False)
@@ -156,10 +402,22 @@ def cached_analysis(ttl_seconds: int = 3600):
             if not is_async_worker:
                 # 尝试从缓存获取
                 start_time = time.time()
-                cached_result = redis_client.get(cache_key)
+                l1_result = _L1.get(cache_key)
+                if l1_result is not None:
+                    # L1 Hit: 返回浅拷贝，避免注入字段污染 L1 中的对象
+                    cached_result = dict(l1_result)
+                    cached_result["data_source"] = "CACHE"
+                    cached_result["cache_lookup_ms"] = int((time.time() - start_time) * 1000)
+                    return cached_result
+                
+                if sliding:
+                    cached_result = await redis_client.get_and_touch(cache_key, ttl_seconds)
+                else:
+                    cached_result = await redis_client.get(cache_key)
                 
                 if cached_result:
-                    # Cache Hit
+                    # Cache Hit (L2)
+                    _L1[cache_key] = dict(cached_result)
                     cache_time_ms = int((time.time() - start_time) * 1000)
                     cached_result["data_source"] = "CACHE"
                     cached_result["cache_lookup_ms"] = cache_time_ms
@@ -167,17 +425,46 @@ def cached_analysis(ttl_seconds: int = 3600):
                     return cached_result
             
             # Cache Miss - 执行原逻辑
-            result = func(self, user_id, *args, **kwargs)
+            if is_async_worker:
+                # 每条队列消息对应独立的 analysis_id，不参与合并
+                return await _run(self, user_id, *args, **kwargs)
+            
+            # 同一 (用户, 图片) 已在计算中时等待同一结果，而不是重复调用 BigQuery / Gemini
+            image_data = kwargs.get("image_data", args[1] if len(args) > 1 else None)
+            image_digest = hashlib.blake2b((image_data or "").encode(), digest_size=8).digest()
+            flight_key = (cache_key, image_digest)
+            task = _INFLIGHT.get(flight_key)
+            if task is None:
+                task = asyncio.create_task(_run(self, user_id, *args, **kwargs))
+                _INFLIGHT[flight_key] = task
+                task.add_done_callback(lambda _: _INFLIGHT.pop(flight_key, None))
+                return await asyncio.shield(task)
+            logger.info(f"[Cache] Joining in-flight analysis for user {user_id}")
+            # 浅拷贝: 各调用方持有独立的顶层字典
+            return dict(await asyncio.shield(task))
+        
+        async def _run(self, user_id: str, *args, **kwargs) -> dict:
+            cache_key = _analysis_cache_key(user_id)
+            is_async_worker = kwargs.get("is_async_worker", False)
+            if is_coroutine:
+                result = await func(self, user_id, *args, **kwargs)
+            else:
+                result = await asyncio.to_thread(func, self, user_id, *args, **kwargs)
             
             # 标记数据来源
             result["data_source"] = "REALTIME"
             
             # 缓存结果（仅非异步模式）
             if not is_async_worker:
-                # 创建缓存副本（移除不需要缓存的字段）
-                cache_data = result.copy()
-                cache_data.pop("generated_audio", None)  # 音频数据太大，不缓存
-                redis_client.set(cache_key, cache_data, ttl_seconds)
+                # 音频数据太大，不缓存: 确有音频时构建不含它的子集，否则直接浅拷贝
+                # (工作流总会带上 generated_audio 键，低风险/无邮件时为 None；
+                #  L1 持有独立副本，调用方之后修改 result 不会影响缓存条目)
+                if result.get("generated_audio") is not None:
+                    cache_data = {k: v for k, v in result.items() if k != "generated_audio"}
+                else:
+                    cache_data = dict(result)
+                _L1[cache_key] = cache_data
+                await redis_client.set(cache_key, cache_data, ttl_seconds)
             
             return result
         
@@ -185,7 +472,7 @@ def cached_analysis(ttl_seconds: int = 3600):
     return decorator
 
 
-def invalidate_user_cache(user_id: str) -> bool:
+async def invalidate_user_cache(user_id: str) -> bool:
     """
     使用户缓存失效（用于数据更新后）
     
@@ -195,5 +482,6 @@ def invalidate_user_cache(user_id: str) -> bool:
     Returns:
         是否成功
     """
-    cache_key = f"{CACHE_KEY_PREFIX}:{user_id}"
-    return redis_client.delete(cache_key)
+    cache_key = _analysis_cache_key(user_id)
+    _L1.pop(cache_key, None)
+    return await redis_client.delete(cache_key)
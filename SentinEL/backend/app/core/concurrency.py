@@ -0,0 +1,38 @@
+"""
+SentinEL 并发工具模块
+为 async 端点中的同步阻塞 I/O (Firestore / BigQuery 等 SDK) 提供统一的线程池入口
+"""
+
+import os
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# 专用的有界 I/O 线程池: 与默认 executor 隔离，并发上限可控
+IO_POOL_MAX_WORKERS = int(os.getenv("IO_POOL_MAX_WORKERS", "32"))
+_IO_POOL = ThreadPoolExecutor(max_workers=IO_POOL_MAX_WORKERS, thread_name_prefix="sentinel-io")
+
+
+async def run_in_threadpool(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    在 I/O 线程池中执行同步函数，避免阻塞事件循环
+
+    与 asyncio.to_thread 相同，会复制当前 contextvars (OpenTelemetry span 上下文得以延续)。
+    仅用于短小的阻塞调用；长时间运行的整段工作流请使用 asyncio.to_thread，
+    避免占满线程池导致内部 I/O 排队。
+
+    Usage:
+        profile = await run_in_threadpool(storage.get_user_profile, user_id)
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(_IO_POOL, call)
+
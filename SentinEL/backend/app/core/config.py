@@ -11,6 +11,8 @@ class Settings(BaseSettings):
     # Defaulting to values found in existing code to ensure backward compatibility if env vars are missing
     PIPELINE_ROOT_BUCKET: str = "sentinel-ai-project-482208_cloudbuild/pipeline_root" 
     MLOPS_ARTIFACT_BUCKET: str = "sentinel-mlops-artifacts-sentinel-ai-project-482208"
+    # 多模态图片按内容哈希上传一次，Gemini 通过 gs:// URI 读取
+    IMAGE_UPLOAD_BUCKET: str = os.getenv("IMAGE_UPLOAD_BUCKET", "sentinel-images")
     
     # BigQuery Config
     BQ_TUNING_DATASET_ID: str = "sentinel-ai-project-482208.retail_ai.gemini_tuning_dataset"
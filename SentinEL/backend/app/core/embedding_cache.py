@@ -0,0 +1,67 @@
+"""
+SentinEL 持久化 Embedding 缓存
+以文本内容寻址 (blake2b) 的 LMDB 缓存，跨进程重启复用查询向量，避免重复调用 Embedding 模型
+
+缓存目录需挂载持久卷 (如 Cloud Run 的 GCS FUSE / Filestore 卷) 才能跨实例重启保留；
+未安装 lmdb 或目录不可写时退化为直接计算。
+"""
+
+import os
+import hashlib
+import logging
+from array import array
+from typing import List, Optional
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/sentinel-embeddings")
+EMBEDDING_CACHE_MAP_SIZE = int(os.getenv("EMBEDDING_CACHE_MAP_SIZE", str(256 * 1024 * 1024)))
+
+
+class EmbeddingCache:
+    """
+    text -> float32 向量
+
+    键为 blake2b(namespace + text) 的 16 字节摘要，值为 float32 原始字节。
+    namespace 通常为 Embedding 模型名，模型升级后旧向量自然失效。
+    """
+
+    def __init__(self, namespace: str, path: str = EMBEDDING_CACHE_PATH, map_size: int = EMBEDDING_CACHE_MAP_SIZE):
+        self._prefix = f"{namespace}\0".encode("utf-8")
+        self._env = None
+        if lmdb is None:
+            logger.warning("lmdb not installed; embedding cache disabled")
+            return
+        try:
+            os.makedirs(path, exist_ok=True)
+            self._env = lmdb.open(path, map_size=map_size, subdir=True, max_readers=256)
+        except Exception as e:
+            logger.warning(f"Embedding cache unavailable at {path}: {e}")
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(self._prefix + text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        if self._env is None:
+            return None
+        with self._env.begin(buffers=True) as txn:
+            value = txn.get(self._key(text))
+            if value is None:
+                return None
+            vec = array("f")
+            vec.frombytes(value)
+        return vec.tolist()
+
+    def put(self, text: str, vector: List[float]) -> None:
+        if self._env is None:
+            return
+        try:
+            with self._env.begin(write=True) as txn:
+                txn.put(self._key(text), array("f", vector).tobytes())
+        except lmdb.MapFullError:
+            logger.warning("Embedding cache is full; new vectors are not persisted")
@@ -1,22 +1,57 @@
 from fastapi import Security, HTTPException, status
 from fastapi.security.api_key import APIKeyHeader
 import os
+import hmac
+import time
+import hashlib
 import logging
 
 API_KEY_NAME = "X-API-KEY"
 # In a real scenario, use os.getenv("API_SECRET_KEY")
 # For this demo, we hardcode as requested
-API_SECRET_KEY = "sentinel_top_secret_2025" 
+API_SECRET_KEY = "sentinel_top_secret_2025"
+
+# Digest computed once at import; each request hashes the presented key to the
+# same fixed length and compares in constant time (no timing side channel).
+_VALID_KEY_DIGEST = hashlib.blake2b(API_SECRET_KEY.encode(), digest_size=16).digest()
 
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
 logger = logging.getLogger(__name__)
 
+
+class _RateLimitFilter(logging.Filter):
+    """Lets at most one record through per `interval` seconds, so a flood of bad keys can't flood the logs."""
+
+    def __init__(self, interval: float = 10.0):
+        super().__init__()
+        self.interval = interval
+        self._next_allowed = 0.0
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        if now < self._next_allowed:
+            self.suppressed += 1
+            return False
+        if self.suppressed:
+            record.msg = f"{record.msg} ({self.suppressed} similar messages suppressed)"
+            self.suppressed = 0
+        self._next_allowed = now + self.interval
+        return True
+
+
+_unauthorized_logger = logging.getLogger(f"{__name__}.unauthorized")
+_unauthorized_logger.addFilter(_RateLimitFilter())
+
+
 async def verify_api_key(api_key: str = Security(api_key_header)):
-    if api_key == API_SECRET_KEY:
+    if api_key and hmac.compare_digest(
+        hashlib.blake2b(api_key.encode(), digest_size=16).digest(), _VALID_KEY_DIGEST
+    ):
         return api_key
-    
-    logger.warning(f"Unauthorized access attempt with key: {api_key}")
+
+    _unauthorized_logger.warning("Unauthorized access attempt with key prefix: %s", (api_key or "")[:4])
     raise HTTPException(
         status_code=status.HTTP_403_FORBIDDEN,
         detail="Could not validate API KEY"
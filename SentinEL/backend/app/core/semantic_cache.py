@@ -0,0 +1,64 @@
+"""
+SentinEL 进程内语义缓存
+以 L2 归一化向量为键的近似匹配缓存，供向量检索 / LLM 生成等高延迟调用复用结果
+"""
+
+import time
+import threading
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    近似向量键缓存
+
+    新查询与已缓存向量的余弦相似度 >= threshold 且 tag 相同时命中
+    (tag 用于隔离不应混用的结果，如不同 top_k / 不同模型)。
+    固定容量，满后淘汰最久未使用的条目。
+    """
+
+    def __init__(self, capacity: int = 256, threshold: float = 0.95):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vecs: Optional[np.ndarray] = None  # [capacity, d]
+        self._tags = np.empty(capacity, dtype=object)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._vals: list = [None] * capacity
+        self._count = 0
+
+    @staticmethod
+    def normalize(vector: list) -> np.ndarray:
+        q = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        return q / norm if norm else q
+
+    def get(self, q: np.ndarray, tag: Hashable) -> Optional[Any]:
+        with self._lock:
+            if not self._count or self._vecs.shape[1] != q.shape[0]:
+                return None
+            sims = self._vecs[:self._count] @ q
+            sims[self._tags[:self._count] != tag] = -np.inf
+            idx = int(np.argmax(sims))
+            if sims[idx] < self.threshold:
+                return None
+            self._last_used[idx] = time.monotonic()
+            return self._vals[idx]
+
+    def put(self, q: np.ndarray, tag: Hashable, value: Any) -> None:
+        with self._lock:
+            if self._vecs is None or self._vecs.shape[1] != q.shape[0]:
+                # 首次写入 (或 embedding 维度变化) 时按维度分配存储
+                self._vecs = np.zeros((self.capacity, q.shape[0]), dtype=np.float32)
+                self._count = 0
+            if self._count < self.capacity:
+                slot = self._count
+                self._count += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+            self._vecs[slot] = q
+            self._tags[slot] = tag
+            self._vals[slot] = value
+            self._last_used[slot] = time.monotonic()
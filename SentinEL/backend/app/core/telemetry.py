@@ -24,6 +24,9 @@ try:
     from opentelemetry import trace
     from opentelemetry.sdk.trace import TracerProvider
     from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import (
+        Sampler, ParentBased, TraceIdRatioBased, ALWAYS_ON
+    )
     from opentelemetry.sdk.resources import Resource
     from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
     from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
@@ -39,9 +42,18 @@ except ImportError:
 SERVICE_NAME = "sentinel-backend"
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "sentinel-ai-project-482208")
 
-# 全局 Tracer 实例
-_tracer = None
+# 高频端点的采样率 (其余端点全量采样)
+HOT_ROUTE_SAMPLE_RATIO = float(os.getenv("OTEL_HOT_ROUTE_SAMPLE_RATIO", "0.1"))
+HOT_ROUTES = ("/recommendations",)
 
+# 不创建 span 的端点 (逗号分隔的正则，匹配 URL): Cloud Run 健康探针、诊断端点
+EXCLUDED_URLS = os.getenv("OTEL_PYTHON_FASTAPI_EXCLUDED_URLS", "health,api/v1/test_llm,metrics")
+
+# BatchSpanProcessor 参数: 更大的队列避免高 RPS 下丢 span，更短的导出间隔避免积压
+SPAN_MAX_QUEUE_SIZE = 8192
+SPAN_SCHEDULE_DELAY_MS = 2000
+SPAN_MAX_EXPORT_BATCH_SIZE = 1024
+SPAN_EXPORT_TIMEOUT_MS = 10000
 
 class DummyTracer:
     def start_as_current_span(self, name):
@@ -56,17 +68,43 @@ class DummyTracer:
     def set_attribute(self, key, value):
         pass
 
+    def add_event(self, name, attributes=None):
+        pass
+
+
+if _HAS_OPENTELEMETRY:
+    class HotRouteSampler(Sampler):
+        """
+        根 span 名称命中高频路由时按比例采样，其余全量采样。
+        外层由 ParentBased 包装，子 span 跟随父 span 的采样决定。
+        """
+
+        def __init__(self, ratio: float):
+            self._hot = TraceIdRatioBased(ratio)
+
+        def should_sample(self, parent_context, trace_id, name, kind=None,
+                          attributes=None, links=None, trace_state=None):
+            sampler = self._hot if any(route in name for route in HOT_ROUTES) else ALWAYS_ON
+            return sampler.should_sample(parent_context, trace_id, name, kind,
+                                         attributes, links, trace_state)
+
+        def get_description(self):
+            return f"HotRouteSampler{{{self._hot.get_description()}}}"
+
+
+# 全局 Tracer 实例 (模块导入时创建一次)
+# OpenTelemetry 返回的是 ProxyTracer: setup_telemetry 设置 TracerProvider 后自动委托给真实实现，
+# 因此在各服务模块导入时提前获取也不会错过配置
+TRACER = trace.get_tracer(__name__) if _HAS_OPENTELEMETRY else DummyTracer()
+
 
 def setup_telemetry(app) -> None:
     """
     初始化 OpenTelemetry 并配置 Google Cloud Trace 导出器。
     如果依赖缺失，则跳过初始化。
     """
-    global _tracer
-    
     if not _HAS_OPENTELEMETRY:
         print("[Telemetry] OpenTelemetry packages not found. Telemetry disabled.")
-        _tracer = DummyTracer()
         return
 
     # 创建资源标识 (用于在 Cloud Console 中识别服务)
@@ -79,7 +117,10 @@ def setup_telemetry(app) -> None:
     })
     
     # 创建 TracerProvider
-    provider = TracerProvider(resource=resource)
+    provider = TracerProvider(
+        resource=resource,
+        sampler=ParentBased(HotRouteSampler(HOT_ROUTE_SAMPLE_RATIO)),
+    )
     
     # 配置 Cloud Trace 导出器
     # 在 Cloud Run 上会自动使用服务账号认证
@@ -87,7 +128,13 @@ def setup_telemetry(app) -> None:
         exporter = CloudTraceSpanExporter(project_id=PROJECT_ID)
         
         # 使用 BatchSpanProcessor 批量发送 (提高性能)
-        span_processor = BatchSpanProcessor(exporter)
+        span_processor = BatchSpanProcessor(
+            exporter,
+            max_queue_size=SPAN_MAX_QUEUE_SIZE,
+            schedule_delay_millis=SPAN_SCHEDULE_DELAY_MS,
+            max_export_batch_size=SPAN_MAX_EXPORT_BATCH_SIZE,
+            export_timeout_millis=SPAN_EXPORT_TIMEOUT_MS,
+        )
         provider.add_span_processor(span_processor)
         
         print(f"[Telemetry] Cloud Trace exporter configured for project: {PROJECT_ID}")
@@ -95,16 +142,16 @@ def setup_telemetry(app) -> None:
         print(f"[Telemetry] Warning: Failed to configure Cloud Trace exporter: {e}")
         print("[Telemetry] Traces will be logged locally only.")
     
-    # 设置全局 TracerProvider
+    # 设置全局 TracerProvider (TRACER 随之生效)
     trace.set_tracer_provider(provider)
     
-    # 获取 Tracer 实例
-    _tracer = trace.get_tracer(__name__)
+    # 进程退出前刷新队列中尚未导出的 span
+    app.add_event_handler("shutdown", provider.shutdown)
     
     # 自动注入 FastAPI 仪表盘
     # 这会自动为每个 HTTP 请求创建 span
-    FastAPIInstrumentor.instrument_app(app)
-    print("[Telemetry] FastAPI auto-instrumentation enabled.")
+    FastAPIInstrumentor.instrument_app(app, excluded_urls=EXCLUDED_URLS)
+    print(f"[Telemetry] FastAPI auto-instrumentation enabled (excluded: {EXCLUDED_URLS}).")
     
     # 自动注入 requests 库 (用于追踪外部 HTTP 调用)
     RequestsInstrumentor().instrument()
@@ -117,11 +164,4 @@ def get_tracer():
     """
     获取全局 Tracer 实例用于手动埋点。
     """
-    global _tracer
-    if _tracer is None:
-        if _HAS_OPENTELEMETRY:
-             _tracer = trace.get_tracer(__name__)
-        else:
-             _tracer = DummyTracer()
-             
-    return _tracer
+    return TRACER
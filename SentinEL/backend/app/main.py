@@ -7,6 +7,7 @@ SentinEL Enterprise Microservice
 
 import sys
 import os
+import asyncio
 import logging
 
 # Basic logging setup
@@ -20,7 +21,8 @@ try:
 except Exception as e:
     print("DEBUG: Error checking env:", e)
 
-from fastapi import FastAPI
+import orjson
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 
@@ -57,16 +59,97 @@ app.include_router(recommendations.router, prefix="/api/v1", tags=["Recommendati
 app.include_router(agent.router, prefix="/api/v1", tags=["Agent Orchestration"])
 app.include_router(events.router, prefix="/api/v1/events", tags=["Internal Events"])
 
+# --- Startup Warmup ---
+async def _warmup():
+    """
+    在进程启动时构建 Agent Graph 并预热 Vertex 通道，
+    避免新实例的首个请求承担 gRPC/认证握手延迟
+    """
+    try:
+        from app.agents.sentinel_agent import warmup_agent
+        app.state.agent_graph = await warmup_agent()
+    except Exception as e:
+        logger.warning(f"Agent warmup failed, will initialize lazily: {e}")
+
+app.add_event_handler("startup", _warmup)
+
+async def _warmup_services():
+    """
+    预构建编排器依赖的服务单例并预热各自的连接
+    (Feature Store gRPC 通道、BigQuery、Gemini 审计模型)，首个用户请求不再承担冷启动
+    """
+    def _run():
+        from app.services.feature_store_service import get_feature_store_service
+        from app.services.orchestrator import get_orchestrator
+        
+        fs_service = get_feature_store_service()
+        if fs_service:
+            fs_service.warmup()
+        orchestrator = get_orchestrator()
+        orchestrator.bq_service.warmup()
+        orchestrator.judge_service.warmup()
+    
+    try:
+        await asyncio.to_thread(_run)
+    except Exception as e:
+        logger.warning(f"Service warmup failed, will initialize lazily: {e}")
+
+app.add_event_handler("startup", _warmup_services)
+
+# --- Pending Pipeline Dispatches (drained before cache/broker shutdown) ---
+async def _drain_dispatches():
+    from app.api.v1.endpoints.pipeline import drain_pending_dispatches
+    await drain_pending_dispatches()
+
+app.add_event_handler("shutdown", _drain_dispatches)
+
+# --- Redis Cache ---
+async def _connect_cache():
+    """检测 Redis 连接，失败时缓存自动降级为直通"""
+    from app.core.cache import redis_client
+    await redis_client.connect()
+
+async def _close_cache():
+    from app.core.cache import redis_client
+    await redis_client.close()
+
+app.add_event_handler("startup", _connect_cache)
+app.add_event_handler("shutdown", _close_cache)
+
+# --- Pipeline Job Queue (publish only; jobs are consumed by app.workers.pipeline_worker) ---
+async def _connect_broker():
+    from app.workers.pipeline_worker import broker
+    try:
+        await broker.connect()
+    except Exception as e:
+        logger.warning(f"Pipeline broker connection failed: {e}")
+
+async def _close_broker():
+    from app.workers.pipeline_worker import broker
+    await broker.close()
+
+app.add_event_handler("startup", _connect_broker)
+app.add_event_handler("shutdown", _close_broker)
+
 # --- Health Check ---
-@app.get("/health")
+# 响应体在启动时预编码，探针请求无需任何序列化
+_HEALTH_BODY = orjson.dumps({"status": "healthy", "service": "SentinEL Backend", "version": settings.VERSION})
+
+@app.get("/health", response_class=Response, include_in_schema=False)
 def health_check():
-    return {"status": "healthy", "service": "SentinEL Backend", "version": settings.VERSION}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
+
+@app.get("/health/cache", include_in_schema=False)
+def health_cache():
+    from app.core.cache import redis_client
+    return redis_client.pool_stats()
 
 # --- Diagnostic Endpoint ---
 @app.get("/api/v1/test_llm")
-async def test_llm_endpoint():
+async def test_llm_endpoint(deep: bool = False):
     """
-    Diagnostic endpoint to test LLM connectivity and report library versions.
+    Diagnostic endpoint to test LLM connectivity.
+    Pass ?deep=1 to also report library versions (imports TensorFlow etc. into the worker).
     """
     import sys
     import traceback
@@ -79,8 +162,9 @@ async def test_llm_endpoint():
         "response": None
     }
     
-    # Check Library Versions
-    libs_to_check = [
+    # Check Library Versions (deep mode only: importing these pulls heavy
+    # libraries such as TensorFlow into the worker process)
+    libs_to_check = [] if not deep else [
         "google.protobuf",
         "google.cloud.aiplatform",
         "vertexai",
@@ -126,4 +210,4 @@ async def test_llm_endpoint():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8080, reload=True)
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8080, reload=True, loop="uvloop", http="httptools")
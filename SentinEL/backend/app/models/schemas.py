@@ -1,11 +1,15 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Dict, Any
 
 class UserAnalysisRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     user_id: str
     image_data: Optional[str] = None  # Base64 encoded image
 
 class UserAnalysisResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     user_id: str
     risk_level: str
     churn_probability: float
@@ -20,6 +24,8 @@ class UserAnalysisResponse(BaseModel):
     generated_audio: Optional[str] = None  # Base64 encoded MP3
 
 class FeedbackRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     analysis_id: str
     user_id: str
     feedback_type: str  # "thumbs_up" or "thumbs_down"
@@ -0,0 +1,87 @@
+"""
+SentinEL 共享 GCP 客户端
+进程内只构建一次，供各 Service 复用 (连接池、凭证刷新只有一份)
+"""
+
+import os
+import threading
+from functools import lru_cache
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery, bigquery_storage_v1, firestore, storage
+from requests.adapters import HTTPAdapter
+
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "sentinel-ai-project-482208")
+
+# BigQuery REST 传输的连接池大小: 并发请求复用已建立的 TLS 连接
+BQ_HTTP_POOL_CONNECTIONS = int(os.getenv("BQ_HTTP_POOL_CONNECTIONS", "32"))
+BQ_HTTP_POOL_MAXSIZE = int(os.getenv("BQ_HTTP_POOL_MAXSIZE", "64"))
+
+_CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+# Vertex AI 传输: gRPC (HTTP/2 多路复用，同一模型对象的并发调用共享一条通道)
+VERTEX_API_TRANSPORT = os.getenv("VERTEX_API_TRANSPORT", "grpc")
+
+_vertexai_lock = threading.Lock()
+_vertexai_initialized: set = set()
+
+
+@lru_cache(maxsize=1)
+def bq_http_session() -> AuthorizedSession:
+    """
+    带连接池的已授权 HTTP Session (传给 bigquery.Client 的 _http)
+
+    默认传输的连接池仅 10 个连接，突发并发时会反复 TLS 握手。
+    """
+    credentials, _ = google.auth.default(scopes=[_CLOUD_PLATFORM_SCOPE])
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=BQ_HTTP_POOL_CONNECTIONS, pool_maxsize=BQ_HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    return session
+
+
+@lru_cache(maxsize=1)
+def bq_client() -> bigquery.Client:
+    """进程级共享的 BigQuery 客户端"""
+    return bigquery.Client(project=PROJECT_ID, _http=bq_http_session())
+
+
+@lru_cache(maxsize=1)
+def bq_read_client() -> bigquery_storage_v1.BigQueryReadClient:
+    """进程级共享的 BigQuery Storage Read API 客户端 (大结果集以 Arrow 流式读取)"""
+    return bigquery_storage_v1.BigQueryReadClient()
+
+
+@lru_cache(maxsize=1)
+def firestore_client() -> firestore.Client:
+    """进程级共享的 Firestore 客户端 (gRPC 通道与凭证缓存只有一份)"""
+    return firestore.Client(project=PROJECT_ID)
+
+
+@lru_cache(maxsize=1)
+def gcs_client() -> storage.Client:
+    """进程级共享的 Cloud Storage 客户端"""
+    return storage.Client(project=PROJECT_ID)
+
+
+def init_vertexai(project: str = PROJECT_ID, location: str = "us-central1"):
+    """
+    进程内只执行一次 vertexai.init (相同 project/location 重复调用直接返回)
+
+    多个 Service 各自初始化时会重复构建凭证与 API 端点配置。
+    """
+    key = (project, location)
+    if key in _vertexai_initialized:
+        return
+    with _vertexai_lock:
+        if key in _vertexai_initialized:
+            return
+        import vertexai  # 延迟导入: 仅使用 BigQuery/Firestore 的进程无需加载 aiplatform
+        vertexai.init(
+            project=project,
+            location=location,
+            api_endpoint=f"{location}-aiplatform.googleapis.com",
+            api_transport=VERTEX_API_TRANSPORT
+        )
+        _vertexai_initialized.add(key)
@@ -7,11 +7,19 @@ BigQuery Service - 企业级用户流失预测和向量检索服务
 from google.cloud import bigquery
 from fastapi import HTTPException
 from app.core.telemetry import get_tracer
+from app.services._clients import bq_client, bq_read_client
+from app.core.semantic_cache import SemanticCache
+from cachetools import TTLCache
 import os
+import threading
 
 # 获取 Tracer 实例
 tracer = get_tracer()
 
+# 预测结果缓存: 同一用户的 ML.PREDICT 输出在分钟级别内稳定
+PREDICTION_CACHE_SIZE = 50_000
+PREDICTION_CACHE_TTL = 300
+
 
 class BigQueryService:
     def __init__(self):
@@ -20,12 +28,69 @@ class BigQueryService:
         self.dataset_id = os.getenv("BQ_DATASET", "retail_ai")
         self.table_id = os.getenv("BQ_TABLE", "user_features_training")
         self.model_id = os.getenv("BQ_MODEL", "churn_dnn_premium")
-        self.client = bigquery.Client(project=self.project_id)
+        self.client = bq_client()
+        # 单次查询最大计费字节数上限，防止异常查询扫描全表产生意外费用
+        self.max_bytes_billed = int(os.getenv("BQ_MAX_BYTES_BILLED", str(10 * 1024 ** 3)))
         
         # Table References
         self.prediction_model = f"{self.project_id}.{self.dataset_id}.{self.model_id}"
         self.feature_table = f"{self.project_id}.{self.dataset_id}.{self.table_id}"
         self.policy_table = f"{self.project_id}.{self.dataset_id}.retention_policies_embedded"
+        
+        # user_id -> 预测结果 (TTLCache 在读取时也会清理过期项，读写都需加锁)
+        self._pred_cache = TTLCache(maxsize=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+        self._pred_cache_lock = threading.Lock()
+        
+        # 近似重复的查询向量直接命中语义缓存
+        self._policy_cache = SemanticCache(capacity=256, threshold=0.95)
+        
+        # user_id 通过查询参数传入: 所有用户共用同一 SQL 文本，避免注入
+        self._prediction_sql = f"""
+            SELECT
+                *
+            FROM
+                ML.PREDICT(MODEL `{self.prediction_model}`,
+                (
+                    SELECT * EXCEPT(churn_label)
+                    FROM `{self.feature_table}`
+                    WHERE user_id = @uid
+                ))
+            LIMIT 1
+        """
+        
+        # 批量预测: 一次查询覆盖一组用户 (analyze_users 预取，结果写入预测缓存)
+        self._bulk_prediction_sql = f"""
+            SELECT
+                user_id, predicted_churn_label, predicted_churn_label_probs,
+                country, traffic_source, device_type, monetary_90d
+            FROM
+                ML.PREDICT(MODEL `{self.prediction_model}`,
+                (
+                    SELECT * EXCEPT(churn_label)
+                    FROM `{self.feature_table}`
+                    WHERE user_id IN UNNEST(@uids)
+                ))
+        """
+        
+        # 向量与 top_k 通过查询参数传入: SQL 文本固定不变 (表名不能参数化，构造一次即可)
+        self._policy_search_sql = f"""
+            SELECT base.policy_text
+            FROM
+              VECTOR_SEARCH(
+                TABLE `{self.policy_table}`,
+                'ml_generate_embedding_result',
+                (SELECT @q AS query_vector),
+                top_k => @k,
+                distance_type => 'COSINE'
+              )
+        """
+
+    def warmup(self):
+        """执行一次 SELECT 1，提前建立 HTTP 连接并获取访问令牌"""
+        try:
+            self.client.query_and_wait("SELECT 1", max_results=1)
+        except Exception as e:
+            print(f"BigQuery warmup failed: {e}")
 
     def get_user_churn_prediction(self, user_id: str) -> dict:
         """
@@ -41,54 +106,48 @@ class BigQueryService:
             span.set_attribute("user.id", user_id)
             span.set_attribute("model.name", self.prediction_model)
             
-            query = f"""
-                SELECT
-                    *
-                FROM
-                    ML.PREDICT(MODEL `{self.prediction_model}`,
-                    (
-                        SELECT * EXCEPT(churn_label)
-                        FROM `{self.feature_table}`
-                        WHERE user_id = CAST('{user_id}' AS INT64)
-                    ))
-            """
+            with self._pred_cache_lock:
+                cached = self._pred_cache.get(user_id)
+            span.set_attribute("cache.hit", cached is not None)
+            if cached is not None:
+                # 调用方会在 features 上追加实时特征，返回副本避免污染缓存
+                return {**cached, "features": dict(cached["features"])}
             
+            # 特征表 user_id 为 INT64，非数字 ID 不可能命中
             try:
-                query_job = self.client.query(query)
-                rows = list(query_job.result())
+                uid = int(user_id)
+            except (TypeError, ValueError):
+                span.set_attribute("error", True)
+                span.set_attribute("error.message", "Invalid user_id")
+                raise HTTPException(status_code=404, detail=f"User {user_id} not found in features table.")
+            
+            try:
+                # query_and_wait: 结果随 jobs.query 响应一并返回，省去 getQueryResults 轮询往返
+                rows = self.client.query_and_wait(
+                    self._prediction_sql,
+                    job_config=bigquery.QueryJobConfig(
+                        query_parameters=[bigquery.ScalarQueryParameter("uid", "INT64", uid)],
+                        maximum_bytes_billed=self.max_bytes_billed,
+                        use_query_cache=True
+                    ),
+                    max_results=1
+                )
+                row = next(iter(rows), None)
                 
-                if not rows:
+                if row is None:
                     span.set_attribute("error", True)
                     span.set_attribute("error.message", "User not found")
                     raise HTTPException(status_code=404, detail=f"User {user_id} not found in features table.")
-                    
-                row = rows[0]
                 
-                # Extract probability for label 1 (Churn)
-                churn_prob = 0.0
-                for p in row.predicted_churn_label_probs:
-                    label = p['label'] if isinstance(p, dict) else p.label
-                    prob = p['prob'] if isinstance(p, dict) else p.prob
-                    
-                    if label == 1:
-                        churn_prob = prob
-                        break
+                result = self._prediction_from_row(user_id, row)
                 
                 # 记录结果到 Span
-                span.set_attribute("prediction.churn_probability", churn_prob)
-                span.set_attribute("prediction.label", row.predicted_churn_label)
-                        
-                return {
-                    "user_id": user_id,
-                    "predicted_label": row.predicted_churn_label,
-                    "churn_probability": churn_prob,
-                    "features": {
-                        "country": row.country,
-                        "traffic_source": row.traffic_source,
-                        "device_type": row.device_type,
-                        "monetary_90d": row.monetary_90d
-                    }
-                }
+                span.set_attribute("prediction.churn_probability", result["churn_probability"])
+                span.set_attribute("prediction.label", result["predicted_label"])
+                
+                with self._pred_cache_lock:
+                    self._pred_cache[user_id] = result
+                return {**result, "features": dict(result["features"])}
                 
             except Exception as e:
                 if isinstance(e, HTTPException):
@@ -98,6 +157,86 @@ class BigQueryService:
                 print(f"Error in BigQuery Service (Prediction): {e}")
                 raise HTTPException(status_code=500, detail="Internal ML prediction error.")
 
+    @staticmethod
+    def _prediction_from_row(user_id: str, row) -> dict:
+        """
+        将 ML.PREDICT 结果行转换为预测结果字典
+        
+        按列名下标取值: bigquery.Row 与 Arrow to_pylist() 产生的 dict 通用
+        """
+        # Extract probability for label 1 (Churn)
+        churn_prob = 0.0
+        for p in row["predicted_churn_label_probs"]:
+            label = p['label'] if isinstance(p, dict) else p.label
+            prob = p['prob'] if isinstance(p, dict) else p.prob
+            
+            if label == 1:
+                churn_prob = prob
+                break
+        
+        return {
+            "user_id": user_id,
+            "predicted_label": row["predicted_churn_label"],
+            "churn_probability": churn_prob,
+            "features": {
+                "country": row["country"],
+                "traffic_source": row["traffic_source"],
+                "device_type": row["device_type"],
+                "monetary_90d": row["monetary_90d"]
+            }
+        }
+
+    def prefetch_churn_predictions(self, user_ids: list[str]) -> int:
+        """
+        用一次 ML.PREDICT 查询批量预测一组用户，结果写入预测缓存，
+        随后各用户的 get_user_churn_prediction 直接命中缓存。
+        
+        Trace Span: "BigQuery: ML.PREDICT Batch"
+        
+        Returns:
+            int: 新写入缓存的用户数
+        """
+        with tracer.start_as_current_span("BigQuery: ML.PREDICT Batch") as span:
+            span.set_attribute("db.system", "bigquery")
+            span.set_attribute("db.operation", "ML.PREDICT")
+            span.set_attribute("model.name", self.prediction_model)
+            
+            with self._pred_cache_lock:
+                pending = {uid for uid in user_ids if uid not in self._pred_cache}
+            uids = []
+            for user_id in pending:
+                try:
+                    uids.append(int(user_id))
+                except (TypeError, ValueError):
+                    continue  # 非数字 ID 留给单用户路径返回 404
+            span.set_attribute("input.batch_size", len(uids))
+            if not uids:
+                return 0
+            
+            try:
+                rows = self.client.query_and_wait(
+                    self._bulk_prediction_sql,
+                    job_config=bigquery.QueryJobConfig(
+                        query_parameters=[bigquery.ArrayQueryParameter("uids", "INT64", uids)],
+                        maximum_bytes_billed=self.max_bytes_billed,
+                        use_query_cache=True
+                    )
+                )
+                # 大批量结果经 Storage Read API 以 Arrow 读取 (结果较小时客户端自动沿用 REST 首页数据)
+                table = rows.to_arrow(bqstorage_client=bq_read_client())
+                results = [self._prediction_from_row(str(row["user_id"]), row) for row in table.to_pylist()]
+            except Exception as e:
+                span.set_attribute("error", True)
+                span.set_attribute("error.message", str(e))
+                print(f"Error in BigQuery Service (Batch Prediction): {e}")
+                return 0
+            
+            with self._pred_cache_lock:
+                for result in results:
+                    self._pred_cache[result["user_id"]] = result
+            span.set_attribute("output.rows", len(results))
+            return len(results)
+
     def search_similar_policies(self, query_vector: list[float], top_k: int = 3) -> list[str]:
         """
         使用向量搜索检索相关挽留策略。
@@ -111,27 +250,26 @@ class BigQueryService:
             span.set_attribute("search.top_k", top_k)
             span.set_attribute("search.vector_dimensions", len(query_vector))
             
+            q = self._policy_cache.normalize(query_vector)
+            cached = self._policy_cache.get(q, top_k)
+            span.set_attribute("cache.hit", cached is not None)
+            if cached is not None:
+                return list(cached)
+            
             try:
-                vector_str = str(query_vector)
-                
-                sql = f"""
-                    SELECT base.policy_text
-                    FROM
-                      VECTOR_SEARCH(
-                        TABLE `{self.policy_table}`,
-                        'ml_generate_embedding_result',
-                        (SELECT {vector_str} AS query_vector),
-                        top_k => {top_k},
-                        distance_type => 'COSINE'
-                      )
-                """
+                job_config = bigquery.QueryJobConfig(query_parameters=[
+                    bigquery.ArrayQueryParameter("q", "FLOAT64", list(query_vector)),
+                    bigquery.ScalarQueryParameter("k", "INT64", top_k),
+                ])
                 
-                query_job = self.client.query(sql)
+                query_job = self.client.query(self._policy_search_sql, job_config=job_config)
                 results = [row.policy_text for row in query_job.result()]
                 
                 # 记录结果到 Span
                 span.set_attribute("search.results_count", len(results))
                 
+                if results:
+                    self._policy_cache.put(q, top_k, list(results))
                 return results
 
             except Exception as e:
@@ -1,36 +1,98 @@
-import firebase_admin
-from firebase_admin import firestore
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import bigquery
-import vertexai
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types as bq_storage_types
+from google.cloud.bigquery_storage_v1 import writer as bq_storage_writer
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 from vertexai.generative_models import GenerativeModel
+from vertexai.batch_prediction import BatchPredictionJob
+import asyncio
 import logging
-from datetime import datetime
+import uuid
+import time
 import os
 
+from app.services._clients import bq_client, firestore_client, init_vertexai
+
 # Configure Logger
 logger = logging.getLogger(__name__)
 
+SYNTHESIS_MODEL = "gemini-2.5-pro"
+# Batch Prediction jobs carry minutes of queueing overhead; below this many
+# low-score logs the online generate_content path finishes sooner.
+BATCH_PREDICTION_MIN_ROWS = int(os.getenv("BATCH_PREDICTION_MIN_ROWS", "10"))
+BATCH_POLL_INTERVAL_SECONDS = 30
+# Rows per AppendRowsRequest (each request must stay under the 10 MB limit)
+EXPORT_BATCH_ROWS = 500
+
+# gemini_tuning_dataset row layout for the Storage Write API (proto2 field types).
+# created_at is a TIMESTAMP column (the batch path writes CURRENT_TIMESTAMP()), which the
+# Storage Write API takes as INT64 microseconds since the epoch.
+_TUNING_ROW_FIELDS = (
+    ("origin_id", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+    ("prompt", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+    ("response", descriptor_pb2.FieldDescriptorProto.TYPE_STRING),
+    ("quality_score", descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE),
+    ("is_synthetic", descriptor_pb2.FieldDescriptorProto.TYPE_BOOL),
+    ("created_at", descriptor_pb2.FieldDescriptorProto.TYPE_INT64),
+)
+
+
+def _build_tuning_row_message():
+    """Build the protobuf message class and its DescriptorProto for one tuning-dataset row."""
+    file_proto = descriptor_pb2.FileDescriptorProto(name="sentinel_tuning_row.proto", syntax="proto2")
+    message_proto = file_proto.message_type.add(name="TuningRow")
+    for number, (name, field_type) in enumerate(_TUNING_ROW_FIELDS, start=1):
+        message_proto.field.add(
+            name=name,
+            number=number,
+            type=field_type,
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName("TuningRow")
+    if hasattr(message_factory, "GetMessageClass"):  # protobuf >= 4.22
+        return message_factory.GetMessageClass(descriptor), message_proto
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor), message_proto
+
+
+TuningRow, _TUNING_ROW_DESCRIPTOR = _build_tuning_row_message()
+
+
+def _now_micros() -> int:
+    """Current time as epoch microseconds (TIMESTAMP encoding for the Storage Write API)."""
+    return time.time_ns() // 1000
+
+# Concurrent online generate_content calls (keeps us under the Gemini QPS quota)
+SYNTHESIS_CONCURRENCY = int(os.getenv("SYNTHESIS_CONCURRENCY", "8"))
+
 class DataFactory:
     def __init__(self):
         # Initialize Services
         try:
-            # Check if app is already initialized
-            if not firebase_admin._apps:
-                from firebase_admin import credentials
-                cred = credentials.ApplicationDefault()
-                firebase_admin.initialize_app(cred, {"projectId": "sentinel-ai-project-482208"})
-            
-            self.db = firestore.client()
-            self.bq_client = bigquery.Client()
+            self.db = firestore_client()
+            self.bq_client = bq_client()
             
             project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "sentinel-ai-project-482208")
             location = "us-central1"
-            vertexai.init(project=project_id, location=location)
-            self.model = GenerativeModel("gemini-2.5-pro")
+            init_vertexai(project_id, location)
+            self.model = GenerativeModel(SYNTHESIS_MODEL)
             
             self.dataset_id = "retail_ai"
             self.table_id = "gemini_tuning_dataset"
             
+            # Storage Write API: one gRPC channel reused by every export; rows go to the
+            # table's default stream (committed on append, no stream lifecycle to manage)
+            self.write_client = bigquery_storage_v1.BigQueryWriteClient()
+            self._write_request_template = bq_storage_types.AppendRowsRequest(
+                write_stream=f"{self.write_client.table_path(self.bq_client.project, self.dataset_id, self.table_id)}/streams/_default",
+                proto_rows=bq_storage_types.AppendRowsRequest.ProtoData(
+                    writer_schema=bq_storage_types.ProtoSchema(proto_descriptor=_TUNING_ROW_DESCRIPTOR)
+                ),
+            )
+            
             logger.info("DataFactory initialized successfully.")
         except Exception as e:
             logger.error(f"Failed to initialize DataFactory: {e}")
@@ -42,17 +104,23 @@ class DataFactory:
         """
         try:
             logs_ref = self.db.collection("analysis_logs")
-            # Filter for documents that have 'audit_score' (we assume check on > -1 implies existence)
-            # In a real scenario, we might query by timestamp.
-            query = logs_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit)
+            # Filter server-side for documents that have 'audit_score' (an inequality only matches
+            # docs where the field exists) and fetch only the fields the refinery reads.
+            # Requires a composite index on (audit_score, timestamp DESC).
+            query = (
+                logs_ref
+                .where(filter=FieldFilter("audit_score", ">=", 0))
+                .order_by("timestamp", direction=firestore.Query.DESCENDING)
+                .select(["audit_score", "email_subject", "user_id", "risk_level", "audit_reason"])
+                .limit(limit)
+            )
             docs = query.stream()
             
             valid_logs = []
             for doc in docs:
                 data = doc.to_dict()
-                if "audit_score" in data:
-                    data["origin_id"] = doc.id
-                    valid_logs.append(data)
+                data["origin_id"] = doc.id
+                valid_logs.append(data)
             
             logger.info(f"Fetched {len(valid_logs)} valid logs for data refinery.")
             return valid_logs
@@ -60,9 +128,29 @@ class DataFactory:
             logger.error(f"Error fetching logs: {e}")
             return []
 
+    @staticmethod
+    def _build_synthesis_prompt(log_entry):
+        original_email = log_entry.get("email_subject", "")
+        audit_reason = log_entry.get("audit_reason", "No reason provided.")
+        return f"""
+            你是一个数据标注专家。这是一个得分较低的客户挽留邮件（内容：{original_email}）。
+            审计意见是：{audit_reason}
+            
+            请根据审计意见重写这封邮件，使其完美符合合规要求，直接输出重写后的邮件内容。
+            """
+
+    @staticmethod
+    def _build_prompt_context(log_entry):
+        user_id = log_entry.get("user_id", "Unknown")
+        risk_level = log_entry.get("risk_level", "Unknown")
+        return f"User {user_id}: Risk {risk_level}. Generate retention email."
+
     def synthesize_improved_data(self, log_entry):
         """
         Refine the data. If score < 80, use Gemini to rewrite the email.
+
+        Online (one generate_content per log) path; run_pipeline hands larger
+        batches of low-score logs to synthesize_with_batch_prediction instead.
         """
         audit_score = log_entry.get("audit_score", 0)
         original_email = log_entry.get("email_subject", "") # Assuming subject contains partial body or we'd ideally store full body
@@ -76,10 +164,8 @@ class DataFactory:
         # Better: Implementation Plan implies we want to form a training pair (Prompt, Response).
         
         # Reconstruct Prompt Context
-        user_id = log_entry.get("user_id", "Unknown")
-        risk_level = log_entry.get("risk_level", "Unknown")
         # Ideal: We would store the exact input prompt used, but we can reconstruct a proxy prompt.
-        prompt_context = f"User {user_id}: Risk {risk_level}. Generate retention email."
+        prompt_context = self._build_prompt_context(log_entry)
 
         if audit_score >= 80:
             # High quality, keep as is
@@ -89,18 +175,11 @@ class DataFactory:
                 "response": original_email, # Or 'generated_email' if we stored it
                 "quality_score": float(audit_score),
                 "is_synthetic": False,
-                "created_at": datetime.utcnow().isoformat()
+                "created_at": _now_micros()
             }
         else:
             # Low quality, synthesize
-            audit_reason = log_entry.get("audit_reason", "No reason provided.")
-            
-            synthesis_prompt = f"""
-            你是一个数据标注专家。这是一个得分较低的客户挽留邮件（内容：{original_email}）。
-            审计意见是：{audit_reason}
-            
-            请根据审计意见重写这封邮件，使其完美符合合规要求，直接输出重写后的邮件内容。
-            """
+            synthesis_prompt = self._build_synthesis_prompt(log_entry)
             
             try:
                 response = self.model.generate_content(synthesis_prompt)
@@ -114,7 +193,7 @@ class DataFactory:
                     "response": improved_email, # The target output
                     "quality_score": 95.0, # Assumed high score after expert rewrite
                     "is_synthetic": True,
-                    "created_at": datetime.utcnow().isoformat()
+                    "created_at": _now_micros()
                 }
             except Exception as e:
                 logger.error(f"Synthesis failed for {log_entry.get('origin_id')}: {e}")
@@ -122,21 +201,132 @@ class DataFactory:
 
     def export_to_bigquery(self, rows):
         """
-        Insert rows into BigQuery.
+        Insert rows into BigQuery via the Storage Write API default stream.
+        Returns the number of rows actually committed (appends to the default
+        stream are committed per request, so a failed request drops only its batch).
         """
         if not rows:
-            return
+            return 0
             
         table_ref = f"{self.bq_client.project}.{self.dataset_id}.{self.table_id}"
+        append_stream = bq_storage_writer.AppendRowsStream(self.write_client, self._write_request_template)
         
+        committed = 0
+        pending = []
         try:
-            errors = self.bq_client.insert_rows_json(table_ref, rows)
-            if errors:
-                logger.error(f"BigQuery Insert Errors: {errors}")
-            else:
-                logger.info(f"Successfully inserted {len(rows)} rows into {table_ref}")
+            try:
+                for start in range(0, len(rows), EXPORT_BATCH_ROWS):
+                    batch = rows[start:start + EXPORT_BATCH_ROWS]
+                    proto_rows = bq_storage_types.ProtoRows()
+                    for row in batch:
+                        proto_rows.serialized_rows.append(TuningRow(**row).SerializeToString())
+                    request = bq_storage_types.AppendRowsRequest(
+                        proto_rows=bq_storage_types.AppendRowsRequest.ProtoData(rows=proto_rows)
+                    )
+                    pending.append((len(batch), append_stream.send(request)))
+            except Exception as e:
+                logger.error(f"Failed to export to BigQuery: {e}")
+            
+            # Batches sent before a failure may still have been committed
+            for batch_size, future in pending:
+                try:
+                    future.result()
+                    committed += batch_size
+                except Exception as e:
+                    logger.error(f"Failed to append {batch_size} rows to {table_ref}: {e}")
+        finally:
+            append_stream.close()
+        
+        logger.info(f"Inserted {committed}/{len(rows)} rows into {table_ref}")
+        return committed
+
+    async def synthesize_with_batch_prediction(self, low_score_logs):
+        """
+        Rewrite low-score emails with a Vertex AI Batch Prediction job.
+
+        Prompts are staged to a BigQuery table, Gemini writes its predictions to
+        a second table, and the results are inserted into the tuning dataset
+        with a single INSERT ... SELECT joined on origin_id.
+        Returns the number of exported rows.
+        """
+        run_id = uuid.uuid4().hex[:12]
+        dataset = f"{self.bq_client.project}.{self.dataset_id}"
+        staging_table = f"{dataset}.data_factory_staging_{run_id}"
+        predictions_table = f"{dataset}.data_factory_predictions_{run_id}"
+        
+        staging_rows = [
+            {
+                "origin_id": log.get("origin_id"),
+                "prompt": self._build_prompt_context(log),
+                # Gemini batch input: one GenerateContentRequest per row
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": self._build_synthesis_prompt(log)}]}]
+                },
+            }
+            for log in low_score_logs
+        ]
+        
+        try:
+            load_job = self.bq_client.load_table_from_json(
+                staging_rows,
+                staging_table,
+                job_config=bigquery.LoadJobConfig(
+                    schema=[
+                        bigquery.SchemaField("origin_id", "STRING"),
+                        bigquery.SchemaField("prompt", "STRING"),
+                        bigquery.SchemaField("request", "JSON"),
+                    ],
+                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                ),
+            )
+            await asyncio.to_thread(load_job.result)
+            
+            job = await asyncio.to_thread(
+                BatchPredictionJob.submit,
+                source_model=SYNTHESIS_MODEL,
+                input_dataset=f"bq://{staging_table}",
+                output_uri_prefix=f"bq://{predictions_table}",
+            )
+            logger.info(f"Submitted batch prediction job {job.resource_name} for {len(staging_rows)} logs.")
+            
+            while not job.has_ended:
+                await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+                await asyncio.to_thread(job.refresh)
+            
+            if not job.has_succeeded:
+                logger.error(f"Batch prediction job failed: {job.error}")
+                return 0
+            
+            # Output table carries the input columns plus response / status;
+            # a non-empty status marks a row that failed inside the job.
+            insert_sql = f"""
+                INSERT INTO `{dataset}.{self.table_id}`
+                    (origin_id, prompt, response, quality_score, is_synthetic, created_at)
+                SELECT
+                    origin_id,
+                    prompt,
+                    JSON_VALUE(response, '$.candidates[0].content.parts[0].text'),
+                    95.0,
+                    TRUE,
+                    CURRENT_TIMESTAMP()
+                FROM `{predictions_table}`
+                WHERE IFNULL(status, '') = ''
+                  AND JSON_VALUE(response, '$.candidates[0].content.parts[0].text') IS NOT NULL
+            """
+            insert_job = await asyncio.to_thread(self.bq_client.query, insert_sql)
+            await asyncio.to_thread(insert_job.result)
+            exported = insert_job.num_dml_affected_rows or 0
+            logger.info(f"Inserted {exported} synthesized rows from batch prediction.")
+            return exported
         except Exception as e:
-            logger.error(f"Failed to export to BigQuery: {e}")
+            logger.error(f"Batch synthesis failed: {e}")
+            return 0
+        finally:
+            for table in (staging_table, predictions_table):
+                try:
+                    await asyncio.to_thread(self.bq_client.delete_table, table, not_found_ok=True)
+                except Exception as e:
+                    logger.warning(f"Failed to drop temporary table {table}: {e}")
 
     async def run_pipeline(self):
         """
@@ -145,18 +335,32 @@ class DataFactory:
         logger.info("Starting Data Factory Pipeline...")
         
         # 1. Fetch
-        logs = self.fetch_and_filter_logs(limit=20) # Process batch of 20
+        logs = await asyncio.to_thread(self.fetch_and_filter_logs, limit=20) # Process batch of 20
         
         # 2. Process / Synthesize
-        tuning_dataset = []
-        for log in logs:
-            result = self.synthesize_improved_data(log)
-            if result:
-                tuning_dataset.append(result)
+        low_score_logs = [log for log in logs if log.get("audit_score", 0) < 80]
+        use_batch = len(low_score_logs) >= BATCH_PREDICTION_MIN_ROWS
+        
+        online_logs = [
+            log for log in logs
+            if not (use_batch and log.get("audit_score", 0) < 80)  # Rewritten by the batch prediction job below
+        ]
+        
+        sem = asyncio.Semaphore(SYNTHESIS_CONCURRENCY)
+        
+        async def _synthesize_one(log):
+            async with sem:
+                return await asyncio.to_thread(self.synthesize_improved_data, log)
+        
+        results = await asyncio.gather(*[_synthesize_one(log) for log in online_logs])
+        tuning_dataset = [r for r in results if r]
         
-        # 3. Export
+        # 3. Export (count only the rows BigQuery actually committed)
+        exported_count = 0
         if tuning_dataset:
-            self.export_to_bigquery(tuning_dataset)
+            exported_count = await asyncio.to_thread(self.export_to_bigquery, tuning_dataset)
+        if use_batch:
+            exported_count += await self.synthesize_with_batch_prediction(low_score_logs)
             
         logger.info("Data Factory Pipeline Completed.")
-        return {"processed_count": len(logs), "exported_count": len(tuning_dataset)}
+        return {"processed_count": len(logs), "exported_count": exported_count}
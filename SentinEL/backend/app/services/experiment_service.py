@@ -3,14 +3,31 @@ SentinEL A/B 测试实验服务
 提供多模型动态路由和确定性用户分流
 """
 
-import zlib
 import logging
+from functools import lru_cache
 from typing import Tuple, Optional
-from firebase_admin import firestore
+from google_crc32c import value as crc32c
+from app.services._clients import firestore_client
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=100_000)
+def _bucket(user_id: str) -> int:
+    """
+    用户 ID -> 分桶号 (0-99)
+
+    CRC32C (硬件指令加速) 产生 32 位无符号整数，取模 100 得到桶号。
+    结果只取决于 user_id，与实验配置无关，配置更新后无需失效。
+
+    注意: 由 zlib.crc32 切换到 CRC32C 是一次性的哈希族变更，
+    部分用户会在上线时重新分桶一次，之后保持稳定。
+    """
+    # 数字 ID 走 ASCII 编码快路径 (ASCII 与 UTF-8 字节相同，分桶结果不变)
+    data = user_id.encode("ascii") if user_id.isascii() else user_id.encode("utf-8")
+    return (crc32c(data) & 0xffffffff) % 100
+
+
 class ExperimentService:
     """
     A/B 测试实验服务
@@ -33,8 +50,12 @@ class ExperimentService:
         self._config_cache: Optional[dict] = None
         self._config_doc_path = "config/ab_testing"
         
+        # 由当前配置预先算好的路由参数: (enabled, threshold, model_a, model_b)
+        self._routing_config: Optional[dict] = None
+        self._routing: Tuple[bool, int, str, str] = (True, 50, "", "")
+        
         try:
-            self.db = firestore.client()
+            self.db = firestore_client()
             logger.info("[ExperimentService] Firestore 连接成功")
         except Exception as e:
             logger.warning(f"[ExperimentService] Firestore 连接失败，使用默认配置: {e}")
@@ -83,7 +104,7 @@ class ExperimentService:
         """
         根据用户 ID 确定实验分组和使用的模型
         
-        使用 CRC32 哈希算法确保:
+        使用 CRC32C 哈希算法确保:
         1. 同一用户始终落入同一分组
         2. 用户分布均匀
         
@@ -95,30 +116,34 @@ class ExperimentService:
                 - experiment_group: "A" 或 "B"
                 - model_name: 具体模型名称
         """
-        config = self.get_config()
+        enabled, threshold, model_a, model_b = self._get_routing()
         
         # 实验未启用时，使用默认模型
-        if not config.get("enabled", True):
-            logger.info(f"[ExperimentService] 实验已禁用，使用默认模型 A")
-            return ("A", config.get("model_a", self.DEFAULT_CONFIG["model_a"]))
+        if not enabled:
+            return ("A", model_a)
         
         # 确定性哈希分流
-        # CRC32 产生 32 位无符号整数，取模 100 得到 0-99 的桶号
-        hash_value = zlib.crc32(user_id.encode("utf-8")) & 0xffffffff
-        bucket = hash_value % 100
-        
-        split_ratio = config.get("split_ratio", 0.5)
-        threshold = int(split_ratio * 100)
-        
+        bucket = _bucket(user_id)
         if bucket < threshold:
-            group = "A"
-            model = config.get("model_a", self.DEFAULT_CONFIG["model_a"])
+            group, model = "A", model_a
         else:
-            group = "B"
-            model = config.get("model_b", self.DEFAULT_CONFIG["model_b"])
+            group, model = "B", model_b
         
-        logger.info(f"[ExperimentService] 用户 {user_id} -> Group {group} ({model}), bucket={bucket}")
+        logger.debug("[ExperimentService] 用户 %s -> Group %s (%s), bucket=%d", user_id, group, model, bucket)
         return (group, model)
+    
+    def _get_routing(self) -> Tuple[bool, int, str, str]:
+        """返回路由参数，仅在配置对象变化 (首次加载 / 失效后重载) 时重新计算"""
+        config = self.get_config()
+        if config is not self._routing_config:
+            self._routing = (
+                config.get("enabled", True),
+                int(config.get("split_ratio", 0.5) * 100),
+                config.get("model_a", self.DEFAULT_CONFIG["model_a"]),
+                config.get("model_b", self.DEFAULT_CONFIG["model_b"]),
+            )
+            self._routing_config = config
+        return self._routing
 
 
 # 全局单例
@@ -9,17 +9,25 @@ Feature Store Service (Online Serving)
     需要 google-cloud-aiplatform SDK >= 1.38.0
 """
 
+import itertools
 import logging
-from typing import Dict, List, Optional, Any
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Any
 from google.cloud import aiplatform
 
 # Attempt to import Feature Service Client gracefully to prevent startup crashes
 FeatureOnlineStoreServingServiceClient = None
+FeatureOnlineStoreServingServiceGrpcTransport = None
 FeatureViewDataKey = None
 FetchFeatureValuesRequest = None
 
 try:
     from google.cloud.aiplatform_v1 import FeatureOnlineStoreServingServiceClient
+    from google.cloud.aiplatform_v1.services.feature_online_store_serving_service.transports import (
+        FeatureOnlineStoreServingServiceGrpcTransport
+    )
     from google.cloud.aiplatform_v1.types import (
         FeatureViewDataKey, 
         FetchFeatureValuesRequest
@@ -28,6 +36,9 @@ except ImportError:
     # Try alternative path or log error
     try:
         from google.cloud.aiplatform_v1.services.feature_online_store_serving_service import FeatureOnlineStoreServingServiceClient
+        from google.cloud.aiplatform_v1.services.feature_online_store_serving_service.transports.grpc import (
+            FeatureOnlineStoreServingServiceGrpcTransport
+        )
         from google.cloud.aiplatform_v1.types import FeatureViewDataKey, FetchFeatureValuesRequest
     except ImportError as e:
         logger = logging.getLogger(__name__)
@@ -38,6 +49,22 @@ from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# 单条 HTTP/2 连接约 100 个并发 stream 上限，高并发时轮询多条通道避免队头阻塞
+FEATURE_STORE_CHANNEL_POOL_SIZE = int(os.getenv("FEATURE_STORE_CHANNEL_POOL_SIZE", "8"))
+
+# 单次 FetchFeatureValues 的超时 (秒): 卡住的 RPC 不会无限占用 IO 线程；
+# 合并等待方按同一超时等待进行中的请求
+FEATURE_FETCH_TIMEOUT_S = float(os.getenv("FEATURE_FETCH_TIMEOUT_S", "2.0"))
+
+# FeatureValue 的 oneof "value" 分支 -> 取值函数 (其余类型如 bytes / 数组暂不使用，返回 None)
+_EXTRACTORS: Dict[str, Callable[[Any], Any]] = {
+    "int64_value": lambda v: v.int64_value,
+    "double_value": lambda v: v.double_value,
+    "string_value": lambda v: v.string_value,
+    "bool_value": lambda v: v.bool_value,
+}
+
+
 class FeatureStoreService:
     def __init__(self, project_id: str = settings.PROJECT_ID, location: str = "us-central1"):
         self.project_id = project_id
@@ -45,12 +72,56 @@ class FeatureStoreService:
         self.feature_online_store = "sentinel_online_store"
         self.feature_view = "user_realtime_view"
         
-        # 初始化客户端
-        client_options = {"api_endpoint": f"{location}-aiplatform.googleapis.com"}
-        self.client = FeatureOnlineStoreServingServiceClient(client_options=client_options)
+        # 初始化客户端池: 每个客户端独占一条 gRPC 通道，调用时轮询
+        api_endpoint = f"{location}-aiplatform.googleapis.com"
+        self._clients = [
+            self._create_client(api_endpoint) for _ in range(FEATURE_STORE_CHANNEL_POOL_SIZE)
+        ]
+        self._client_cycle = itertools.cycle(self._clients)
+        self.client = self._clients[0]
+        
+        # projects/{project}/locations/{location}/featureOnlineStores/{store}/featureViews/{view}
+        self.feature_view_resource = (
+            f"projects/{self.project_id}/locations/{self.location}/"
+            f"featureOnlineStores/{self.feature_online_store}/featureViews/{self.feature_view}"
+        )
+        
+        # 并发请求合并: 同一 user_id 的进行中读取 (Future) 由后到的调用方共享，不引入等待窗口
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
         
         logger.info(f"FeatureStoreService initialized for store: {self.feature_online_store}")
 
+    @staticmethod
+    def _create_client(api_endpoint: str) -> "FeatureOnlineStoreServingServiceClient":
+        # 本地 subchannel 池: 否则参数相同的通道会共享同一条底层 TCP 连接
+        channel = FeatureOnlineStoreServingServiceGrpcTransport.create_channel(
+            f"{api_endpoint}:443",
+            options=[
+                ("grpc.use_local_subchannel_pool", 1),
+                ("grpc.max_send_message_length", -1),
+                ("grpc.max_receive_message_length", -1),
+            ],
+        )
+        transport = FeatureOnlineStoreServingServiceGrpcTransport(host=api_endpoint, channel=channel)
+        return FeatureOnlineStoreServingServiceClient(transport=transport)
+
+    def warmup(self):
+        """
+        对池中每条 gRPC 通道发起一次探测请求，提前完成 TLS 与 ADC 令牌握手
+        (探测键不存在时返回 NotFound，属预期结果)
+        """
+        request = FetchFeatureValuesRequest(
+            feature_view=self.feature_view_resource,
+            data_key=FeatureViewDataKey(key="__warmup__")
+        )
+        for client in self._clients:
+            try:
+                client.fetch_feature_values(request=request)
+            except Exception:
+                pass
+        logger.info(f"FeatureStoreService warmed {len(self._clients)} channels")
+
     def get_online_features(self, user_id: str) -> Dict[str, Any]:
         """
         获取用户的实时特征 (Low Latency)
@@ -61,52 +132,58 @@ class FeatureStoreService:
         Returns:
             Dict: 特征键值对，例如 {"rage_clicks_5m": 2, "active_session_duration": 120.5}
         """
+        with self._inflight_lock:
+            future = self._inflight.get(user_id)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._inflight[user_id] = future
+        
         try:
-            # 构造请求路径
-            # projects/{project}/locations/{location}/featureOnlineStores/{store}/featureViews/{view}
-            feature_view_resource = (
-                f"projects/{self.project_id}/locations/{self.location}/"
-                f"featureOnlineStores/{self.feature_online_store}/featureViews/{self.feature_view}"
-            )
-            
-            # 构造数据键 (Entity ID)
-            data_key = FeatureViewDataKey(key=user_id)
-            
-            # 发起请求
-            request = FetchFeatureValuesRequest(
-                feature_view=feature_view_resource,
-                data_key=data_key,
-                data_format=FetchFeatureValuesRequest.FeatureViewDataFormat.KEY_VALUE
-            )
-            
-            # 同步调用 (FastAPI 可以用 run_in_executor 包装，或者使用异步 gRPC stub)
-            # 这里为简单起见使用同步调用，因为 Vertex SDK 主要是同步的
-            response = self.client.fetch_feature_values(request=request)
-            
-            # 解析结果
-            features = {}
-            if response.key_values:
-                for feature in response.key_values.features:
-                    # 根据类型转换值
-                    val = None
-                    if feature.value.HasField("int64_value"):
-                        val = feature.value.int64_value
-                    elif feature.value.HasField("double_value"):
-                        val = feature.value.double_value
-                    elif feature.value.HasField("string_value"):
-                        val = feature.value.string_value
-                    elif feature.value.HasField("bool_value"):
-                        val = feature.value.bool_value
-                        
-                    features[feature.name] = val
-            
-            return features
-            
+            if is_owner:
+                # 首个调用方在自身线程内直接发起 RPC (v1 每次只接受一个 data_key，无需攒批)
+                try:
+                    future.set_result(self._fetch_features(user_id))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    with self._inflight_lock:
+                        self._inflight.pop(user_id, None)
+            # 每个调用方拿到独立副本，互不影响
+            return dict(future.result(timeout=FEATURE_FETCH_TIMEOUT_S))
         except Exception as e:
             logger.error(f"Failed to fetch online features for user {user_id}: {e}")
             # 降级策略: 返回空特征，避免阻塞主流程
             return {}
 
+    def _fetch_features(self, user_id: str) -> Dict[str, Any]:
+        """单个 user_id 的 FetchFeatureValues 调用 (由 get_online_features 合并调度)"""
+        # 构造数据键 (Entity ID)
+        data_key = FeatureViewDataKey(key=user_id)
+        
+        # 发起请求
+        request = FetchFeatureValuesRequest(
+            feature_view=self.feature_view_resource,
+            data_key=data_key,
+            data_format=FetchFeatureValuesRequest.FeatureViewDataFormat.KEY_VALUE
+        )
+        
+        # 同步调用 (v1 FetchFeatureValues 每次只接受一个 data_key)
+        response = next(self._client_cycle).fetch_feature_values(
+            request=request, timeout=FEATURE_FETCH_TIMEOUT_S
+        )
+        
+        # 解析结果: 直接在底层 protobuf 上读取，避免 proto-plus 逐字段包装
+        raw = type(response).pb(response)
+        features = {}
+        if raw.HasField("key_values"):
+            for feature in raw.key_values.features:
+                # WhichOneof 一次确定值类型，再按类型取值
+                extractor = _EXTRACTORS.get(feature.value.WhichOneof("value"))
+                features[feature.name] = extractor(feature.value) if extractor else None
+        
+        return features
+
 # 单例实例
 _feature_store_service_instance = None
 
@@ -1,40 +1,38 @@
-import vertexai
 from vertexai.generative_models import GenerativeModel, GenerationConfig
-import json
+import orjson
 import logging
 from typing import Dict, List, Optional
 import os
+from app.services._clients import init_vertexai
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-class AIJudge:
-    def __init__(self, project_id: str = "sentinel-ai-project-482208", location: str = "us-central1"):
-        self.project_id = project_id
-        self.location = location
-        # Initialize Vertex AI
-        try:
-           vertexai.init(project=project_id, location=location)
-           self.model = GenerativeModel("gemini-2.5-pro") # Using 1.5 Pro for better reasoning
-           logger.info(f"AIJudge initialized with project {project_id} and model gemini-2.5-pro")
-        except Exception as e:
-            logger.error(f"Failed to initialize Vertex AI for AIJudge: {e}")
-            raise
+# 用户画像可能含非字符串键或 numpy 数值 (来自预测服务)
+_PROMPT_JSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
 
-    def evaluate_response(self, user_profile: Dict, generated_email: str, applied_policies: List[str]) -> Dict:
-        """
-        Evaluates the generated email against strict criteria using Gemini.
-        """
-        
-        prompt = f"""
+# 审计结果的结构化输出约束: 模型保证返回合法 JSON，无需再剥离 Markdown 代码块
+AUDIT_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "score": {"type": "INTEGER"},
+        "reasoning": {"type": "STRING"},
+        "flags": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["score", "reasoning", "flags"],
+}
+
+class AIJudge:
+    # 审计提示词模板 (类级别常量，每次调用只做三处替换)
+    _PROMPT_TEMPLATE = """
         你是一名严苛的企业合规审计员 (AI Judge)。请根据以下标准对生成的客户挽留邮件进行评分 (0-100) 和点评。
 
         ### 输入信息
-        1. **用户画像**: {json.dumps(user_profile, ensure_ascii=False)}
-        2. **应用策略**: {json.dumps(applied_policies, ensure_ascii=False)}
+        1. **用户画像**: {user_profile}
+        2. **应用策略**: {policies}
         3. **生成邮件内容**:
         \"\"\"
-        {generated_email}
+        {email}
         \"\"\"
 
         ### 评分标准
@@ -43,41 +41,94 @@ class AIJudge:
         3. **逻辑性 (Logic)**: 邮件内容是否与用户画像矛盾？(例如给仅浏览用户发送“感谢购买”是不合逻辑的)
 
         ### 输出要求
-        请只输出纯 JSON 格式，不要包含 Markdown 标记 (```json ... ```)。字段如下：
+        请输出 JSON，字段如下：
         - `score` (int): 0-100 分。
         - `reasoning` (str): 简短犀利的点评 (中文)，指出扣分点或做得好的地方。
         - `flags` (list[str]): 发现的严重问题标签，如 ["HALLUCINATION", "LOGIC_ERROR"]，如果没有则为空列表。
         """
 
-        generation_config = GenerationConfig(
-            temperature=0.2, # Low temperature for more deterministic evaluation
-            top_p=0.95,
-            response_mime_type="application/json"
+    def __init__(self, project_id: str = "sentinel-ai-project-482208", location: str = "us-central1"):
+        self.project_id = project_id
+        self.location = location
+        # Initialize Vertex AI
+        try:
+           init_vertexai(project_id, location)
+           self.model = GenerativeModel("gemini-2.5-pro") # Using 1.5 Pro for better reasoning
+           self.generation_config = GenerationConfig(
+               temperature=0.2, # Low temperature for more deterministic evaluation
+               top_p=0.95,
+               response_mime_type="application/json",
+               response_schema=AUDIT_RESPONSE_SCHEMA
+           )
+           logger.info(f"AIJudge initialized with project {project_id} and model gemini-2.5-pro")
+        except Exception as e:
+            logger.error(f"Failed to initialize Vertex AI for AIJudge: {e}")
+            raise
+
+    def warmup(self):
+        """
+        Warms the Gemini channel and credentials with a count_tokens call (no generation cost).
+        """
+        try:
+            self.model.count_tokens("ping")
+        except Exception as e:
+            logger.warning(f"AIJudge warmup failed: {e}")
+
+    def _build_prompt(self, user_profile: Dict, generated_email: str, applied_policies: List[str]) -> str:
+        return self._PROMPT_TEMPLATE.format(
+            user_profile=orjson.dumps(user_profile, option=_PROMPT_JSON_OPTS).decode(),
+            policies=orjson.dumps(applied_policies, option=_PROMPT_JSON_OPTS).decode(),
+            email=generated_email
         )
 
+    @staticmethod
+    def _error_result(e: Exception) -> Dict:
+        # Return a fallback/error result so the flow doesn't crash
+        return {
+            "score": 0,
+            "reasoning": f"Audit process failed: {str(e)}",
+            "flags": ["SYSTEM_ERROR"]
+        }
+
+    def evaluate_response(self, user_profile: Dict, generated_email: str, applied_policies: List[str]) -> Dict:
+        """
+        Evaluates the generated email against strict criteria using Gemini.
+        """
+        
+        prompt = self._build_prompt(user_profile, generated_email, applied_policies)
+
         try:
             logger.info("Sending audit request to Gemini...")
             response = self.model.generate_content(
                 prompt,
-                generation_config=generation_config
+                generation_config=self.generation_config
             )
             
-            response_text = response.text.strip()
-            # Remove markdown code blocks if present, just in case
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
+            audit_result = orjson.loads(response.text)
+            logger.info(f"Audit complete. Score: {audit_result.get('score')}")
+            return audit_result
+
+        except Exception as e:
+            logger.error(f"Error during AI audit: {e}")
+            return self._error_result(e)
+
+    async def aevaluate_response(self, user_profile: Dict, generated_email: str, applied_policies: List[str]) -> Dict:
+        """
+        Async variant of evaluate_response (generate_content_async); no thread is held while Gemini responds.
+        """
+        prompt = self._build_prompt(user_profile, generated_email, applied_policies)
+
+        try:
+            logger.info("Sending audit request to Gemini...")
+            response = await self.model.generate_content_async(
+                prompt,
+                generation_config=self.generation_config
+            )
             
-            audit_result = json.loads(response_text)
+            audit_result = orjson.loads(response.text)
             logger.info(f"Audit complete. Score: {audit_result.get('score')}")
             return audit_result
 
         except Exception as e:
             logger.error(f"Error during AI audit: {e}")
-            # Return a fallback/error result so the flow doesn't crash
-            return {
-                "score": 0,
-                "reasoning": f"Audit process failed: {str(e)}",
-                "flags": ["SYSTEM_ERROR"]
-            }
+            return self._error_result(e)
@@ -4,14 +4,308 @@ LLM Service - 企业级 Gemini 大模型服务
 包含 OpenTelemetry 手动埋点，用于 Google Cloud Trace 可视化。
 """
 
-import vertexai
-from vertexai.generative_models import GenerativeModel, Image, Part
+import asyncio
+import hashlib
+import orjson
+import logging
+import math
+import string
+import threading
+import time
+from dataclasses import dataclass
+from cachetools import LRUCache
+from functools import cached_property, lru_cache
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Image, Part
 from vertexai.language_models import TextEmbeddingModel
 from app.core.telemetry import get_tracer
+from app.core.config import settings
+from app.services._clients import gcs_client, init_vertexai
+from app.core.embedding_cache import EmbeddingCache
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
 import os
 
 # 获取 Tracer 实例
 tracer = get_tracer()
+logger = logging.getLogger(__name__)
+
+# 错误日志限流: 同一错误消息每 10 秒最多记录一次 (Gemini 故障期间避免日志风暴)
+ERROR_LOG_INTERVAL_S = 10.0
+# Span 上 error.message 的最大长度 (Gemini 错误体可能很大)
+SPAN_ERROR_MESSAGE_MAX_LEN = 200
+_error_log_times = LRUCache(maxsize=1024)
+_error_log_lock = threading.Lock()
+
+# 单次 get_embeddings 的最大文本数 (text-embedding-004 单请求上限 250 条 / 20k tokens)
+EMBEDDING_BATCH_SIZE = min(int(os.getenv("EMBEDDING_BATCH_SIZE", "64")), 250)
+EMBEDDING_BATCH_WAIT_S = 0.02
+
+# 挽留邮件生成的固定系统指令: 作为 system_instruction 绑定在模型上 (每个模型只构建一次)，
+# 每次请求的内容仅包含客户画像与政策，请求前缀稳定，可命中 Gemini 隐式上下文缓存
+EMAIL_SYSTEM_PROMPT = """
+        你是一个高级客户关系专家 (SentinEL)。你的目标是根据数据和公司政策挽留高价值客户。
+        严禁编造优惠政策，必须基于工具检索到的信息。
+        语气要诚恳、专业且具有个性化。
+        
+        【重要输出指令】
+        1. 仅输出邮件正文内容。
+        2. 不要包含任何开场白（如"好的，这是邮件..."）或结束语。
+        3. 不要包含 "Subject:" 主题行。
+        4. 直接以称呼（如"Dear..."）开始。
+
+        【多模态指令】
+        如果提供了图片，那通常是用户上传的"竞争对手优惠/广告"或"客户投诉截图"。
+        请先敏锐地分析图片中的关键信息（如通过图片看出对手提供了50%折扣，或客户在投诉物流）。
+        并在生成的邮件中，针对性地回应这些视觉信息（例如："我们可以匹配该折扣"或"针对您提到的物流问题..."），但不要直接说"我看你传的图片..."，要自然融入。
+        """
+
+# 挽留邮件的用户提示词模板 (模块加载时解析一次，每次请求只替换变量槽位)
+# 仅包含邮件缓存键中的画像字段 (国家/来源/消费量级/政策): 生成结果可在同一键的客户间安全复用，
+# 不会把某位客户的 ID 或精确消费额带给另一位客户
+_USER_PROMPT_TMPL = string.Template("""
+        客户画像:
+        - 国家: $country
+        - 来源: $traffic_source
+        - 过去90天消费区间: $spend_range
+
+        检索到的公司挽留政策:
+        $policies
+
+        任务:
+        请为该客户起草一封挽留邮件。
+        1. 针对其具体情况（如高消费、地区等）进行个性化问候。
+        2. 巧妙地提供上述政策中适用的权益。
+        3. 保持简短有力。
+        """)
+
+# 挽留邮件微批: 窗口内并发到达的 (无图片) 请求合并为一次多客户提示词调用，
+# 系统指令与任务说明只发送一次，同时减少对 Gemini RPM 配额的占用
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "8"))
+EMAIL_BATCH_WAIT_S = 0.05
+EMAIL_MAX_OUTPUT_TOKENS = 600
+
+_BATCH_EMAIL_TASK_TMPL = string.Template("""
+        以上共 $count 位客户。请分别为每位客户完成其“任务”部分要求的挽留邮件，各邮件相互独立。
+        输出 JSON 数组，每位客户一项: index 为客户编号，email 为该客户的邮件正文。
+        """)
+
+BATCH_EMAIL_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "index": {"type": "INTEGER"},
+            "email": {"type": "STRING"},
+        },
+        "required": ["index", "email"],
+    },
+}
+
+# 挽留邮件缓存: 画像键 (国家/来源/消费量级/策略) 完全相同的客户复用已生成的邮件
+EMAIL_CACHE_CAPACITY = int(os.getenv("EMAIL_CACHE_CAPACITY", "1024"))
+
+# 已上传图片: 内容哈希 -> gs:// URI (同一张竞品截图只上传一次)
+IMAGE_URI_CACHE_SIZE = 1024
+
+# 进程内查询向量 LRU (命中时跳过 LMDB 读取与微批等待窗口)
+EMBEDDING_LRU_SIZE = 10_000
+
+# 图片格式 -> 文件扩展名 (上传对象名使用)
+_IMAGE_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp"}
+
+
+def _record_error(span, operation: str, error: Exception, model: str):
+    """在 Span 上标记截断后的错误信息，并按消息限流输出带堆栈的错误日志"""
+    message = str(error)
+    span.set_attribute("error", True)
+    span.set_attribute("error.message", message[:SPAN_ERROR_MESSAGE_MAX_LEN])
+    
+    key = (operation, message)
+    now = time.monotonic()
+    with _error_log_lock:
+        last = _error_log_times.get(key)
+        if last is not None and now - last < ERROR_LOG_INTERVAL_S:
+            return
+        _error_log_times[key] = now
+    logger.exception(f"Error {operation}: {message}", extra={"model": model})
+
+
+def _sniff_mime(data: bytes) -> str:
+    """根据文件头魔数识别图片格式，无法识别时按 JPEG 处理"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def spend_tier(spend) -> int:
+    """
+    消费额 log10 分层 (0: <$9, 1: $9-$99, 2: $99-$999, ...)
+
+    RAG 查询文本与邮件缓存键共用该分层，保证同一客户在两处落入同一档
+    """
+    return int(math.log10(spend + 1)) if spend and spend > 0 else 0
+
+
+@dataclass(slots=True, frozen=True)
+class UserContext:
+    """
+    邮件生成所需的用户上下文 (由编排器从画像字典构建一次)
+    
+    frozen + slots: 字段访问无需字典查找，且可作为缓存键 (可哈希)
+    """
+    user_id: str
+    country: str
+    source: str
+    spend: float
+    churn_prob: float
+    
+    @classmethod
+    def from_profile(cls, profile: dict) -> "UserContext":
+        features = profile.get("features", {})
+        return cls(
+            user_id=str(profile.get("user_id", "Unknown")),
+            country=str(features.get("country", "Unknown")),
+            source=str(features.get("traffic_source", "Unknown")),
+            spend=features.get("monetary_90d") or 0,
+            churn_prob=profile.get("churn_probability", 0.0),
+        )
+    
+    @property
+    def spend_bucket(self) -> int:
+        """消费额 log10 分桶"""
+        return spend_tier(self.spend)
+    
+    @property
+    def spend_range(self) -> str:
+        """spend_bucket 对应的消费区间 (提示词中代替精确消费额)"""
+        bucket = self.spend_bucket
+        low = 10 ** bucket - 1 if bucket else 0
+        return f"${low:,} - ${10 ** (bucket + 1) - 1:,}"
+
+
+class EmailBatcher:
+    """
+    挽留邮件微批处理器
+    
+    将 max_wait_s (默认 50ms) 窗口内并发到达的邮件请求按模型分组，每组交给
+    generate_batch 一次生成；积累满 max_batch 条时立即发送。
+    """
+    
+    def __init__(
+        self,
+        generate_batch: Callable[[str, List[Tuple["UserContext", List[str]]]], Awaitable[List[str]]],
+        max_batch: int = EMAIL_BATCH_SIZE,
+        max_wait_s: float = EMAIL_BATCH_WAIT_S
+    ):
+        self._generate_batch = generate_batch
+        self._max_batch = max_batch
+        self._max_wait_s = max_wait_s
+        self._pending: List[Tuple[str, "UserContext", List[str], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()  # 持有批处理任务引用，防止被 GC
+    
+    async def submit(self, ctx: "UserContext", policies: List[str], model_name: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((model_name, ctx, policies, future))
+        
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait_s, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        groups: dict = {}
+        for model_name, ctx, policies, future in batch:
+            if not future.done():
+                groups.setdefault(model_name, []).append((ctx, policies, future))
+        loop = asyncio.get_running_loop()
+        for model_name, items in groups.items():
+            task = loop.create_task(self._run(model_name, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, model_name: str, items: List[Tuple["UserContext", List[str], asyncio.Future]]):
+        try:
+            emails = await self._generate_batch(model_name, [(ctx, policies) for ctx, policies, _ in items])
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), email in zip(items, emails):
+            if not future.done():
+                future.set_result(email)
+
+
+class EmbeddingBatcher:
+    """
+    文本向量微批处理器
+    
+    将 max_wait_s (默认 20ms) 窗口内并发到达的 embedding 请求合并为一次
+    get_embeddings 调用，N 次往返变为 1 次。积累满 max_batch 条时立即发送。
+    """
+    
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], List[List[float]]],
+        max_batch: int = EMBEDDING_BATCH_SIZE,
+        max_wait_s: float = EMBEDDING_BATCH_WAIT_S
+    ):
+        self._embed_batch = embed_batch
+        self._max_batch = max_batch
+        self._max_wait_s = max_wait_s
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()  # 持有批处理任务引用，防止被 GC
+    
+    async def submit(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait_s, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        live = [item for item in batch if not item[1].done()]
+        if not live:
+            return
+        try:
+            # Vertex 文本向量 SDK 没有原生异步接口，在线程中执行
+            vectors = await asyncio.to_thread(self._embed_batch, [text for text, _ in live])
+        except Exception as e:
+            for _, future in live:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(live, vectors):
+            if not future.done():
+                future.set_result(vector)
 
 
 class LLMService:
@@ -20,43 +314,75 @@ class LLMService:
         self.project_id = "sentinel-ai-project-482208"
         self.location = "us-central1"
         
-        # Initialize Vertex AI
-        vertexai.init(project=self.project_id, location=self.location)
+        # Initialize Vertex AI (进程内只初始化一次)
+        init_vertexai(self.project_id, self.location)
         
         # Model Configuration
-        self.llm_model_name = "gemini-2.5-pro"  # 通用模型 (用于邮件生成等复杂任务)
-        self.embedding_model_name = "text-embedding-004"
+        self.llm_model_name = os.getenv("SENTINEL_LLM_MODEL", "gemini-2.5-pro")  # 通用模型 (用于邮件生成等复杂任务)
+        self.embedding_model_name = os.getenv("SENTINEL_EMBED_MODEL", "text-embedding-004")
         
         # ====== 微调模型配置 (Sentinel 专属) ======
         # 训练于: 2025-12-25, 基于 gemini-2.0-flash-001
         # 用途: 简单问答、快速分析 (不支持 system prompt)
         self.tuned_model_id = "projects/672705370432/locations/us-central1/models/5869006152091156608@1"
-        self.use_tuned_model = os.getenv("USE_TUNED_MODEL", "true").lower() == "true"
+        self.use_tuned_model = os.getenv("SENTINEL_USE_TUNED", os.getenv("USE_TUNED_MODEL", "true")).lower() == "true"
         # ==========================================
+        # 通用模型 / 微调模型 / 向量模型均在首次使用时加载 (见下方 cached_property)
         
-        # 始终初始化通用模型 (用于复杂的邮件生成任务)
-        self.general_model = GenerativeModel(self.llm_model_name)
+        # RAG 查询文本来自有限的用户画像组合，向量持久化后重启无需重新计算
+        self.embedding_cache = EmbeddingCache(namespace=self.embedding_model_name)
+        # 并发请求的 embedding 合并为批量调用 (aget_text_embedding 使用)
+        self.embedding_batcher = EmbeddingBatcher(self.get_text_embeddings)
+        self._embedding_lru = LRUCache(maxsize=EMBEDDING_LRU_SIZE)
+        self._embedding_lru_lock = threading.Lock()
+        self._email_models: dict[str, GenerativeModel] = {}
+        self._email_cache = LRUCache(maxsize=EMAIL_CACHE_CAPACITY)
+        self._email_cache_lock = threading.Lock()
+        self.email_batcher = EmailBatcher(self._agenerate_email_batch)
+        self._image_uris = LRUCache(maxsize=IMAGE_URI_CACHE_SIZE)
+        self._image_uris_lock = threading.Lock()
+
+    @cached_property
+    def general_model(self) -> GenerativeModel:
+        """通用模型 (用于复杂的邮件生成任务)"""
+        model = GenerativeModel(self.llm_model_name)
         print(f"ℹ️ 通用模型已加载: {self.llm_model_name}")
-        
-        # 初始化微调模型 (用于简单任务)
-        if self.use_tuned_model:
-            try:
-                self.tuned_model = GenerativeModel(self.tuned_model_id)
-                self.active_model_name = "sentinel-tuned-gemini"
-                print(f"✅ 已加载 Sentinel 微调模型: {self.tuned_model_id}")
-            except Exception as e:
-                print(f"⚠️ 微调模型加载失败: {e}")
-                self.tuned_model = None
-                self.active_model_name = self.llm_model_name
-        else:
-            self.tuned_model = None
-            self.active_model_name = self.llm_model_name
+        return model
+
+    @cached_property
+    def tuned_model(self) -> Optional[GenerativeModel]:
+        """微调模型 (用于简单任务)，禁用或加载失败时为 None"""
+        if not self.use_tuned_model:
             print(f"ℹ️ 微调模型已禁用")
-        
+            return None
+        try:
+            model = GenerativeModel(self.tuned_model_id)
+            print(f"✅ 已加载 Sentinel 微调模型: {self.tuned_model_id}")
+            return model
+        except Exception as e:
+            print(f"⚠️ 微调模型加载失败: {e}")
+            return None
+
+    @property
+    def generative_model(self) -> GenerativeModel:
         # 保持向后兼容 - generative_model 指向通用模型
-        self.generative_model = self.general_model
-        
-        self.embedding_model = TextEmbeddingModel.from_pretrained(self.embedding_model_name)
+        return self.general_model
+
+    @property
+    def active_model_name(self) -> str:
+        return "sentinel-tuned-gemini" if self.tuned_model is not None else self.llm_model_name
+
+    @cached_property
+    def embedding_model(self) -> TextEmbeddingModel:
+        return TextEmbeddingModel.from_pretrained(self.embedding_model_name)
+
+    # 低复杂度任务: 交给微调 flash 模型 (更快更便宜)，复杂生成保留通用 pro 模型
+    _SIMPLE_TASKS = frozenset({"script", "classify", "short_summary"})
+
+    def _pick_model(self, task: str) -> GenerativeModel:
+        if task in self._SIMPLE_TASKS and self.tuned_model is not None:
+            return self.tuned_model
+        return self.general_model
 
     def get_text_embedding(self, text: str) -> list[float]:
         """
@@ -71,22 +397,161 @@ class LLMService:
             span.set_attribute("input.text_length", len(text))
             
             try:
-                embeddings = self.embedding_model.get_embeddings([text])
-                result = embeddings[0].values
+                result = self.embedding_cache.get(text)
+                span.set_attribute("cache.hit", result is not None)
+                if result is None:
+                    embeddings = self.embedding_model.get_embeddings([text])
+                    result = embeddings[0].values
+                    self.embedding_cache.put(text, result)
                 
                 # 记录结果到 Span
                 span.set_attribute("output.dimensions", len(result))
                 
                 return result
             except Exception as e:
-                span.set_attribute("error", True)
-                span.set_attribute("error.message", str(e))
-                print(f"Error generating embedding: {e}")
+                _record_error(span, "generating embedding", e, self.embedding_model_name)
+                raise e
+
+    def get_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """
+        批量生成文本向量: 先查持久化缓存，未命中的去重后一次 get_embeddings 调用。
+        
+        Trace Span: "Vertex AI: Text Embedding Batch"
+        """
+        with tracer.start_as_current_span("Vertex AI: Text Embedding Batch") as span:
+            span.set_attribute("ai.model", self.embedding_model_name)
+            span.set_attribute("ai.provider", "vertex_ai")
+            span.set_attribute("input.batch_size", len(texts))
+            
+            try:
+                vectors = {}
+                for text in texts:
+                    if text not in vectors:
+                        vectors[text] = self.embedding_cache.get(text)
+                misses = [text for text, vector in vectors.items() if vector is None]
+                span.set_attribute("cache.misses", len(misses))
+                
+                # 按单请求上限分块调用 get_embeddings
+                for i in range(0, len(misses), EMBEDDING_BATCH_SIZE):
+                    chunk = misses[i:i + EMBEDDING_BATCH_SIZE]
+                    embeddings = self.embedding_model.get_embeddings(chunk)
+                    for text, embedding in zip(chunk, embeddings):
+                        vectors[text] = embedding.values
+                        self.embedding_cache.put(text, embedding.values)
+                
+                return [vectors[text] for text in texts]
+            except Exception as e:
+                _record_error(span, "generating embeddings", e, self.embedding_model_name)
                 raise e
 
+    async def aget_text_embedding(self, text: str) -> list[float]:
+        """
+        get_text_embedding 的异步版本
+        
+        文本规范化 (去首尾空白、小写) 后先查进程内 LRU；未命中时经由 EmbeddingBatcher
+        与同一时间窗口内的其他请求合并为一次批量调用。
+        """
+        text = text.strip().lower()
+        with self._embedding_lru_lock:
+            vector = self._embedding_lru.get(text)
+        if vector is not None:
+            return vector
+        vector = await self.embedding_batcher.submit(text)
+        with self._embedding_lru_lock:
+            self._embedding_lru[text] = vector
+        return vector
+
+    def _get_email_model(self, model_name: str) -> GenerativeModel:
+        """按模型名缓存带邮件系统指令的 GenerativeModel，避免每次请求重新构建"""
+        model = self._email_models.get(model_name)
+        if model is None:
+            model = GenerativeModel(model_name, system_instruction=EMAIL_SYSTEM_PROMPT)
+            self._email_models[model_name] = model
+        return model
+
+    def _upload_image_once(self, image_bytes: bytes, mime_type: str) -> str:
+        """
+        按内容哈希上传图片到 GCS 并返回 gs:// URI；已上传过的图片 (本进程或其他实例) 不重复上传
+        """
+        digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        with self._image_uris_lock:
+            uri = self._image_uris.get(digest)
+        if uri is not None:
+            return uri
+        
+        object_name = f"{digest}.{_IMAGE_EXTENSIONS[mime_type]}"
+        blob = gcs_client().bucket(settings.IMAGE_UPLOAD_BUCKET).blob(object_name)
+        if not blob.exists():
+            blob.upload_from_string(image_bytes, content_type=mime_type)
+        uri = f"gs://{settings.IMAGE_UPLOAD_BUCKET}/{object_name}"
+        with self._image_uris_lock:
+            self._image_uris[digest] = uri
+        return uri
+
+    def _image_part(self, image_bytes: bytes) -> Part:
+        """图片以 GCS URI 传给 Gemini (请求体不再内联图片字节)；上传失败时回退为内联数据"""
+        mime_type = _sniff_mime(image_bytes)
+        try:
+            return Part.from_uri(self._upload_image_once(image_bytes, mime_type), mime_type=mime_type)
+        except Exception as e:
+            logger.warning(f"Image upload failed, sending inline: {e}")
+            return Part.from_data(data=image_bytes, mime_type=mime_type)
+
+    @staticmethod
+    def _user_prompt(ctx: UserContext, policies: list[str]) -> str:
+        return _USER_PROMPT_TMPL.substitute(
+            country=ctx.country,
+            traffic_source=ctx.source,
+            spend_range=ctx.spend_range,
+            policies="\n".join([f"- {p}" for p in policies])
+        )
+
+    def _prepare_email_request(
+        self,
+        span,
+        ctx: UserContext,
+        policies: list[str],
+        image_part: Optional[Part] = None,
+        model_name: str = None
+    ):
+        """
+        构建邮件生成请求 (同步 / 异步入口共用)，返回 (model, inputs, generation_config)
+        """
+        # 动态选择模型 (A/B 测试支持)
+        actual_model_name = model_name or self.llm_model_name
+        active_model = self._get_email_model(actual_model_name)
+        
+        span.set_attribute("ai.model", actual_model_name)
+        span.set_attribute("ai.provider", "vertex_ai")
+        span.set_attribute("input.policies_count", len(policies))
+        span.set_attribute("input.has_image", image_part is not None)
+        
+        span.set_attribute("user.id", ctx.user_id)
+        span.set_attribute("user.churn_probability", ctx.churn_prob)
+        
+        generation_config = {
+            "temperature": 0.7,
+            "max_output_tokens": EMAIL_MAX_OUTPUT_TOKENS, # Increased for detailed analysis
+        }
+        
+        inputs = [self._user_prompt(ctx, policies)]
+        
+        # 如果有图片，加入到输入中
+        if image_part is not None:
+            print("Processing image for Vision API...")
+            inputs.append(image_part)
+            inputs.append("请参考上述图片中的竞争对手信息或问题进行针对性回复。")
+        
+        return active_model, inputs, generation_config
+
+    @staticmethod
+    def _email_cache_key(ctx: UserContext, policies: list[str]) -> tuple:
+        """邮件缓存键: 与 _user_prompt 使用的字段一致 (消费额按 log10 分桶)"""
+        return (ctx.country, ctx.source, ctx.spend_bucket, tuple(sorted(policies)))
+
     def generate_retention_email(
         self, 
-        user_profile: dict, 
+        ctx: UserContext, 
         policies: list[str], 
         image_bytes: bytes = None,
         model_name: str = None
@@ -96,7 +561,7 @@ class LLMService:
         支持多模态输入 (Competitor Image Analysis) 和 A/B 测试动态模型。
         
         Args:
-            user_profile: 用户画像
+            ctx: 用户上下文 (UserContext.from_profile 构建)
             policies: 挽留政策列表
             image_bytes: 可选的图片数据
             model_name: 可选的模型名称 (A/B 测试用)
@@ -105,78 +570,11 @@ class LLMService:
         """
         # 创建追踪 Span
         with tracer.start_as_current_span("Gemini: Generate Email") as span:
-            # 动态选择模型 (A/B 测试支持)
-            if model_name:
-                active_model = GenerativeModel(model_name)
-                actual_model_name = model_name
-            else:
-                active_model = self.generative_model
-                actual_model_name = self.llm_model_name
-            
-            span.set_attribute("ai.model", actual_model_name)
-            span.set_attribute("ai.provider", "vertex_ai")
-            span.set_attribute("input.policies_count", len(policies))
-            span.set_attribute("input.has_image", image_bytes is not None)
-            
-            feature_context = user_profile.get("features", {})
-            user_id = user_profile.get("user_id", "Unknown")
-            churn_prob = user_profile.get("churn_probability", 0.0)
-            
-            span.set_attribute("user.id", user_id)
-            span.set_attribute("user.churn_probability", churn_prob)
-            
-            system_prompt = """
-            你是一个高级客户关系专家 (SentinEL)。你的目标是根据数据和公司政策挽留高价值客户。
-            严禁编造优惠政策，必须基于工具检索到的信息。
-            语气要诚恳、专业且具有个性化。
-            
-            【重要输出指令】
-            1. 仅输出邮件正文内容。
-            2. 不要包含任何开场白（如"好的，这是邮件..."）或结束语。
-            3. 不要包含 "Subject:" 主题行。
-            4. 直接以称呼（如"Dear..."）开始。
-
-            【多模态指令】
-            如果提供了图片，那通常是用户上传的"竞争对手优惠/广告"或"客户投诉截图"。
-            请先敏锐地分析图片中的关键信息（如通过图片看出对手提供了50%折扣，或客户在投诉物流）。
-            并在生成的邮件中，针对性地回应这些视觉信息（例如："我们可以匹配该折扣"或"针对您提到的物流问题..."），但不要直接说"我看你传的图片..."，要自然融入。
-            """
-            
-            policies_text = "\n".join([f"- {p}" for p in policies])
-            
-            user_prompt = f"""
-            客户画像:
-            - ID: {user_id}
-            - 国家: {feature_context.get('country', 'Unknown')}
-            - 来源: {feature_context.get('traffic_source', 'Unknown')}
-            - 过去90天消费: {feature_context.get('monetary_90d', 0)}
-            - 风险概率: {churn_prob:.2f}
-
-            检索到的公司挽留政策:
-            {policies_text}
-
-            任务:
-            请为该客户起草一封挽留邮件。
-            1. 针对其具体情况（如高消费、地区等）进行个性化问候。
-            2. 巧妙地提供上述政策中适用的权益。
-            3. 保持简短有力。
-            """
-            
-            generation_config = {
-                "temperature": 0.7,
-                "max_output_tokens": 600, # Increased for detailed analysis
-            }
-            
             try:
-                inputs = [system_prompt, user_prompt]
-                
-                # 如果有图片，加入到输入中
-                if image_bytes:
-                    print("Processing image for Vision API...")
-                    image_part = Part.from_data(data=image_bytes, mime_type="image/jpeg") # Default to jpeg, robust enough
-                    inputs.append(image_part)
-                    inputs.append("请参考上述图片中的竞争对手信息或问题进行针对性回复。")
-
+                image_part = self._image_part(image_bytes) if image_bytes else None
+                active_model, inputs, generation_config = self._prepare_email_request(
+                    span, ctx, policies, image_part, model_name
+                )
                 response = active_model.generate_content(
                     inputs,
                     generation_config=generation_config
@@ -188,18 +586,60 @@ class LLMService:
                 
                 return result
             except Exception as e:
-                span.set_attribute("error", True)
-                span.set_attribute("error.message", str(e))
-                print(f"Error generating email: {e}")
+                _record_error(span, "generating email", e, model_name or self.llm_model_name)
                 return "Unable to generate email at this time due to system error."
 
-    def generate_call_script(self, email_content: str) -> str:
+    async def agenerate_retention_email(
+        self, 
+        ctx: UserContext, 
+        policies: list[str], 
+        image_bytes: bytes = None,
+        model_name: str = None
+    ) -> str:
         """
-        基于生成的邮件内容，提炼一段简短的电话留言脚本 (Voicemail Script)。
-        风格：亲切、口语化。
+        generate_retention_email 的异步版本 (generate_content_async)，
+        等待 Gemini 响应期间不占用线程，事件循环可并发处理其他请求。
+        
+        不带图片的请求先查邮件缓存: 画像键 (且模型) 完全相同时直接复用邮件，跳过 Gemini 调用；
+        未命中时经 EmailBatcher 与并发请求合并生成。
+        带图片的邮件针对具体截图，不参与缓存与合并，单独流式生成。
+        
+        Trace Span: "Gemini: Generate Email"
         """
-        with tracer.start_as_current_span("Gemini: Generate Script") as span:
-             prompt = f"""
+        with tracer.start_as_current_span("Gemini: Generate Email") as span:
+            try:
+                cache_key = None
+                cache_tag = model_name or self.llm_model_name
+                if image_bytes is None:
+                    cache_key = (cache_tag, self._email_cache_key(ctx, policies))
+                    with self._email_cache_lock:
+                        cached = self._email_cache.get(cache_key)
+                    span.set_attribute("cache.hit", cached is not None)
+                    if cached is not None:
+                        return cached
+                
+                if image_bytes is None:
+                    # 无图片请求经微批处理器与同一窗口内的其他客户合并生成
+                    result = await self.email_batcher.submit(ctx, policies, cache_tag)
+                else:
+                    image_part = await asyncio.to_thread(self._image_part, image_bytes)
+                    result = await self._astream_email(span, ctx, policies, image_part, cache_tag)
+                
+                span.set_attribute("output.text_length", len(result))
+                
+                if cache_key is not None:
+                    with self._email_cache_lock:
+                        self._email_cache[cache_key] = result
+                return result
+            except Exception as e:
+                _record_error(span, "generating email", e, model_name or self.llm_model_name)
+                return "Unable to generate email at this time due to system error."
+
+    _CALL_SCRIPT_FALLBACK = "Hi, this is your account manager from SentinEL. We noticed you haven't been active lately and have a special offer for you. Please check your email!"
+
+    @staticmethod
+    def _call_script_prompt(email_content: str) -> str:
+        return f"""
              Based on the following retention email, verify create a SHORT, CASUAL voicemail script (max 50 words).
              It should sound like a friendly account manager leaving a message.
              Do not include "Subject:" or placeholders. Just the spoken script.
@@ -207,11 +647,129 @@ class LLMService:
              Email Context:
              {email_content}
              """
+
+    async def _astream_email(
+        self,
+        span,
+        ctx: UserContext,
+        policies: list[str],
+        image_part: Optional[Part],
+        model_name: str
+    ) -> str:
+        """单客户邮件: 流式接收，首个 token 到达时间记录到 Span (TTFT)，各分块到达即拼接"""
+        active_model, inputs, generation_config = self._prepare_email_request(
+            span, ctx, policies, image_part, model_name
+        )
+        stream = await active_model.generate_content_async(
+            inputs,
+            generation_config=generation_config,
+            stream=True
+        )
+        chunks = []
+        async for chunk in stream:
+            if not chunks:
+                span.add_event("first_token")
+            chunks.append(chunk.text)
+        return "".join(chunks)
+
+    async def _agenerate_email_single(self, ctx: UserContext, policies: list[str], model_name: str) -> str:
+        with tracer.start_as_current_span("Gemini: Generate Email Single") as span:
+            return await self._astream_email(span, ctx, policies, None, model_name)
+
+    async def _agenerate_email_batch(self, model_name: str, items: list[tuple]) -> list[str]:
+        """
+        EmailBatcher 的批量生成: 多位客户的提示词拼接为一次调用，按 JSON 结构化输出逐项取回。
+        单条请求或解析失败 (缺项/空邮件) 的客户回退为单独生成。
+        
+        Trace Span: "Gemini: Generate Email Batch"
+        """
+        if len(items) == 1:
+            ctx, policies = items[0]
+            return [await self._agenerate_email_single(ctx, policies, model_name)]
+        
+        with tracer.start_as_current_span("Gemini: Generate Email Batch") as span:
+            span.set_attribute("ai.model", model_name)
+            span.set_attribute("input.batch_size", len(items))
+            
+            sections = [
+                f"### 客户 {i}\n{self._user_prompt(ctx, policies)}"
+                for i, (ctx, policies) in enumerate(items, start=1)
+            ]
+            sections.append(_BATCH_EMAIL_TASK_TMPL.substitute(count=len(items)))
+            
+            emails: dict = {}
+            try:
+                response = await self._get_email_model(model_name).generate_content_async(
+                    "\n".join(sections),
+                    generation_config=GenerationConfig(
+                        temperature=0.7,
+                        max_output_tokens=EMAIL_MAX_OUTPUT_TOKENS * len(items),
+                        response_mime_type="application/json",
+                        response_schema=BATCH_EMAIL_RESPONSE_SCHEMA
+                    )
+                )
+                for entry in orjson.loads(response.text):
+                    email = (entry.get("email") or "").strip()
+                    if email:
+                        emails[entry.get("index")] = email
+            except Exception as e:
+                _record_error(span, "generating email batch", e, model_name)
+            
+            missing = [i for i in range(1, len(items) + 1) if i not in emails]
+            span.set_attribute("output.fallback_count", len(missing))
+        
+        if missing:
+            fallbacks = await asyncio.gather(*(
+                self._agenerate_email_single(items[i - 1][0], items[i - 1][1], model_name) for i in missing
+            ))
+            emails.update(zip(missing, fallbacks))
+        return [emails[i] for i in range(1, len(items) + 1)]
+
+    def generate_call_script(self, email_content: str) -> str:
+        """
+        基于生成的邮件内容，提炼一段简短的电话留言脚本 (Voicemail Script)。
+        风格：亲切、口语化。
+        """
+        with tracer.start_as_current_span("Gemini: Generate Script") as span:
+             prompt = self._call_script_prompt(email_content)
              
              try:
-                response = self.generative_model.generate_content(prompt)
+                model = self._pick_model("script")
+                response = model.generate_content(prompt)
                 return response.text.strip()
              except Exception as e:
-                 print(f"Error generating script: {e}")
-                 return "Hi, this is your account manager from SentinEL. We noticed you haven't been active lately and have a special offer for you. Please check your email!"
+                 _record_error(span, "generating script", e, self.active_model_name)
+                 return self._CALL_SCRIPT_FALLBACK
+
+    async def agenerate_call_script_stream(self, email_content: str) -> AsyncIterator[str]:
+        """
+        generate_call_script 的流式版本: 逐块产出脚本文本，调用方可在整句完成时立即送入 TTS。
+        生成失败且尚未产出任何内容时产出兜底脚本。
+        
+        Trace Span: "Gemini: Generate Script"
+        """
+        with tracer.start_as_current_span("Gemini: Generate Script") as span:
+            produced = False
+            try:
+                model = self._pick_model("script")
+                stream = await model.generate_content_async(
+                    self._call_script_prompt(email_content),
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not produced:
+                        span.add_event("first_token")
+                    produced = True
+                    yield chunk.text
+            except Exception as e:
+                _record_error(span, "generating script", e, self.active_model_name)
+                if not produced:
+                    yield self._CALL_SCRIPT_FALLBACK
+
 
+@lru_cache(maxsize=1)
+def get_llm_service() -> LLMService:
+    """
+    进程级 LLMService 单例: 模型对象、向量缓存与微批处理器只构建一份，所有调用方共享
+    """
+    return LLMService()
@@ -3,29 +3,43 @@ SentinEL 业务编排器
 协调 BigQuery, LLM 和 Storage 服务完成用户分析流程
 """
 
+import os
+import re
 import time
-from typing import Optional, Callable
+import threading
+from uuid import uuid4
+from functools import cached_property
+from typing import Optional, Callable, List
 from app.services.bigquery_service import BigQueryService
-from app.services.llm_service import LLMService
+from app.services.llm_service import LLMService, UserContext, get_llm_service, spend_tier
 from app.services.storage_service import get_storage_service
 from app.services.judge_service import AIJudge
 from app.core import telemetry
 # from opentelemetry import trace
 import logging
 import asyncio
-from fastapi import BackgroundTasks
 import base64
+import binascii
 from app.services.tts_service import TTSService
 from app.core.cache import cached_analysis
+from app.core.concurrency import run_in_threadpool
 from app.services.experiment_service import experiment_service
 from app.services.feature_store_service import get_feature_store_service
-from app.services.feature_store_service import get_feature_store_service
 from app.services.prediction_service import get_prediction_service
 from app.services.recommendation_service import get_recommendation_service
 
 logger = logging.getLogger(__name__)
 tracer = telemetry.get_tracer()
 
+# 通话脚本断句: 句末标点后跟空白，或换行 (要求空白可避免在 "5.99" 之类的数字中断开)
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# 超过该长度 (base64 字符) 的图片在线程中解码，不阻塞事件循环
+IMAGE_DECODE_INLINE_MAX = 1024 * 1024
+
+# analyze_users 批量分析的并发上限 (受 Gemini QPM 配额约束)
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "8"))
+
 
 class AnalysisOrchestrator:
     """
@@ -33,18 +47,49 @@ class AnalysisOrchestrator:
     负责协调各个服务完成完整的用户分析和挽留流程
     """
     
-    def __init__(self):
-        self.bq_service = BigQueryService()
-        self.llm_service = LLMService()
-        self.storage_service = get_storage_service()  # Initialize StorageService safely
-        self.judge_service = AIJudge() # Initialize AIJudge
-        self.tts_service = TTSService() # Initialize TTSService
-        self.tts_service = TTSService() # Initialize TTSService
-        self.prediction_service = get_prediction_service()  # 深度模型预测服务
-        self.recommendation_service = get_recommendation_service() # 推荐服务
+    def __init__(self, llm_service: Optional[LLMService] = None):
+        # 各服务客户端均在首次使用时创建 (见下方 cached_property)，冷启动不再预先建连；
+        # 低风险路径用不到的 TTS / Judge / 推荐服务不会被构造
+        if llm_service is not None:
+            # LLMService 为进程级单例，可由调用方注入 (覆盖 cached_property)
+            self.llm_service = llm_service
+        self._background_tasks: set = set()  # 持有 fire-and-forget 任务引用，防止被 GC
+        self._profile_inflight: dict = {}  # user_id -> 进行中的画像查询 (并发请求合并)
+        self._audit_tasks: dict = {}  # analysis_id -> 进行中的审计任务 (Worker 模式由 audit_workflow_result 等待)
+
+    @cached_property
+    def bq_service(self) -> BigQueryService:
+        return BigQueryService()
+
+    @cached_property
+    def llm_service(self) -> LLMService:
+        return get_llm_service()
+
+    @cached_property
+    def storage_service(self):
+        """Firestore 存储服务，初始化失败时为 None"""
+        return get_storage_service()
+
+    @cached_property
+    def judge_service(self) -> AIJudge:
+        return AIJudge()
+
+    @cached_property
+    def tts_service(self) -> TTSService:
+        return TTSService()
+
+    @cached_property
+    def prediction_service(self):
+        """深度模型预测服务"""
+        return get_prediction_service()
+
+    @cached_property
+    def recommendation_service(self):
+        """推荐服务"""
+        return get_recommendation_service()
 
     @cached_analysis(ttl_seconds=3600)  # 缓存 1 小时
-    def analyze_user_workflow(
+    async def analyze_user_workflow(
         self,
         user_id: str,
         analysis_id: Optional[str] = None,
@@ -64,7 +109,7 @@ class AnalysisOrchestrator:
         """
         # 记录开始时间
         logger.info(f"SentinEL-Orchestrator: STARTING ANALYSIS for user {user_id}")
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         # 0. 获取或生成分析 ID
         # 0. 获取或生成分析 ID
@@ -72,40 +117,46 @@ class AnalysisOrchestrator:
             analysis_id = self.storage_service.generate_id()
         elif not analysis_id:
             # Fallback if storage service failed
-            import uuid
-            analysis_id = str(uuid.uuid4())
+            analysis_id = uuid4().hex
         
-        # A/B 测试: 获取实验分组和模型
-        experiment_group, model_name = experiment_service.get_model_for_user(user_id)
-
-        # 1. BigQuery: 获取用户画像和特征上下文
-        profile = self.bq_service.get_user_churn_prediction(user_id)
-        feature_context = profile.get("features", {})
+        # 1. BigQuery 画像与 Feature Store 实时特征互不依赖，最先同时发起
+        #    (A/B 实验分组在首次需要处解析，不推迟两项查询的提交)
+        fs_task = asyncio.create_task(self._get_realtime_features(user_id))
+        try:
+            profile = await self._get_profile(user_id)
+        except Exception:
+            fs_task.cancel()
+            raise
+        pget = profile.get
+        feature_context = pget("features", {})
+        fcget = feature_context.get
         
-        # 1.5 Feature Store: 获取实时特征 (Real-time Context)
-        realtime_features = {}
+        # 1.1 RAG 检索只依赖 BigQuery 画像字段 (国家/来源/消费)，画像到手即投机启动，
+        #     与 Feature Store / 深度模型 / 推荐并行；低风险用户直接取消
+        country, source = fcget('country', 'global'), fcget('traffic_source', 'general')
+        # 消费额按 log10 分层 (与邮件缓存键同一分层): 同国家/来源/量级的客户共用同一查询文本
+        tier = spend_tier(fcget('monetary_90d'))
+        search_query_text = f"Customer from {country} via {source} spending tier {tier}"
+        rag_task = asyncio.create_task(self._retrieve_policies(search_query_text))
+        
+        # 1.5 Feature Store: 实时特征 (Real-time Context，已在步骤 1 启动)
+        realtime_features = await fs_task
         recent_events = []  # 用于深度模型的事件序列
-        try:
-            fs_service = get_feature_store_service()
-            if fs_service:
-                realtime_features = fs_service.get_online_features(user_id)
-                if realtime_features:
-                    logger.info(f"Retrieved realtime features for {user_id}: {realtime_features}")
-                    feature_context.update(realtime_features)
-                    # 提取事件序列用于深度模型 (如果 Feature Store 提供)
-                    recent_events = realtime_features.get("recent_events", [])
-        except Exception as e:
-            logger.warning(f"Feature Store retrieval failed: {e}")
+        if realtime_features:
+            feature_context.update(realtime_features)
+            # 提取事件序列用于深度模型 (如果 Feature Store 提供)
+            recent_events = realtime_features.get("recent_events", [])
         
         # 2. 深度模型预测: 使用 LSTM/Transformer 预测流失概率
         # 优先使用深度模型，如果不可用则回退到 BigQuery ML
-        churn_prob = profile.get("churn_probability", 0.0)  # 默认回退值
+        churn_prob = pget("churn_probability", 0.0)  # 默认回退值
         prediction_source = "bigquery_ml"  # 记录预测来源
+        pred = self.prediction_service
         
-        if self.prediction_service and recent_events:
+        if pred and recent_events:
             try:
                 # 调用 Vertex AI Endpoint 进行深度模型预测
-                deep_churn_prob = self.prediction_service.predict_churn(
+                deep_churn_prob = await pred.predict_churn_async(
                     user_id=user_id,
                     events=recent_events,
                     use_cache=True
@@ -115,21 +166,24 @@ class AnalysisOrchestrator:
                 logger.info(f"Deep model prediction for {user_id}: {churn_prob:.4f}")
                 
                 # 获取风险因素分析
-                risk_factors = self.prediction_service.analyze_sequence_risk_factors(recent_events)
+                risk_factors = pred.analyze_sequence_risk_factors(recent_events)
                 feature_context["risk_factors"] = risk_factors
             except Exception as e:
                 logger.warning(f"Deep model prediction failed, using BQ fallback: {e}")
-        elif self.prediction_service and not recent_events:
+        elif pred:
             # 如果没有事件序列，尝试从 BigQuery 获取
             logger.info(f"No recent events for {user_id}, using BQ fallback")
         
         # 确定风险等级
-        if self.prediction_service:
-            risk_level = self.prediction_service.get_risk_level(churn_prob)
+        if pred:
+            risk_level = pred.get_risk_level(churn_prob)
         else:
-            risk_level = "High" if profile.get("predicted_label") == 1 else "Low"
+            risk_level = "High" if pget("predicted_label") == 1 else "Low"
         
-        # 默认结果
+        # A/B 测试: 获取实验分组和模型 (本地计算，画像与特征已就绪)
+        experiment_group, model_name = experiment_service.get_model_for_user(user_id)
+        
+        # 默认结果 (低风险直接返回；高风险路径在末尾一次性 update)
         result = {
             "user_id": user_id,
             "risk_level": risk_level,
@@ -142,98 +196,194 @@ class AnalysisOrchestrator:
             "recommended_action": "No intervention needed",
             "analysis_id": analysis_id,
             "experiment_group": experiment_group,
-
             "model_used": model_name,
             "recommended_strategies": [] # 新增字段
         }
 
         # 2. 低风险跳过 (除非强制，暂简单处理)
         if risk_level == "Low":
-            self._schedule_save(
-                 background_save, user_id, churn_prob, risk_level, None, start_time, analysis_id
-            )
+            rag_task.cancel()
+            # 异步 Worker 模式下由调用方一次性写入终态，避免重复写入
+            if not is_async_worker:
+                self._schedule_save(
+                     background_save, user_id, churn_prob, risk_level, None, start_time, analysis_id
+                )
             return result
         
-        # 2.5 智能策略推荐 (双塔模型 + Vector Search)
+        # 2.5 智能策略推荐 (双塔模型 + Vector Search): 与邮件/脚本/TTS 无依赖，后台并行，返回前收集
+        rec_task = None
         if self.recommendation_service:
-            try:
-                # 异步调用推荐服务 (在同步方法中使用 event loop)
-                import asyncio
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                strategies = loop.run_until_complete(
-                    self.recommendation_service.get_recommendations(user_id, churn_prob)
-                )
-                loop.close()
-                result["recommended_strategies"] = strategies
-                logger.info(f"Generated {len(strategies)} recommendations for {user_id}")
-            except Exception as e:
-                logger.error(f"Recommendation failed: {e}")
-            
-        result["recommended_action"] = "Send Retention Email"
-        
-        # 3. RAG 搜索
-        country = feature_context.get('country', 'global')
-        source = feature_context.get('traffic_source', 'general')
-        spend = feature_context.get('monetary_90d', 0)
-        search_query_text = f"Customer from {country} via {source} spending {spend}"
+            rec_task = asyncio.create_task(self.recommendation_service.get_recommendations(user_id, churn_prob))
         
-        query_vector = self.llm_service.get_text_embedding(search_query_text)
-        policies = self.bq_service.search_similar_policies(query_vector, top_k=3)
-        result["retention_policies"] = policies
-        
-        # 4. Vision & LLM: 生成邮件
-        # Decode image if present
+        # 3. Decode image if present (在等待 RAG 结果之前完成)
         image_bytes = None
         if image_data:
             try:
                 # Remove header if present (e.g. "data:image/jpeg;base64,")
-                if "," in image_data:
-                    image_data = image_data.split(",")[1]
-                image_bytes = base64.b64decode(image_data)
+                _, sep, payload = image_data.partition(",")
+                encoded = payload if sep else image_data
+                if len(encoded) > IMAGE_DECODE_INLINE_MAX:
+                    image_bytes = await asyncio.to_thread(binascii.a2b_base64, encoded)
+                else:
+                    image_bytes = binascii.a2b_base64(encoded)
                 logger.info("Image decoded successfully for vision analysis.")
-            except Exception as e:
+            except (binascii.Error, ValueError) as e:
                 logger.error(f"Failed to decode image: {e}")
-
-        email_content = self.llm_service.generate_retention_email(profile, policies, image_bytes, model_name)
-        result["generated_email"] = email_content
         
-        # 5. 生成通话脚本 & TTS 语音 (串行执行，确保内容一致性)
+        # 3.1 RAG 搜索 (已在步骤 1.1 启动)
+        policies = await rag_task
+        
+        # 4. Vision & LLM: 生成邮件
+        email_content = await self.llm_service.agenerate_retention_email(
+            UserContext.from_profile(profile), policies, image_bytes, model_name
+        )
+        
+        # 4.1 AI 审计只依赖 (画像, 邮件, 策略): 邮件生成后立即启动，与脚本/TTS 并行
+        if email_content:
+            audit_task = self._spawn(self._run_audit_task(
+                user_profile=profile,
+                generated_email=email_content,
+                applied_policies=policies,
+                analysis_id=analysis_id
+            ))
+            if is_async_worker:
+                # 任务完成后仍保留在字典中，由 audit_workflow_result 取出 (审计通常早于脚本/TTS 完成)
+                self._audit_tasks[analysis_id] = audit_task
+        
+        # 5. 生成通话脚本 & TTS 语音 (脚本流式生成，每完成一句即送入 TTS)
+        call_script = audio_base64 = None
         if email_content:
-            # A. Generate Script
-            call_script = self.llm_service.generate_call_script(email_content)
-            result["call_script"] = call_script
-            
-            # B. Synthesize Audio
-            audio_base64 = self.tts_service.generate_voicemail_audio(call_script)
-            result["generated_audio"] = audio_base64
+            try:
+                call_script, audio_base64 = await self._generate_script_and_audio(email_content)
+            except BaseException:
+                # 工作流失败时调用方不会再取审计任务，在此释放 (任务本身继续在后台完成)
+                self._audit_tasks.pop(analysis_id, None)
+                raise
+
+        # 5.5 收集推荐结果
+        strategies = []
+        if rec_task is not None:
+            try:
+                strategies = await rec_task
+                logger.info(f"Generated {len(strategies)} recommendations for {user_id}")
+            except Exception as e:
+                logger.error(f"Recommendation failed: {e}")
 
         # 6. 计算处理时间
-        end_time = time.time()
-        processing_time_ms = int((end_time - start_time) * 1000)
-        result["processing_time_ms"] = processing_time_ms
+        processing_time_ms = int((time.perf_counter() - start_time) * 1000)
+        result.update({
+            "retention_policies": policies,
+            "generated_email": email_content,
+            "call_script": call_script,
+            "generated_audio": audio_base64,
+            "recommended_action": "Send Retention Email",
+            "recommended_strategies": strategies,
+            "processing_time_ms": processing_time_ms,
+        })
 
         # 7. 后台保存 (仅同步模式)
         if not is_async_worker:
             self._schedule_save(
-                background_save, user_id, churn_prob, risk_level, email_content, start_time, analysis_id
-            )
-
-        if email_content and background_save and not is_async_worker:
-             background_save(
-                self._run_audit_task,
-                user_profile=profile,
-                generated_email=email_content,
-                applied_policies=policies,
-                analysis_id=analysis_id
+                background_save, user_id, churn_prob, risk_level, email_content, start_time, analysis_id,
+                processing_time_ms=processing_time_ms
             )
         
         return result
 
-    def _schedule_save(self, background_save, user_id: str, churn_prob: float, risk_level: str, generated_email: str, start_time: float, analysis_id: str):
-        """Helper to run storage save in background"""
-        end_time = time.time()
-        latency_ms = int((end_time - start_time) * 1000)
+    async def _get_profile(self, user_id: str) -> dict:
+        """
+        获取用户画像 (BigQueryService 内有 5 分钟 TTL 缓存)；同一用户的并发请求共用一次查询
+        """
+        task = self._profile_inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(run_in_threadpool(self.bq_service.get_user_churn_prediction, user_id))
+            self._profile_inflight[user_id] = task
+            task.add_done_callback(lambda _: self._profile_inflight.pop(user_id, None))
+        profile = await asyncio.shield(task)
+        # 调用方会在 features 上追加实时特征，各请求持有独立副本
+        return {**profile, "features": dict(profile["features"])}
+
+    async def _generate_script_and_audio(self, email_content: str) -> tuple:
+        """
+        流式生成通话脚本，按句切分后立即并发合成语音: 第 N 句的 TTS 与第 N+1 句的生成重叠。
+        各句 MP3 按顺序拼接；任一句合成失败时不返回音频。
+        
+        Returns:
+            (call_script, audio_base64 或 None)
+        """
+        parts = []
+        pending = ""
+        tts_tasks = []
+        
+        def _synthesize(sentence: str):
+            tts_tasks.append(asyncio.create_task(
+                run_in_threadpool(self.tts_service.synthesize_audio_bytes, sentence)
+            ))
+        
+        async for chunk in self.llm_service.agenerate_call_script_stream(email_content):
+            parts.append(chunk)
+            pending += chunk
+            *sentences, pending = _SENTENCE_BREAK.split(pending)
+            for sentence in sentences:
+                if sentence.strip():
+                    _synthesize(sentence.strip())
+        if pending.strip():
+            _synthesize(pending.strip())
+        
+        call_script = "".join(parts).strip()
+        segments = await asyncio.gather(*tts_tasks)
+        if not segments or any(segment is None for segment in segments):
+            return call_script, None
+        return call_script, base64.b64encode(b"".join(segments)).decode("utf-8")
+
+    async def _get_realtime_features(self, user_id: str) -> dict:
+        """Feature Store 在线特征；服务不可用或查询失败时返回空字典"""
+        try:
+            fs_service = get_feature_store_service()
+            if not fs_service:
+                return {}
+            realtime_features = await run_in_threadpool(fs_service.get_online_features, user_id)
+            if realtime_features:
+                logger.info(f"Retrieved realtime features for {user_id}: {realtime_features}")
+            return realtime_features or {}
+        except Exception as e:
+            logger.warning(f"Feature Store retrieval failed: {e}")
+            return {}
+
+    async def _retrieve_policies(self, search_query_text: str) -> list:
+        """RAG: 查询文本 -> embedding -> BigQuery 向量检索挽留政策"""
+        query_vector = await self.llm_service.aget_text_embedding(search_query_text)
+        return await run_in_threadpool(self.bq_service.search_similar_policies, query_vector, top_k=3)
+
+    async def analyze_users(self, user_ids: List[str], max_concurrency: int = ANALYZE_CONCURRENCY) -> List[dict]:
+        """
+        批量分析多个用户
+        
+        先用一次 BigQuery 查询预取全部用户的画像 (写入预测缓存)，再并发执行各用户的工作流；
+        并发工作流的 RAG embedding 由 EmbeddingBatcher 合并为批量调用。
+        信号量限制同时在途的工作流数量以遵守 Gemini QPM。
+        单个用户失败不影响其他用户，对应位置返回 {"user_id", "error"}。
+        """
+        await run_in_threadpool(self.bq_service.prefetch_churn_predictions, list(user_ids))
+        
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def _analyze_one(user_id: str) -> dict:
+            async with semaphore:
+                try:
+                    return await self.analyze_user_workflow(user_id)
+                except Exception as e:
+                    logger.error(f"Batch analysis failed for {user_id}: {e}")
+                    return {"user_id": user_id, "error": str(e)}
+        
+        return await asyncio.gather(*(_analyze_one(u) for u in user_ids))
+
+    def _schedule_save(self, background_save, user_id: str, churn_prob: float, risk_level: str, generated_email: str, start_time: float, analysis_id: str,
+                       processing_time_ms: Optional[int] = None):
+        """Helper to run storage save in background (start_time 为 time.perf_counter() 读数)"""
+        latency_ms = processing_time_ms
+        if latency_ms is None:
+            latency_ms = int((time.perf_counter() - start_time) * 1000)
         
         if background_save and self.storage_service:
              background_save(
@@ -246,24 +396,44 @@ class AnalysisOrchestrator:
                  analysis_id=analysis_id
              )
         elif self.storage_service:
-             # Fallback if no background_save provided (e.g. testing)
-             self.storage_service.save_analysis_result(
+             # Fallback if no background_save provided (e.g. testing / analyze_users):
+             # 在线程中写入，不阻塞事件循环
+             self._spawn(run_in_threadpool(
+                 self.storage_service.save_analysis_result,
                  user_id=user_id,
                  churn_probability=churn_prob,
                  risk_level=risk_level,
                  generated_email=generated_email,
                  processing_time_ms=latency_ms,
                  analysis_id=analysis_id
-             )
+             ))
+
+    def _spawn(self, coro):
+        """fire-and-forget: 在事件循环上调度协程并持有任务引用直到完成"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def audit_workflow_result(self, result: dict):
+        """
+        等待工作流结果的 AI 审计完成 (异步 Worker 模式，在写入终态的同时调用)
+        
+        审计任务在邮件生成后即已启动；此处仅取出并等待，不会重复审计
+        (Worker 模式不走结果缓存，每个 analysis_id 都有对应的任务)。
+        """
+        audit_task = self._audit_tasks.pop(result.get("analysis_id"), None)
+        if audit_task is not None:
+            await audit_task
 
-    def _run_audit_task(self, user_profile: dict, generated_email: str, applied_policies: list, analysis_id: str):
+    async def _run_audit_task(self, user_profile: dict, generated_email: str, applied_policies: list, analysis_id: str):
         """
         Background task to run AI Audit (Judge) and update Firestore.
         """
         with tracer.start_as_current_span("run_audit_task"):
             try:
-                # 1. Run Evaluation
-                audit_result = self.judge_service.evaluate_response(
+                # 1. Run Evaluation (异步调用 Gemini，不占用线程)
+                audit_result = await self.judge_service.aevaluate_response(
                     user_profile=user_profile,
                     generated_email=generated_email,
                     applied_policies=applied_policies
@@ -271,7 +441,7 @@ class AnalysisOrchestrator:
                 
                 # 2. Update Firestore
                 if self.storage_service:
-                    self.storage_service.update_audit_result(analysis_id, audit_result)
+                    await run_in_threadpool(self.storage_service.update_audit_result, analysis_id, audit_result)
                 
             except Exception as e:
                 logger.error(f"Background audit failed for {analysis_id}: {e}")
@@ -279,9 +449,12 @@ class AnalysisOrchestrator:
 
 # 单例实例
 _orchestrator_instance = None
+_orchestrator_lock = threading.Lock()
 
 def get_orchestrator() -> "AnalysisOrchestrator":
     global _orchestrator_instance
     if _orchestrator_instance is None:
-        _orchestrator_instance = AnalysisOrchestrator()
+        with _orchestrator_lock:
+            if _orchestrator_instance is None:
+                _orchestrator_instance = AnalysisOrchestrator()
     return _orchestrator_instance
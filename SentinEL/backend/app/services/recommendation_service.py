@@ -5,13 +5,14 @@ SentinEL 推荐服务
 
 import logging
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from google.cloud import aiplatform
 from google.protobuf import json_format
 from google.cloud.aiplatform.matching_engine import matching_engine_index_endpoint
 
 from app.core.config import settings
 from app.core.telemetry import get_tracer
+from app.core.concurrency import run_in_threadpool
 
 logger = logging.getLogger(__name__)
 tracer = get_tracer()
@@ -91,59 +92,82 @@ class RecommendationService:
         """
         调用 User Tower 获取用户向量
         """
+        embeddings = await self.get_user_embeddings([(user_id, risk_score)])
+        return embeddings[0]
+
+    async def get_user_embeddings(self, users: List[Tuple[str, float]]) -> List[Optional[List[float]]]:
+        """
+        批量调用 User Tower: 一次 predict 请求携带多个 instance
+        
+        Args:
+            users: [(user_id, risk_score), ...]
+        
+        Returns:
+            与输入顺序一致的向量列表，失败的位置为 None
+        """
         if not self.user_endpoint:
             logger.warning("User Endpoint unavailable")
-            return None
+            return [None] * len(users)
             
         try:
             # 构造 Vertex AI Prediction 请求
             # 输入格式需符合 SavedModel signature
-            instances = [{
-                "user_id": user_id,
-                "user_risk_score": risk_score
-            }]
+            instances = [
+                {"user_id": user_id, "user_risk_score": risk_score}
+                for user_id, risk_score in users
+            ]
             
             # 异步执行同步调用
-            loop = asyncio.get_event_loop()
-            prediction = await loop.run_in_executor(
-                None, 
-                lambda: self.user_endpoint.predict(instances)
-            )
+            prediction = await run_in_threadpool(self.user_endpoint.predict, instances)
             
-            if prediction.predictions:
-                # 假设输出 key 为 "output_1" 或 similar，通常是一个 list
-                # TFRS 输出通常直接是 embedding list
-                embedding = prediction.predictions[0]
+            # 假设输出 key 为 "output_1" 或 similar，通常是一个 list
+            # TFRS 输出通常直接是 embedding list
+            embeddings: List[Optional[List[float]]] = []
+            for i in range(len(users)):
+                embedding = prediction.predictions[i] if i < len(prediction.predictions or []) else None
                 if isinstance(embedding, dict) and "output_1" in embedding:
-                     return embedding["output_1"]
-                return embedding # 列表形式
-                
-            return None
+                    embedding = embedding["output_1"]
+                embeddings.append(embedding or None)
+            return embeddings
             
         except Exception as e:
             logger.error(f"User Embedding prediction failed: {e}")
-            return None
+            return [None] * len(users)
 
     async def search_strategies(self, embedding: List[float], top_k: int = 3) -> List[Dict]:
         """
         在 Vector Search 中检索相似策略
         使用 Public Endpoint REST API 进行查询
         """
+        results = await self.search_strategies_batch([(embedding, top_k)])
+        return results[0]
+
+    async def search_strategies_batch(self, queries: List[Tuple[List[float], int]]) -> List[List[Dict]]:
+        """
+        批量向量检索: 一次 findNeighbors 请求携带多个 query
+        
+        Args:
+            queries: [(embedding, top_k), ...]
+        
+        Returns:
+            与输入顺序一致的检索结果列表
+        """
+        empty: List[List[Dict]] = [[] for _ in queries]
         if not self.index_endpoint:
             logger.warning("Index Endpoint unavailable")
-            return []
+            return empty
             
         try:
             # 获取 Public Endpoint Domain
             public_domain = self.index_endpoint.public_endpoint_domain_name
             if not public_domain:
                 logger.warning("No public endpoint domain found")
-                return []
+                return empty
                 
             # 查找已部署的 Index ID
             if not self.index_endpoint.deployed_indexes:
                 logger.warning("No deployed indexes found on endpoint")
-                return []
+                return empty
                 
             deployed_index_id = self.index_endpoint.deployed_indexes[0].id
             
@@ -167,46 +191,44 @@ class RecommendationService:
             
             payload = {
                 "deployed_index_id": deployed_index_id,
-                "queries": [{
-                    "datapoint": {
-                        "datapoint_id": "query",
-                        "feature_vector": embedding
-                    },
-                    "neighbor_count": top_k
-                }]
+                "queries": [
+                    {
+                        "datapoint": {
+                            "datapoint_id": f"query_{i}",
+                            "feature_vector": embedding
+                        },
+                        "neighbor_count": top_k
+                    }
+                    for i, (embedding, top_k) in enumerate(queries)
+                ]
             }
             
             # 异步发送请求
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: requests.post(url, json=payload, headers=headers, timeout=30)
-            )
+            response = await run_in_threadpool(requests.post, url, json=payload, headers=headers, timeout=30)
             
             if response.status_code != 200:
                 logger.error(f"Vector search API error: {response.status_code} - {response.text}")
-                return []
+                return empty
             
-            # 解析结果
+            # 解析结果 (nearestNeighbors 与 queries 顺序一致)
             data = response.json()
             neighbors = data.get("nearestNeighbors", [])
-            if not neighbors:
-                return []
                 
-            results = []
-            for neighbor in neighbors[0].get("neighbors", []):
-                datapoint = neighbor.get("datapoint", {})
-                results.append({
-                    "strategy_id": datapoint.get("datapointId", "unknown"),
-                    "score": neighbor.get("distance", 0.0)
-                })
+            results = empty
+            for i, query_neighbors in enumerate(neighbors[:len(queries)]):
+                for neighbor in query_neighbors.get("neighbors", []):
+                    datapoint = neighbor.get("datapoint", {})
+                    results[i].append({
+                        "strategy_id": datapoint.get("datapointId", "unknown"),
+                        "score": neighbor.get("distance", 0.0)
+                    })
                 
-            logger.info(f"Vector search returned {len(results)} results")
+            logger.info(f"Vector search returned results for {len(neighbors)}/{len(queries)} queries")
             return results
             
         except Exception as e:
             logger.error(f"Vector search failed: {e}")
-            return []
+            return empty
 
     async def get_recommendations(
         self, 
@@ -217,37 +239,62 @@ class RecommendationService:
         """
         获取用户推荐策略 (完整流程)
         """
-        with tracer.start_as_current_span("RecommendationService.get_recommendations") as span:
-            span.set_attribute("user.id", user_id)
-            span.set_attribute("risk.score", risk_score)
+        results = await self.batch_recommend([(user_id, risk_score, top_k)])
+        return results[0]
+
+    async def batch_recommend(self, items: List[Tuple[str, float, int]]) -> List[List[Dict]]:
+        """
+        批量获取推荐策略: User Tower 与 Vector Search 各发起一次批量调用
+        
+        Args:
+            items: [(user_id, risk_score, top_k), ...]
+        
+        Returns:
+            与输入顺序一致的推荐列表
+        """
+        with tracer.start_as_current_span("RecommendationService.batch_recommend") as span:
+            span.set_attribute("batch.size", len(items))
+            if len(items) == 1:
+                span.set_attribute("user.id", items[0][0])
+                span.set_attribute("risk.score", items[0][1])
             
             # 1. 获取 User Embedding
-            embedding = await self.get_user_embedding(user_id, risk_score)
-            
-            if not embedding:
-                logger.warning("Failed to get user embedding, returning fallback")
-                return self._get_fallback_strategies(risk_score)
-                
-            # 2. 向量检索
-            search_results = await self.search_strategies(embedding, top_k)
+            embeddings = await self.get_user_embeddings([(u, r) for u, r, _ in items])
             
-            if not search_results:
-                logger.warning("No search results, returning fallback")
-                return self._get_fallback_strategies(risk_score)
+            # 2. 向量检索 (仅对成功获取向量的请求)
+            searchable = [i for i, emb in enumerate(embeddings) if emb]
+            search_results: Dict[int, List[Dict]] = {}
+            if searchable:
+                batch_results = await self.search_strategies_batch(
+                    [(embeddings[i], items[i][2]) for i in searchable]
+                )
+                search_results = dict(zip(searchable, batch_results))
             
             # 3. 补充详情 (Mock for now, should load from DB/CSV)
-            recommendations = []
-            for res in search_results:
-                sid = res["strategy_id"]
-                # 简单 Mock 内容，实际应读取 strategies.csv 或数据库
-                recommendations.append({
-                    "id": sid,
-                    "score": res["score"],
-                    "description": self._get_strategy_description(sid),
-                    "type": self._infer_type(sid) 
-                })
+            all_recommendations = []
+            for i, (user_id, risk_score, _) in enumerate(items):
+                if not embeddings[i]:
+                    logger.warning(f"Failed to get user embedding for {user_id}, returning fallback")
+                    all_recommendations.append(self._get_fallback_strategies(risk_score))
+                    continue
+                if not search_results.get(i):
+                    logger.warning(f"No search results for {user_id}, returning fallback")
+                    all_recommendations.append(self._get_fallback_strategies(risk_score))
+                    continue
+                
+                recommendations = []
+                for res in search_results[i]:
+                    sid = res["strategy_id"]
+                    # 简单 Mock 内容，实际应读取 strategies.csv 或数据库
+                    recommendations.append({
+                        "id": sid,
+                        "score": res["score"],
+                        "description": self._get_strategy_description(sid),
+                        "type": self._infer_type(sid) 
+                    })
+                all_recommendations.append(recommendations)
                 
-            return recommendations
+            return all_recommendations
 
     def _get_fallback_strategies(self, risk_score: float) -> List[Dict]:
         """降级策略"""
@@ -280,3 +327,69 @@ def get_recommendation_service() -> RecommendationService:
     if _rec_service is None:
         _rec_service = RecommendationService()
     return _rec_service
+
+
+class RecommendationBatcher:
+    """
+    推荐请求微批处理器
+    
+    将短时间窗口内 (默认 5ms) 并发到达的推荐请求合并为一次 batch_recommend 调用，
+    User Tower 与 Vector Search 的批量接口吞吐远高于逐条调用。
+    窗口关闭或积累满 max_batch 条时立即发送。
+    """
+    
+    def __init__(self, service: RecommendationService, max_batch: int = 32, max_wait_s: float = 0.005):
+        self._service = service
+        self._max_batch = max_batch
+        self._max_wait_s = max_wait_s
+        self._pending: List[Tuple[str, float, int, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()  # 持有批处理任务引用，防止被 GC
+    
+    async def submit(self, user_id: str, risk_score: float, top_k: int = 3) -> List[Dict]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, risk_score, top_k, future))
+        
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait_s, self._flush)
+        
+        # 客户端断开导致当前协程被取消时，future 随之取消，批处理会跳过它
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch: List[Tuple[str, float, int, asyncio.Future]]):
+        live = [item for item in batch if not item[3].done()]
+        if not live:
+            return
+        try:
+            results = await self._service.batch_recommend([(u, r, k) for u, r, k, _ in live])
+        except Exception as e:
+            for *_, future in live:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(live, results):
+            if not future.done():
+                future.set_result(result)
+
+
+_rec_batcher: Optional[RecommendationBatcher] = None
+
+def get_recommendation_batcher() -> RecommendationBatcher:
+    global _rec_batcher
+    if _rec_batcher is None:
+        _rec_batcher = RecommendationBatcher(get_recommendation_service())
+    return _rec_batcher
@@ -9,6 +9,8 @@ from datetime import datetime
 import re
 from typing import Optional
 
+from app.services._clients import firestore_client
+
 
 class StorageService:
     """
@@ -17,9 +19,8 @@ class StorageService:
     """
     
     def __init__(self):
-        # 初始化 Firestore 客户端
-        # 使用默认凭证 (Application Default Credentials)
-        self.db = firestore.Client()
+        # 共享的 Firestore 客户端 (默认凭证 Application Default Credentials)
+        self.db = firestore_client()
         self.collection_name = "analysis_logs"
     
     def save_analysis_result(
@@ -65,7 +66,8 @@ class StorageService:
         else:
             doc_ref = self.db.collection(self.collection_name).document()
             
-        doc_ref.set(doc_data)
+        # merge 写入: 与并行执行的审计结果写入互不覆盖 (先后顺序无关)
+        doc_ref.set(doc_data, merge=True)
         
         print(f"[StorageService] 已保存分析日志: {doc_ref.id} for user {user_id}")
         return doc_ref.id
@@ -126,6 +128,48 @@ class StorageService:
             logs.append(data)
         
         return logs
+    
+    def get_recent_analysis_logs(self, user_id: str, limit: int = 10) -> list:
+        """
+        获取指定用户最近的分析日志
+        
+        需要 Firestore 复合索引: analysis_logs (user_id ASC, timestamp DESC)
+        
+        Args:
+            user_id: 用户 ID
+            limit: 返回记录数量
+        
+        Returns:
+            list: 该用户最近的分析记录列表
+        """
+        docs = (
+            self.db.collection(self.collection_name)
+            .where("user_id", "==", user_id)
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .limit(limit)
+            .stream()
+        )
+        
+        logs = []
+        for doc in docs:
+            data = doc.to_dict()
+            data["doc_id"] = doc.id
+            logs.append(data)
+        
+        return logs
+    
+    def get_user_profile(self, user_id: str) -> Optional[dict]:
+        """
+        获取用户画像文档 (user_profiles/{user_id})
+        
+        Args:
+            user_id: 用户 ID
+        
+        Returns:
+            dict | None: 用户画像，不存在时返回 None
+        """
+        doc = self.db.collection("user_profiles").document(user_id).get()
+        return doc.to_dict() if doc.exists else None
 
 
     def update_feedback(self, analysis_id: str, feedback_type: str) -> bool:
@@ -157,12 +201,13 @@ class StorageService:
         """
         try:
             doc_ref = self.db.collection(self.collection_name).document(analysis_id)
-            doc_ref.update({
+            # merge 写入而非 update: 审计与结果保存并行执行，文档此时可能尚未创建
+            doc_ref.set({
                 "audit_score": audit_data.get("score"),
                 "audit_reason": audit_data.get("reasoning"),
                 "audit_flags": audit_data.get("flags", []),
                 "audit_timestamp": firestore.SERVER_TIMESTAMP
-            })
+            }, merge=True)
             print(f"[StorageService] Audit result updated for {analysis_id}")
             return True
         except Exception as e:
@@ -210,7 +255,8 @@ class StorageService:
                 "updated_at": SERVER_TIMESTAMP,
                 **kwargs
             }
-            doc_ref.update(update_data)
+            # 单次 merge 写入: 状态与结果字段合并为一个 RPC
+            doc_ref.set(update_data, merge=True)
             print(f"[StorageService] Status updated for {analysis_id}: {status}")
             return True
         except Exception as e:
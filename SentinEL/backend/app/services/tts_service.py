@@ -11,6 +11,7 @@ except ImportError:
     texttospeech = None
 
 import base64
+from typing import Optional
 from app.core import telemetry
 
 tracer = telemetry.get_tracer()
@@ -39,9 +40,10 @@ class TTSService:
             print("TTS Service disabled (dependency missing)")
             self.client = None
 
-    def generate_voicemail_audio(self, text: str) -> str:
+    def synthesize_audio_bytes(self, text: str) -> Optional[bytes]:
         """
-        Generates audio from text and returns Base64 encoded MP3 string.
+        Synthesizes text to raw MP3 bytes. MP3 segments can be concatenated,
+        so callers may synthesize sentence by sentence and join the results.
         
         Trace Span: "TTS: Generate Audio"
         """
@@ -56,15 +58,22 @@ class TTSService:
                     voice=self.voice,
                     audio_config=self.audio_config
                 )
-
-                # Convert binary audio content to Base64 string for easy frontend consumption
-                audio_base64 = base64.b64encode(response.audio_content).decode("utf-8")
                 
                 span.set_attribute("output.audio_size_bytes", len(response.audio_content))
-                return audio_base64
+                return response.audio_content
                 
             except Exception as e:
                 span.set_attribute("error", True)
                 print(f"Error generating TTS: {e}")
                 # Return None or raise to let orchestrator handle graceful degradation
                 return None
+
+    def generate_voicemail_audio(self, text: str) -> Optional[str]:
+        """
+        Generates audio from text and returns Base64 encoded MP3 string.
+        """
+        audio_content = self.synthesize_audio_bytes(text)
+        if audio_content is None:
+            return None
+        # Convert binary audio content to Base64 string for easy frontend consumption
+        return base64.b64encode(audio_content).decode("utf-8")
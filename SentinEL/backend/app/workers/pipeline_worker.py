@@ -0,0 +1,115 @@
+"""
+SentinEL Data Factory 任务队列 Worker
+基于 FastStream + Redis List 的持久化任务队列，与 API 进程解耦
+
+- API 进程: 仅连接 broker 并发布任务 (见 endpoints/pipeline.py)
+- Worker 进程: 消费任务并执行 DataFactory 流水线
+    faststream run app.workers.pipeline_worker:worker_app
+
+任务状态写入 Redis Hash (sentinel:jobs:{job_id})，供 GET /jobs/{job_id} 轮询。
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from faststream import FastStream
+from faststream.redis import RedisBroker
+
+from app.core.cache import redis_client, REDIS_HOST, REDIS_PORT, REDIS_UDS_PATH
+from app.services.data_factory_service import DataFactory
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv(
+    "REDIS_URL",
+    f"unix://{REDIS_UDS_PATH}" if REDIS_UDS_PATH else f"redis://{REDIS_HOST}:{REDIS_PORT}"
+)
+PIPELINE_QUEUE = "data_pipeline_jobs"  # Redis List: 消息在 Worker 重启期间不会丢失
+JOB_KEY_PREFIX = "sentinel:jobs"
+JOB_TTL_SECONDS = 7 * 24 * 3600
+
+# 全局只允许一个流水线运行 (值为当前 job_id)，超时自动释放
+PIPELINE_LOCK_KEY = "sentinel:pipeline:lock"
+PIPELINE_LOCK_TTL_SECONDS = 3600
+
+broker = RedisBroker(REDIS_URL)
+worker_app = FastStream(broker)
+
+
+# ==============================================================================
+# Job Status
+# ==============================================================================
+
+async def set_job_status(job_id: str, status: str, **fields) -> bool:
+    """更新任务状态 (queued / running / completed / failed)"""
+    return await redis_client.hset(
+        f"{JOB_KEY_PREFIX}:{job_id}",
+        {"status": status, **fields},
+        ttl_seconds=JOB_TTL_SECONDS
+    )
+
+
+async def get_job_status(job_id: str) -> Optional[dict]:
+    """读取任务状态，不存在时返回 None"""
+    return await redis_client.hgetall(f"{JOB_KEY_PREFIX}:{job_id}")
+
+
+# ==============================================================================
+# Worker
+# ==============================================================================
+
+# DataFactory 延迟到首个任务时在线程中初始化 (GCP 客户端创建不阻塞事件循环)；
+# 初始化失败后退避一段时间再重试，而不是永久不可用
+INIT_FAILURE_THRESHOLD = 3
+INIT_BACKOFF_SECONDS = 60
+
+_data_factory: Optional[DataFactory] = None
+_data_factory_lock = asyncio.Lock()
+_init_failures = 0
+_init_retry_at = 0.0
+
+
+async def get_data_factory() -> DataFactory:
+    global _data_factory, _init_failures, _init_retry_at
+    if _data_factory is not None:
+        return _data_factory
+    
+    async with _data_factory_lock:
+        if _data_factory is not None:
+            return _data_factory
+        if time.monotonic() < _init_retry_at:
+            raise RuntimeError("DataFactory initialization backing off after repeated failures")
+        try:
+            _data_factory = await asyncio.to_thread(DataFactory)
+            _init_failures = 0
+        except Exception:
+            _init_failures += 1
+            if _init_failures >= INIT_FAILURE_THRESHOLD:
+                _init_retry_at = time.monotonic() + INIT_BACKOFF_SECONDS
+                _init_failures = 0
+            raise
+    return _data_factory
+
+
+@worker_app.on_startup
+async def _connect_cache():
+    await redis_client.connect()
+
+
+@broker.subscriber(list=PIPELINE_QUEUE)
+async def run_pipeline_task(job_id: str):
+    logger.info(f"Job {job_id}: Starting Data Factory Pipeline Task...")
+    await set_job_status(job_id, "running")
+    try:
+        data_factory = await get_data_factory()
+        result = await data_factory.run_pipeline()
+        logger.info(f"Job {job_id}: Pipeline finished. Result: {result}")
+        await set_job_status(job_id, "completed", **result)
+    except Exception as e:
+        logger.error(f"Job {job_id}: Pipeline failed: {e}")
+        await set_job_status(job_id, "failed", error=str(e))
+    finally:
+        await redis_client.release_lock(PIPELINE_LOCK_KEY, job_id)
@@ -0,0 +1,43 @@
+import asyncio
+
+from faststream.redis import TestRedisBroker
+
+from app.api.v1.endpoints import pipeline
+from app.workers import pipeline_worker
+
+
+class _FakeDataFactory:
+    async def run_pipeline(self):
+        return {"processed": 1}
+
+
+def test_enqueued_job_reaches_worker(monkeypatch):
+    """API 发布的消息必须能被 run_pipeline_task 解析并执行 (Redis 往返)"""
+    statuses = []
+    released = []
+
+    async def fake_set_job_status(job_id, status, **fields):
+        statuses.append((job_id, status))
+        return True
+
+    async def fake_get_data_factory():
+        return _FakeDataFactory()
+
+    async def fake_release_lock(key, owner):
+        released.append((key, owner))
+        return True
+
+    monkeypatch.setattr(pipeline, "set_job_status", fake_set_job_status)
+    monkeypatch.setattr(pipeline_worker, "set_job_status", fake_set_job_status)
+    monkeypatch.setattr(pipeline_worker, "get_data_factory", fake_get_data_factory)
+    monkeypatch.setattr(pipeline_worker.redis_client, "release_lock", fake_release_lock)
+
+    async def run():
+        async with TestRedisBroker(pipeline_worker.broker):
+            await pipeline._enqueue_pipeline_job("abc")
+            pipeline_worker.run_pipeline_task.mock.assert_called_once_with("abc")
+
+    asyncio.run(run())
+
+    assert statuses == [("abc", "queued"), ("abc", "running"), ("abc", "completed")]
+    assert released == [(pipeline_worker.PIPELINE_LOCK_KEY, "abc")]
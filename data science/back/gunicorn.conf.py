@@ -0,0 +1,28 @@
+"""
+Gunicorn 配置文件
+
+生产环境统一通过 `gunicorn -c gunicorn.conf.py main:app` 启动，
+取代 `app.run(debug=True)` 的 Werkzeug 开发服务器（reloader 会多 fork 一个进程）。
+worker/线程数可通过环境变量覆盖，默认值与 GAE F4 实例的内存预算一致。
+"""
+
+import os
+
+# 绑定端口（GAE / Cloud Run 通过 PORT 注入）
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# gthread: 每个 worker 多线程处理请求，I/O 等待期间不占用整个进程
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))  # F4 实例内存有限，默认 1 个 worker 避免 OOM
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# 5 分钟超时（模型训练 / 优化求解任务耗时较长）
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+
+# 在 master 中预加载应用（Pandas / Scikit-learn 等重依赖只导入一次），
+# fork 出的 worker 通过写时复制共享只读内存页，降低每个 worker 的 RSS
+preload_app = True
+
+# 日志输出到 stdout / stderr
+accesslog = "-"
+errorlog = "-"
@@ -158,4 +158,5 @@ app = create_app()
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    # 仅用于本地开发；生产环境使用 gunicorn -c gunicorn.conf.py main:app
+    app.run(host='0.0.0.0', port=port, debug=app.config.get('DEBUG', False))
\ No newline at end of file